@@ -0,0 +1,127 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import json
+import os
+import time
+import utilities
+from hostinfo import get_filesystem
+from procsampler import device_of_path
+from config import Config
+""" Write rate calibration of test devices, cached on disk.
+
+FileWriteTest needs the write rate of its device to check that its
+timeout allows Config.TEST_MIN_FILE_WRITES files. Probing writes synced
+blocks right before the measurement, so the rate is cached in
+Config.TEST_CALIBRATION_CACHE, keyed by the device (major:minor), its
+filesystem and the engine settings that change the rate (engine, block
+size, io size and preallocation). Entries older than
+Config.TEST_CALIBRATION_TTL seconds are probed again.
+
+The probe writes chunks of Config.TEST_CALIBRATION_CHUNK_BLOCKS blocks
+into one file and stops once the rates of two chunks in a row differ by
+less than Config.TEST_CALIBRATION_TOLERANCE, or after
+Config.TEST_TIMEOUT_NUM_OF_BLOCKS blocks, whichever is first.
+
+Clients on a host share the cache file. It is replaced atomically, so a
+client reads the old or the new version, and two clients probing at
+once only cost one extra probe.
+
+Example:
+    result = calibrate(ioengines.get_engine('sync', 4096))
+    print result.rate, result.cached, result.elapsed
+"""
+
+
+class Calibration(object):
+    """ Result of calibrate().
+
+        Args:
+            rate (float): bytes per second written by the engine.
+            cached (bool): True if rate came from the cache.
+            elapsed (float): seconds calibrate() took, the startup cost of the test.
+    """
+    __slots__ = ('rate', 'cached', 'elapsed')
+
+    def __init__(self, rate, cached, elapsed):
+        self.rate = rate
+        self.cached = cached
+        self.elapsed = elapsed
+
+
+def calibration_key(engine, directory=Config.TEST_LOG_DIR):
+    """ Returns the cache key of engine writing to the device holding directory. """
+    major, minor = device_of_path(directory)
+    settings = ','.join('{}={}'.format(name, value) for name, value in engine.get_args())
+    return '{}:{}|{}|{}'.format(major, minor, get_filesystem(directory), settings)
+
+
+def load_cache(location=Config.TEST_CALIBRATION_CACHE):
+    try:
+        with open(location, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (IOError, ValueError):
+        return {}
+
+
+def save_entry(key, rate, location=Config.TEST_CALIBRATION_CACHE):
+    """ Adds key to the cache file, dropping expired entries. """
+    now = time.time()
+    cache = dict((name, entry) for name, entry in load_cache(location).iteritems()
+                 if isinstance(entry, dict) and now - entry.get('time', 0) < Config.TEST_CALIBRATION_TTL)
+    cache[key] = dict(rate=rate, time=now)
+    temporary = '{}.{}.tmp'.format(location, os.getpid())
+    try:
+        utilities.verify_dir_exists(os.path.dirname(location) or '.')
+        with open(temporary, 'w') as f:
+            json.dump(cache, f, sort_keys=True)
+        os.rename(temporary, location)
+    except (IOError, OSError):
+        pass
+
+
+def probe(engine, directory=Config.TEST_LOG_DIR):
+    """ Writes chunks of blocks with engine until the rate is stable.
+
+        Return:
+            float: bytes per second of the last two chunks.
+    """
+    io_size = engine.io_size
+    chunk_bytes = max((Config.TEST_CALIBRATION_CHUNK_BLOCKS * engine.block_size) // io_size, 1) * io_size
+    max_bytes = max((Config.TEST_TIMEOUT_NUM_OF_BLOCKS * engine.block_size) // io_size, 1) * io_size
+    file_name = os.path.join(directory, 'calibration_{}'.format(os.getpid()))
+    file_descriptor = engine.open(file_name, max_bytes)
+    try:
+        written = 0
+        last_bytes, last_time = 0, 0.0
+        while written < max_bytes:
+            start = time.time()
+            chunk = engine.write_file(file_descriptor, min(chunk_bytes, max_bytes - written))
+            elapsed = max(time.time() - start, 1e-9)
+            written += chunk
+            if last_time and abs(chunk / elapsed - last_bytes / last_time) <= \
+                    Config.TEST_CALIBRATION_TOLERANCE * (last_bytes / last_time):
+                return (chunk + last_bytes) / (elapsed + last_time)
+            last_bytes, last_time = chunk, elapsed
+        return last_bytes / last_time
+    finally:
+        os.close(file_descriptor)
+        os.remove(file_name)
+
+
+def calibrate(engine, directory=Config.TEST_LOG_DIR, cache_location=Config.TEST_CALIBRATION_CACHE):
+    """ Returns the Calibration of engine writing to directory, from the cache while it is
+        fresh, otherwise probed and cached.
+    """
+    start = time.time()
+    utilities.verify_dir_exists(directory)
+    key = calibration_key(engine, directory)
+    entry = load_cache(cache_location).get(key)
+    try:
+        if start - entry['time'] < Config.TEST_CALIBRATION_TTL and entry['rate'] > 0:
+            return Calibration(entry['rate'], True, time.time() - start)
+    except (TypeError, KeyError):
+        pass
+    rate = probe(engine, directory)
+    save_entry(key, rate, cache_location)
+    return Calibration(rate, False, time.time() - start)
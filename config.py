@@ -1,26 +1,68 @@
 __author__ = 'Tristan Storz'
-from collections import namedtuple
 
 
 class Config(object):
     """ Config information for everything in the TestServer module """
 
     HTTP_PORT = 8000
+    HTTP_PAGE_SIZE = 50
+    HTTP_PAGE_SIZE_MAX = 1000
+    HTTP_CACHE_SIZE = 128
+    HTTP_STREAM_CHUNK = 16 * 1024
+    LIVE_PORT = 8001
+    LIVE_INTERVAL = 1.0
+    LIVE_BACKLOG = 64
+    LIVE_MAX_BUFFER = 1024 * 1024
+    LIVE_WRITE_SIZE = 64 * 1024
     PORT = 1115
     HOST = 'localhost'
 
     DB_NAME = 'test_server.db'
+    DB_JOURNAL_MODE = 'WAL'
+    DB_SYNCHRONOUS = 'NORMAL'
+    DB_QUEUE_SIZE = 10000
+    DB_QUEUE_HIGH_WATER = 8000
+    DB_QUEUE_LOW_WATER = 2000
+    DB_COMMIT_ROWS = 500
+    DB_COMMIT_INTERVAL = 1.0
+
+    SAMPLE_STATS = 0
+    SAMPLE_HEARTBEAT = 1
+    SAMPLE_ROLLOVER = 2
+    SAMPLE_TARGET_STATS = 3
+    SAMPLES_MAX_PER_RUN = 1000
+    SAMPLES_RETENTION_DAYS = 30
+    SECONDS_PER_DAY = 24 * 60 * 60
+    METRIC_WRITE_LATENCY = 'write_latency_us'
+    METRIC_CPU = 'cpu'
+    METRIC_MEM = 'mem'
+    METRIC_THROUGHPUT = 'throughput_mb_s'
+    METRIC_FILE_DURATION = 'file_duration_s'
+    METRIC_DISK_BUSY = 'disk_busy'
+    STATS_SKETCH_ACCURACY = 0.01
+    STATS_SKETCH_BUCKETS = 512
     SERVER_LOG_DIR = './server_logs/'
     TEST_LOG_DIR = './test_logs/'
+    HOST_INFO_CACHE = TEST_LOG_DIR + 'host_info.json'
 
     BYTES_PER_KILOBYTE = 1024
     BYTES_PER_MEGABYTE = 1024 * 1024
     MICRO_SECONDS_PER_SECOND = 1000000
+    NANO_SECONDS_PER_SECOND = 1000000000
 
     LOOP_TIMEOUT = 0.1
     LOOP_COUNT = 1
+    SERVER_ENGINE = 'asyncore'
+    SERVER_BACKLOG = 1024
+    SERVER_DRAIN_TIMEOUT = 5
+    ENGINE_MAX_EVENTS = 1024
+    ENGINE_RESCAN_INTERVAL = 1.0
+    ENGINE_DRAIN_POLL = 0.01
 
     TERMINATOR = '||'
+    CHANNEL_READ_SIZE = 4096
+    CHANNEL_MAX_MESSAGE = 4096
+    CHANNEL_HIGH_WATER = 256 * 1024
 
     API_CLOSE = 'end connection'
     API_CLIENT_START = 'start'
@@ -30,18 +72,55 @@ class Config(object):
     API_ID_REQUEST = 'id request'
     API_TEST_REQUEST = 'test request'
     API_SYSTEM_INFO = 'system info'
+    API_HOST = 'host'
     API_BAD_TIMEOUT = 'bad timeout'
     API_RUNNING_TEST = 'test start'
     API_HEARTBEAT = 'heartbeat'
     API_TEST_STATS = 'stats'
     API_TEST_FILE_WRITE = 'file write'
+    API_TEST_LATENCY = 'latency'
+    API_TEST_RESULT = 'result'
+    API_TEST_TARGET = 'target'
+    API_TEST_TARGET_STATS = 'target stats'
+    API_PROTOCOL = 'protocol'
+    PROTOCOL_BINARY = 'binary'
 
+    TEST_PLUGIN_PACKAGE = 'workloads'
+    TEST_ENTRY_POINT = 'testserver.tests'
     TEST_FILE_WRITE_NAME = 'file_write'
-    TEST_FILE_WRITE = namedtuple(TEST_FILE_WRITE_NAME, ['timeout', 'file_size'])
+    TEST_DEFAULT_ENGINE = 'sync'
+    TEST_DEFAULT_DURABILITY = 'dsync'
+    TEST_DEFAULT_SYNC_MB = 1
+    TEST_FILL_BYTE = b'\xab'
     TEST_DEFAULT_TIMEOUT_SEC = 10
     TEST_DEFAULT_FILE_SIZE_MB = 10
     TEST_TIMEOUT_CHECK = 0.1
     TEST_TIMEOUT_NUM_OF_BLOCKS = 256
+    TEST_CALIBRATION_CACHE = TEST_LOG_DIR + 'calibration.json'
+    TEST_CALIBRATION_TTL = 24 * 60 * 60
+    TEST_CALIBRATION_CHUNK_BLOCKS = 16
+    TEST_CALIBRATION_TOLERANCE = 0.1
     TEST_MIN_FILE_WRITES = 2
     TEST_HEARTBEAT_TIME = 5
     TEST_STATS_TIME = 2
+    TEST_STATS_MIN_TIME = 0.05
+    TEST_LATENCY_TIME = 2
+    TEST_STOP_TIMEOUT = 5
+
+    LIVENESS_MISSED_HEARTBEATS = 3
+    LIVENESS_RESOLUTION = 1.0
+    LIVENESS_SLOTS = 64
+
+    SCHEDULER_HOST_LIMIT = None
+    SCHEDULER_DEVICE_LIMIT = None
+    SCHEDULER_MAX_REQUEUES = 1
+
+    SWEEP_REPETITIONS = 1
+    SWEEP_PLATEAU = 0.05
+    SWEEP_PREFETCH = 8
+
+    LOG_ASYNC = True
+    LOG_QUEUE_SIZE = 10000
+    LOG_FORMAT = 'text'
+    LOG_RATE_LIMITS = {API_HEARTBEAT: 10, API_TEST_STATS: 10, API_TEST_FILE_WRITE: 10, API_TEST_LATENCY: 10,
+                       API_TEST_TARGET_STATS: 10}
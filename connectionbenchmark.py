@@ -0,0 +1,183 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import gc
+import imp
+import multiprocessing
+import os
+import Queue
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import dbwriter
+import livemetrics
+import testserver
+from dbwriter import DatabaseWriter
+from histogram import LogHistogram
+from loggers import server_log
+from scheduler import Scheduler
+from serverbenchmark import raise_file_limit, read_rss
+from config import Config
+""" Memory benchmark of ClientAPI connections.
+
+Accepts connections from a helper process that holds them open, then
+measures the resident memory the server process grows by:
+
+    idle    ClientAPI created for every accepted socket, nothing received.
+    active  every client sent start, test start, stats, a rollover and a
+            latency snapshot, as a client a few seconds into its test.
+
+Memory of the accepted sockets themselves is measured before the
+ClientAPIs are created and not counted. With -b the ClientAPI of another
+git revision is measured the same way, e.g. the one before RunState and
+the class level dispatch table. The revision's ClientAPI is constructed
+with the current arguments (sock, client_id, scheduler, db_writer,
+run_id, hosts, live, socket_map), older revisions that take others fail
+and report the error instead of a measurement.
+
+Example:
+    python connectionbenchmark.py -c 10000 -b 09afa63
+"""
+
+
+def hold_connections(port, count, ready, done, parent):
+    """ Helper process, connects count sockets and keeps them open until done is set or the
+        measuring process parent is gone, e.g. terminated after a timeout.
+    """
+    raise_file_limit()
+    sockets = [socket.create_connection((Config.HOST, port)) for _ in xrange(count)]
+    ready.set()
+    while not done.wait(Config.LOOP_TIMEOUT) and os.getppid() == parent:
+        pass
+    for sock in sockets:
+        sock.close()
+
+
+def load_client_class(revision):
+    """ Returns ClientAPI of testserver.py at a git revision, the current one if None. The module
+        stays in sys.modules, Python 2 clears the globals of a module once it is collected.
+    """
+    if revision is None:
+        return testserver.ClientAPI
+    directory = os.path.dirname(os.path.realpath(__file__))
+    source = subprocess.check_output(['git', 'show', '{}:testserver.py'.format(revision)], cwd=directory)
+    module = sys.modules['testserver_{}'.format(revision)] = imp.new_module('testserver_{}'.format(revision))
+    module.__file__ = os.path.join(directory, 'testserver.py')
+    exec compile(source, module.__file__, 'exec') in module.__dict__
+    return module.ClientAPI
+
+
+def activate(client):
+    """ Feeds client the messages of a running test. """
+    snapshot = LogHistogram()
+    snapshot.record(120)
+    client.handle_message(Config.API_CLIENT_START, [])
+    client.handle_message(Config.API_RUNNING_TEST, [Config.TEST_FILE_WRITE_NAME, "{'timeout': 10, 'file_size': 1}"])
+    client.handle_message(Config.API_TEST_STATS, [0.5, 0.25, 0.0, 0.1, 0, 4096, 0, 4096, 0.2])
+    client.handle_message(Config.API_TEST_FILE_WRITE, [0.0, 0, Config.BYTES_PER_MEGABYTE])
+    client.handle_message(Config.API_TEST_LATENCY, [0.0, 0, snapshot.encode()])
+
+
+def measure(client_class, count):
+    """ Return:
+            (float, float): bytes per idle and per active connection.
+    """
+    raise_file_limit()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((Config.HOST, 0))
+    listener.listen(Config.SERVER_BACKLOG)
+    ready = multiprocessing.Event()
+    done = multiprocessing.Event()
+    helper = multiprocessing.Process(target=hold_connections,
+                                     args=(listener.getsockname()[1], count, ready, done, os.getpid()))
+    helper.start()
+    db = sqlite3.connect(Config.DB_NAME)
+    dbwriter.initialize_schema(db)
+    db.close()
+    db_writer = DatabaseWriter(Config.DB_NAME)
+    db_writer.start()
+    try:
+        accepted = [listener.accept()[0] for _ in xrange(count)]
+        ready.wait()
+        live = livemetrics.LiveMetrics(dict)
+        scheduler = Scheduler()
+        socket_map = {}
+        gc.collect()
+        before = read_rss()[0]
+        clients = [client_class(sock, uuid.uuid4(), scheduler, db_writer, run_id, None, live, socket_map)
+                   for run_id, sock in enumerate(accepted)]
+        gc.collect()
+        idle = read_rss()[0]
+        for client in clients:
+            activate(client)
+        while db_writer.queue_depth():
+            time.sleep(Config.LOOP_TIMEOUT)
+        gc.collect()
+        active = read_rss()[0]
+        for client in clients:
+            client.del_channel()
+            client.socket.close()
+        return (idle - before) * 1024 / count, (active - before) * 1024 / count
+    finally:
+        done.set()
+        helper.join()
+        listener.close()
+        db_writer.close()
+
+
+def run(revision, count, results):
+    """ Measures in a process of its own so every class starts from the same heap. Puts
+        (idle, active, error) on results, error is None if the measurement succeeded.
+    """
+    try:
+        client_class = load_client_class(revision)
+    except Exception as e:
+        results.put((0, 0, repr(e)))
+        return
+    directory = tempfile.mkdtemp(prefix='connectionbenchmark')
+    os.chdir(directory)
+    server_log.disabled = True
+    try:
+        results.put(measure(client_class, count) + (None,))
+    except Exception as e:
+        results.put((0, 0, repr(e)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(count, baseline, timeout):
+    print '{} connections'.format(count)
+    print '{:<10} {:>12} {:>14}  {}'.format('ClientAPI', 'idle B/conn', 'active B/conn', 'error')
+    for name, revision in ((baseline, baseline), ('current', None)):
+        if name is None:
+            continue
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(revision, count, results))
+        process.start()
+        try:
+            idle, active, error = results.get(timeout=timeout)
+        except Queue.Empty:
+            idle, active, error = 0, 0, 'no result after {:g}s'.format(timeout)
+            process.terminate()
+        process.join()
+        if error is None and process.exitcode:
+            error = 'exit code {}'.format(process.exitcode)
+        print '{:<10} {:>12.0f} {:>14.0f}  {}'.format(name, idle, active, error or '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--connections', dest='connections', default=10000, type=int,
+                        help='connections to hold open')
+    parser.add_argument('-b', '--baseline', dest='baseline', default=None,
+                        help='git revision whose ClientAPI is measured for comparison, its constructor must '
+                             'take the current arguments')
+    parser.add_argument('-t', '--timeout', dest='timeout', default=300, type=float,
+                        help='max seconds per measurement')
+    cmd_input = parser.parse_args()
+    main(cmd_input.connections, cmd_input.baseline, cmd_input.timeout)
@@ -1,78 +1,552 @@
+from __future__ import division
 __author__ = 'Tristan Storz'
-import SimpleHTTPServer
+import BaseHTTPServer
 import SocketServer
+import email.utils
+import hashlib
+import json
+import os
+import re
 import sqlite3
+import threading
+import urlparse
+from collections import OrderedDict
 import jinja2
 from config import Config
-# Wrote this module to display the tests db in browser.
-# Uses jinja2 to template db info and simpleHttpServer
-# to host it at localhost 8000
+from histogram import LogHistogram
+from onlinestats import RunningStats
+""" HTTP service for the test server db.
 
+TestDataServer answers every request with a live query of the db, so
+results show up as soon as TestServer's writer commits them. Requests
+are handled in threads, each thread keeps its own read only connection.
 
-def get_test_data_from_db(database_location):
-    """ Query db and return the tests table.
+JSON endpoints:
+    /api/runs                 newest runs first, one page per request.
+                              Filters: test, status, host_id, since, until
+                              (start time, YYYY-mm-dd_HH:MM:SS).
+                              Paging: limit and before, the next_before
+                              value of the previous page.
+    /api/runs/<run_id>        one run with its workers, targets, metrics
+                              and latency percentiles.
+    /api/runs/<run_id>/samples  the run's sample timeline, optional kind.
+    /api/aggregates/tests     per test name aggregates, same filters.
+    /api/aggregates/hosts     per host aggregates, same filters.
+    /api/aggregates/devices   per (host, device) aggregates of the targets
+                              of the filtered runs.
+    /api/latency              write latency percentiles merged over runs
+                              (run_id=1,2,3) or every run.
+    /api/stats                cpu, mem and throughput summaries merged
+                              over runs (run_id=1,2,3), the runs of a
+                              host (host_id) and of a test (test).
+
+/ streams the index template over the same run pages as /api/runs.
+
+Every response has an ETag and a Last-Modified header derived from the
+db and its WAL file, and conditional requests are answered with 304.
+JSON bodies are kept in a small LRU cache keyed by request. The cache is
+dropped whenever the db changes, because a commit changes the WAL file.
+Errors are JSON as well: 400 for bad parameters, 404 for unknown
+resources, 503 while the db does not exist and 500 for db errors.
+
+Example:
+    serve(Config.DB_NAME, Config.HTTP_PORT)
+    # curl 'localhost:8000/api/runs?test=file_write&limit=20'
+"""
+
+RUN_COLUMNS = ['run_id', 'test_name', 'test', 'start_time', 'end_time', 'status', 'host_id', 'files_written',
+               'bytes_written', 'write_speed', 'avg_cpu', 'avg_mem', 'latency_p50', 'latency_p90', 'latency_p99',
+               'latency_p999', 'latency_max', 'clock_offset']
+RUN_FILTERS = OrderedDict([('test', ('test_name = ?', str)),
+                           ('status', ('status = ?', str)),
+                           ('host_id', ('host_id = ?', int)),
+                           ('since', ('start_time >= ?', str)),
+                           ('until', ('start_time < ?', str))])
+AGGREGATE_COLUMNS = '''count(*) AS runs,
+                       sum(status = 'COMPLETED') AS completed,
+                       sum(files_written) AS files_written,
+                       sum(bytes_written) AS bytes_written,
+                       avg(write_speed) AS avg_write_speed,
+                       min(write_speed) AS min_write_speed,
+                       max(write_speed) AS max_write_speed,
+                       avg(avg_cpu) AS avg_cpu,
+                       avg(avg_mem) AS avg_mem,
+                       avg(latency_p99) AS avg_latency_p99,
+                       max(latency_max) AS latency_max,
+                       min(start_time) AS first_start,
+                       max(start_time) AS last_start'''
+SAMPLE_COLUMNS = ['client_time', 'kind', 'cpu', 'mem', 'value', 'client_cpu', 'read_bytes', 'write_bytes',
+                  'disk_read_bytes', 'disk_write_bytes', 'disk_busy', 'duration', 'target']
+TARGET_COLUMNS = ['target', 'path', 'major', 'minor', 'filesystem', 'block_size', 'workers', 'files_written',
+                  'bytes_written', 'write_speed']
+DEVICE_AGGREGATE_COLUMNS = '''count(DISTINCT run_targets.run_id) AS runs,
+                              group_concat(DISTINCT run_targets.path) AS paths,
+                              group_concat(DISTINCT run_targets.filesystem) AS filesystems,
+                              sum(run_targets.files_written) AS files_written,
+                              sum(run_targets.bytes_written) AS bytes_written,
+                              avg(run_targets.write_speed) AS avg_write_speed,
+                              min(run_targets.write_speed) AS min_write_speed,
+                              max(run_targets.write_speed) AS max_write_speed'''
+
+
+class DatabaseMissing(Exception):
+    pass
+
+
+def get_run_filters(params):
+    """ Return:
+            (str, list): sql where clause (empty without filters) and its parameters for params.
+    """
+    clauses, values = [], []
+    for name, (clause, kind) in RUN_FILTERS.iteritems():
+        if params.get(name):
+            try:
+                values.append(kind(params[name]))
+            except ValueError:
+                raise ValueError('bad value for {}: {}'.format(name, params[name]))
+            clauses.append(clause)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', values
+
+
+def get_limit(params):
+    try:
+        limit = int(params.get('limit', Config.HTTP_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('bad value for limit: {}'.format(params['limit']))
+    return min(max(limit, 1), Config.HTTP_PAGE_SIZE_MAX)
+
+
+def iter_runs(db, params):
+    """ Validates params and runs the query, so bad params and db errors raise here rather than
+        while the runs are streamed.
+
+        Return:
+            iterator: runs newest first as dicts. Stops after limit runs, the last dict then holds
+                the next_before cursor of the following page.
+    """
+    where, values = get_run_filters(params)
+    if params.get('before'):
+        try:
+            values.append(int(params['before']))
+        except ValueError:
+            raise ValueError('bad value for before: {}'.format(params['before']))
+        where += (' AND ' if where else ' WHERE ') + 'rowid < ?'
+    limit = get_limit(params)
+    cursor = db.execute('SELECT rowid, {} FROM tests{} ORDER BY rowid DESC LIMIT ?;'.format(
+        ', '.join(RUN_COLUMNS), where), values + [limit + 1])
+    return page_runs(cursor, limit)
+
+
+def page_runs(cursor, limit):
+    """ Yields the first limit rows of cursor as run dicts, then the next_before cursor if more remain. """
+    for count, row in enumerate(cursor):
+        if count == limit:
+            yield dict(next_before=row_id)
+            return
+        row_id = row[0]
+        yield dict(zip(RUN_COLUMNS, row[1:]))
+
+
+def query_runs(db, params):
+    """ Return:
+            dict: runs on the requested page and next_before, None on the last page.
+    """
+    runs = list(iter_runs(db, params))
+    next_before = None
+    if runs and 'next_before' in runs[-1]:
+        next_before = runs.pop()['next_before']
+    return dict(runs=runs, next_before=next_before)
+
+
+def query_run(db, run_id):
+    """ Return:
+            dict: run_id's tests row with workers, targets, metrics and latency percentiles, None if
+                  unknown. Targets of a run with several carry their own stats.
+    """
+    row = db.execute('SELECT {} FROM tests WHERE run_id = ?;'.format(', '.join(RUN_COLUMNS)), (run_id,)).fetchone()
+    if row is None:
+        return None
+    run = dict(zip(RUN_COLUMNS, row))
+    run['workers'] = [dict(worker=worker, target=target, files_written=files, bytes_written=nbytes,
+                           write_speed=speed)
+                      for worker, target, files, nbytes, speed in db.execute(
+                          'SELECT worker, target, files_written, bytes_written, write_speed FROM run_workers '
+                          'WHERE run_id = ? ORDER BY worker;', (run_id,))]
+    run['targets'] = [dict(zip(TARGET_COLUMNS, row)) for row in db.execute(
+        'SELECT {} FROM run_targets WHERE run_id = ? ORDER BY target;'.format(', '.join(TARGET_COLUMNS)), (run_id,))]
+    for target in run['targets']:
+        target['stats'] = dict((metric, RunningStats.decode(encoded).summary()) for metric, encoded in db.execute(
+            'SELECT metric, summary FROM run_stats WHERE run_id = ? AND target = ?;', (run_id, target['target'])))
+    run['metrics'] = [dict(metric=metric, value=value, unit=unit) for metric, value, unit in db.execute(
+        'SELECT metric, value, unit FROM run_metrics WHERE run_id = ? ORDER BY metric;', (run_id,))]
+    latency = merge_histograms(db, [run_id])
+    run['latency'] = dict((str(percent), value) for percent, value in latency.percentiles().iteritems())
+    run['stats'] = dict((metric, stats.summary()) for metric, stats in merge_run_stats(db, [run_id]).iteritems())
+    return run
+
+
+def query_samples(db, run_id, params):
+    statement = 'SELECT {} FROM samples WHERE run_id = ?'.format(', '.join(SAMPLE_COLUMNS))
+    values = [run_id]
+    if params.get('kind'):
+        statement += ' AND kind = ?'
+        values.append(int(params['kind']))
+    return dict(run_id=run_id, samples=[dict(zip(SAMPLE_COLUMNS, row)) for row in
+                                        db.execute(statement + ' ORDER BY client_time;', values)])
+
+
+def query_test_aggregates(db, params):
+    """ Return:
+            dict: aggregates per test name, computed in sql over the filtered runs.
+    """
+    where, values = get_run_filters(params)
+    cursor = db.execute('SELECT test_name, {} FROM tests{} GROUP BY test_name ORDER BY test_name;'.format(
+        AGGREGATE_COLUMNS, where), values)
+    columns = [column[0] for column in cursor.description]
+    return dict(tests=[dict(zip(columns, row)) for row in cursor])
+
+
+def query_host_aggregates(db, params):
+    """ Return:
+            dict: aggregates per host with each host's fingerprint, computed in sql over the filtered runs.
+    """
+    where, values = get_run_filters(params)
+    cursor = db.execute('''SELECT tests.host_id, hosts.hash, hosts.info, {}
+                           FROM tests LEFT JOIN hosts ON tests.host_id = hosts.host_id{}
+                           GROUP BY tests.host_id ORDER BY tests.host_id;'''.format(AGGREGATE_COLUMNS, where),
+                        values)
+    columns = [column[0] for column in cursor.description]
+    hosts = []
+    for row in cursor:
+        host = dict(zip(columns, row))
+        try:
+            host['info'] = json.loads(host['info']) if host['info'] else None
+        except ValueError:
+            pass
+        hosts.append(host)
+    return dict(hosts=hosts)
+
+
+def query_device_aggregates(db, params):
+    """ Return:
+            dict: aggregates per host and device (major, minor) over the targets of the filtered runs.
+    """
+    where, values = get_run_filters(params)
+    cursor = db.execute('''SELECT run_targets.host_id, run_targets.major, run_targets.minor, {}
+                           FROM run_targets
+                           WHERE run_targets.run_id IN (SELECT run_id FROM tests{})
+                           GROUP BY run_targets.host_id, run_targets.major, run_targets.minor
+                           ORDER BY run_targets.host_id, run_targets.major, run_targets.minor;'''.format(
+                        DEVICE_AGGREGATE_COLUMNS, where), values)
+    columns = [column[0] for column in cursor.description]
+    return dict(devices=[dict(zip(columns, row)) for row in cursor])
+
+
+def merge_histograms(db, run_ids=None, metric=Config.METRIC_WRITE_LATENCY):
+    """ Returns the LogHistogram of metric merged over run_ids, every run if None. """
+    merged = LogHistogram()
+    statement = 'SELECT histogram FROM histograms WHERE metric=?'
+    parameters = [metric]
+    if run_ids is not None:
+        statement += ' AND run_id IN ({})'.format(','.join('?' * len(run_ids)))
+        parameters.extend(run_ids)
+    for (encoded,) in db.execute(statement + ';', parameters):
+        merged.merge(LogHistogram.decode(encoded))
+    return merged
+
+
+def merge_run_stats(db, run_ids=None, host_id=None, test_name=None):
+    """ Returns dict of metric to the RunningStats merged over the runs matching run_ids, host_id
+        and test_name, every run if all are None. Stats of single targets are left out.
+    """
+    statement = 'SELECT run_stats.metric, run_stats.summary FROM run_stats'
+    clauses, parameters = ['run_stats.target IS NULL'], []
+    if host_id is not None or test_name is not None:
+        statement += ' JOIN tests ON tests.run_id = run_stats.run_id'
+    if run_ids is not None:
+        clauses.append('run_stats.run_id IN ({})'.format(','.join('?' * len(run_ids))))
+        parameters.extend(run_ids)
+    if host_id is not None:
+        clauses.append('tests.host_id = ?')
+        parameters.append(host_id)
+    if test_name is not None:
+        clauses.append('tests.test_name = ?')
+        parameters.append(test_name)
+    statement += ' WHERE ' + ' AND '.join(clauses)
+    merged = {}
+    for metric, encoded in db.execute(statement + ';', parameters):
+        stats = merged.get(metric)
+        if stats is None:
+            stats = merged[metric] = RunningStats()
+        stats.merge(RunningStats.decode(encoded))
+    return merged
+
+
+def query_stats(db, params):
+    run_ids = None
+    if params.get('run_id'):
+        run_ids = [int(run_id) for run_id in params['run_id'].split(',')]
+    host_id = int(params['host_id']) if params.get('host_id') else None
+    merged = merge_run_stats(db, run_ids, host_id, params.get('test') or None)
+    return dict(run_ids=run_ids, host_id=host_id, test=params.get('test') or None,
+                stats=dict((metric, stats.summary()) for metric, stats in merged.iteritems()))
+
+
+def query_latency(db, params):
+    run_ids = None
+    if params.get('run_id'):
+        run_ids = [int(run_id) for run_id in params['run_id'].split(',')]
+    merged = merge_histograms(db, run_ids)
+    return dict(run_ids=run_ids, count=merged.count, mean=merged.mean(), max=merged.max,
+                percentiles=dict((str(percent), value) for percent, value in merged.percentiles().iteritems()))
+
+
+def get_merged_histogram(database_location, run_ids=None, metric=Config.METRIC_WRITE_LATENCY):
+    """ Query db and merge the histograms of metric across runs.
         Args:
             database_location (string): location of db.
+            run_ids (optional[list[int]]): runs to merge, all runs if None.
+            metric (optional[string]): histogram metric, write latency in microseconds by default.
 
         Return:
-            (list[dict]): each test stored as dict in list.
+            (LogHistogram): merged histogram, use percentile() or percentiles() on it.
     """
     db = sqlite3.connect(database_location)
-    db_tests = []
     try:
-        test_entries = db.execute('SELECT * FROM tests;')
-        for entry in test_entries:
-            test = dict(test=entry[0],
-                        start_time=entry[1],
-                        end_time=entry[2],
-                        files_written=entry[3],
-                        write_speed=entry[4],
-                        avg_cpu=entry[5],
-                        avg_mem=entry[6],
-                        cpu_info=entry[7],
-                        test_status=entry[8])
-            db_tests.append(test)
-    except sqlite3.OperationalError as e:
-        print 'test_server.db has not been created by TestServer or cannot be found by dbserver.py'
-        raise e
+        return merge_histograms(db, run_ids, metric)
     finally:
         db.close()
-        return db_tests
 
 
-def render_tests_to_template(db_tests):
-    """ Render tests in index.html """
-    try:
-        environment = jinja2.Environment(loader=jinja2.PackageLoader('testserver', 'templates'))
-        template = environment.get_template('index_template.html')
-        index_file = 'index.html'
-        with open(index_file, 'wb') as f:
-            f.write(template.render(tests=db_tests))
-    except ImportError as e:
-        print 'template not found'
-        raise e
-
-
-def http_server_at_local_host(port):
-    """ serve index.html at port """
-    server = SocketServer.TCPServer(('', port), SimpleHTTPServer.SimpleHTTPRequestHandler)
+class ResultCache(object):
+    """ Thread safe LRU cache of response bodies for one db version.
+
+        Args:
+            size (int): max number of cached bodies.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            body = self.entries.pop(key, None)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries[key] = body
+            self.hits += 1
+            return body
+
+    def put(self, key, version, body):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = body
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class RunPage(object):
+    """ Run page for the template. Iterating yields the runs, next_before is set once
+        the last run has been streamed. Params are validated on construction, before the
+        response is started.
+    """
+    def __init__(self, db, params):
+        self.runs = iter_runs(db, params)
+        self.next_before = None
+
+    def __iter__(self):
+        for run in self.runs:
+            if 'next_before' in run:
+                self.next_before = run['next_before']
+                return
+            yield run
+
+
+class TestDataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Routes GET requests to the query functions. """
+    server_version = 'TestDataServer/1.0'
+    routes = [(re.compile(r'^/api/runs/?$'), 'runs'),
+              (re.compile(r'^/api/runs/(\d+)/?$'), 'run'),
+              (re.compile(r'^/api/runs/(\d+)/samples/?$'), 'samples'),
+              (re.compile(r'^/api/aggregates/tests/?$'), 'test_aggregates'),
+              (re.compile(r'^/api/aggregates/hosts/?$'), 'host_aggregates'),
+              (re.compile(r'^/api/aggregates/devices/?$'), 'device_aggregates'),
+              (re.compile(r'^/api/latency/?$'), 'latency'),
+              (re.compile(r'^/api/stats/?$'), 'stats'),
+              (re.compile(r'^/(index\.html)?$'), 'index')]
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        for pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if match:
+                break
+        else:
+            return self.send_json(404, dict(error='no such resource {}'.format(url.path)))
+
+        try:
+            version, modified = self.server.data_version()
+            etag = '"{}"'.format(hashlib.sha1(self.path + version).hexdigest())
+            if self.not_modified(etag, modified):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            if name == 'index':
+                return self.send_index(params, etag, modified)
+            body = self.server.cache.get(self.path, version)
+            if body is None:
+                result = getattr(self, 'get_' + name)(params, *match.groups())
+                if result is None:
+                    return self.send_json(404, dict(error='no such resource {}'.format(url.path)))
+                body = json.dumps(result)
+                self.server.cache.put(self.path, version, body)
+        except DatabaseMissing as e:
+            return self.send_json(503, dict(error=str(e)))
+        except ValueError as e:
+            return self.send_json(400, dict(error=str(e)))
+        except sqlite3.Error as e:
+            return self.send_json(500, dict(error='database error: {}'.format(e)))
+        self.send_body(200, body, 'application/json', etag, modified)
+
+    def not_modified(self, etag, modified):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            return since is not None and int(modified) <= email.utils.mktime_tz(since)
+        return False
+
+    def get_runs(self, params):
+        return query_runs(self.server.get_db(), params)
+
+    def get_run(self, params, run_id):
+        return query_run(self.server.get_db(), int(run_id))
+
+    def get_samples(self, params, run_id):
+        return query_samples(self.server.get_db(), int(run_id), params)
+
+    def get_test_aggregates(self, params):
+        return query_test_aggregates(self.server.get_db(), params)
+
+    def get_host_aggregates(self, params):
+        return query_host_aggregates(self.server.get_db(), params)
+
+    def get_device_aggregates(self, params):
+        return query_device_aggregates(self.server.get_db(), params)
+
+    def get_latency(self, params):
+        return query_latency(self.server.get_db(), params)
+
+    def get_stats(self, params):
+        return query_stats(self.server.get_db(), params)
+
+    def send_index(self, params, etag, modified):
+        """ Streams the index template while the runs are read from the db. """
+        page = RunPage(self.server.get_db(), params)
+        stream = self.server.template.generate(page=page, params=params)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(modified, usegmt=True))
+        self.end_headers()
+        chunks = []
+        size = 0
+        for chunk in stream:
+            chunk = chunk.encode('utf-8')
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= Config.HTTP_STREAM_CHUNK:
+                self.wfile.write(''.join(chunks))
+                chunks, size = [], 0
+        self.wfile.write(''.join(chunks))
+
+    def send_json(self, code, result):
+        self.send_body(code, json.dumps(result), 'application/json')
+
+    def send_body(self, code, body, content_type, etag=None, modified=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(modified, usegmt=True))
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestDataServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP server over the test server db.
+
+        Args:
+            address (tuple): (host, port) to serve on.
+            database_location (str): location of db.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, database_location):
+        BaseHTTPServer.HTTPServer.__init__(self, address, TestDataHandler)
+        self.database_location = database_location
+        self.local = threading.local()
+        self.cache = ResultCache(Config.HTTP_CACHE_SIZE)
+        environment = jinja2.Environment(loader=jinja2.PackageLoader('testserver', 'templates'), autoescape=True)
+        self.template = environment.get_template('index_template.html')
+
+    def get_db(self):
+        """ Returns the calling thread's connection, opened on first use. """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.database_location)
+            db.execute('PRAGMA query_only = 1;')
+            self.local.db = db
+        return db
+
+    def data_version(self):
+        """ Return:
+                (str, float): version that changes with every commit and the last modification time.
+        """
+        stats = []
+        for location in (self.database_location, self.database_location + '-wal'):
+            try:
+                stat = os.stat(location)
+            except OSError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size))
+        if not stats:
+            raise DatabaseMissing('test_server.db has not been created by TestServer or cannot be found by dbserver.py')
+        return repr(stats), max(mtime for mtime, _ in stats)
+
+
+def serve(database_location, port):
+    """ serve the db at port until interrupted """
+    server = TestDataServer(('', port), database_location)
     try:
         print 'now serving test data at localhost {}'.format(port)
         print 'press ctrl+C to end'
         server.serve_forever()
     except KeyboardInterrupt:
         print 'keyboard interrupt'
-    except Exception as e:
-        raise e
     finally:
-        server.shutdown()
+        server.server_close()
 
 
 if __name__ == '__main__':
     try:
-        tests = get_test_data_from_db(Config.DB_NAME)
-        render_tests_to_template(tests)
-        http_server_at_local_host(Config.HTTP_PORT)
+        serve(Config.DB_NAME, Config.HTTP_PORT)
     except Exception as exc:
         print 'Faulted during execution'
         raise exc
@@ -0,0 +1,483 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import threading
+import sqlite3
+import Queue
+import time
+from collections import OrderedDict
+from config import Config
+from loggers import server_log
+""" Write-behind database writer for TestServer.
+
+DatabaseWriter owns the only sqlite3 connection used while the server is
+running. ClientAPI instances hand rows to insert() or execute(), which only
+puts them on a bounded queue, so the asyncore loop never waits on disk.
+The writer thread batches queued rows per statement with executemany()
+and commits a group of rows whenever Config.DB_COMMIT_ROWS rows are
+pending or Config.DB_COMMIT_INTERVAL seconds have passed, whichever is
+first. The database runs in WAL journal mode with a tunable synchronous
+setting.
+
+If the queue fills up, insert() and execute() block until the writer
+catches up, so rows are never dropped. Maintenance work that needs the
+connection, such as downsampling a finished run, is queued with call()
+and runs in the writer thread after pending rows are flushed.
+
+A batch that fails is written again row by row, so a row sqlite cannot
+store (e.g. an integer beyond 64 bits) is dropped and counted alone
+instead of taking the rows of other clients with it. Should the writer
+thread stop anyway, put() raises DatabaseWriterError instead of queueing
+rows nobody will write.
+
+The schema is described by TABLES and INDEXES. initialize_schema()
+creates missing tables and adds missing columns to databases written by
+older versions of the server.
+
+The samples table keeps the timeline of every run. Each row is keyed by
+run_id and the client's timestamp. cpu, mem, client_cpu and disk_busy are
+fractions and are averaged when downsampling. value and the byte counters
+are deltas since the previous sample (bytes for rollovers, 1 per
+heartbeat) and are summed, so downsampled rows keep run totals intact.
+duration is the seconds a rollover's file took on the client's monotonic
+clock. Downsampling keeps the longest, so slow files stay visible.
+
+run_workers keeps the files, bytes and throughput (MB/s) of every writer
+of a run and the target it wrote to. The tests row holds the aggregate.
+run_metrics keeps the metrics a test declares in testregistry, combined
+over its workers.
+
+tests.test holds the test name and its arguments, test_name the name
+alone so runs can be filtered and grouped by test over an index.
+
+hosts keeps one row per host fingerprint (see hostinfo.py). tests rows
+reference it by host_id. cpu_info is only set on rows written before
+hosts existed.
+
+histograms keeps the merged histogram.LogHistogram of every run in its
+encoded form, so percentiles can be computed over any set of runs. The
+tests row holds the run's write latency percentiles in microseconds.
+
+run_stats keeps the onlinestats.RunningStats of a run's cpu, mem and
+per stats interval throughput (MB/s), as columns and in the encoded
+summary that merges with those of other runs. The tests row's avg_cpu
+and avg_mem are their means. file_duration_s summarises the durations of
+the run's files.
+
+tests.clock_offset is the server's time.time() minus the client's
+monotonic clock in seconds, estimated from the smallest difference seen
+on the connection. Adding it to a client's monotonic timestamp gives
+server time.
+
+run_targets keeps one row per target directory of a run with the host
+and the block device (major, minor) backing it, so results can be
+grouped per host and device. Target stats samples (kind
+Config.SAMPLE_TARGET_STATS) and run_stats rows of a single target carry
+its index in target, run level rows have none.
+
+Example:
+    writer = DatabaseWriter(Config.DB_NAME)
+    writer.start()
+    writer.insert('tests', dict(test='file_write', status='COMPLETED'))
+    writer.call(downsample_run, 1, Config.SAMPLES_MAX_PER_RUN)
+    writer.close()
+    print writer.get_counters()
+"""
+
+
+TABLES = OrderedDict([
+    ('tests', [('test', 'text'),
+               ('start_time', 'text'),
+               ('end_time', 'text'),
+               ('files_written', 'int'),
+               ('write_speed', 'int'),
+               ('avg_cpu', 'float'),
+               ('avg_mem', 'float'),
+               ('cpu_info', 'text'),
+               ('status', 'text'),
+               ('run_id', 'int'),
+               ('bytes_written', 'int'),
+               ('latency_p50', 'int'),
+               ('latency_p90', 'int'),
+               ('latency_p99', 'int'),
+               ('latency_p999', 'int'),
+               ('latency_max', 'int'),
+               ('host_id', 'int'),
+               ('test_name', 'text'),
+               ('clock_offset', 'real')]),
+    ('hosts', [('host_id', 'integer primary key'),
+               ('hash', 'text'),
+               ('info', 'text'),
+               ('first_seen', 'text')]),
+    ('run_workers', [('run_id', 'int'),
+                     ('worker', 'int'),
+                     ('files_written', 'int'),
+                     ('bytes_written', 'int'),
+                     ('write_speed', 'float'),
+                     ('target', 'int')]),
+    ('run_targets', [('run_id', 'int'),
+                     ('target', 'int'),
+                     ('host_id', 'int'),
+                     ('path', 'text'),
+                     ('major', 'int'),
+                     ('minor', 'int'),
+                     ('filesystem', 'text'),
+                     ('block_size', 'int'),
+                     ('workers', 'int'),
+                     ('files_written', 'int'),
+                     ('bytes_written', 'int'),
+                     ('write_speed', 'float')]),
+    ('samples', [('run_id', 'int'),
+                 ('client_time', 'real'),
+                 ('kind', 'int'),
+                 ('cpu', 'real'),
+                 ('mem', 'real'),
+                 ('value', 'real'),
+                 ('client_cpu', 'real'),
+                 ('read_bytes', 'int'),
+                 ('write_bytes', 'int'),
+                 ('disk_read_bytes', 'int'),
+                 ('disk_write_bytes', 'int'),
+                 ('disk_busy', 'real'),
+                 ('duration', 'real'),
+                 ('target', 'int')]),
+    ('run_metrics', [('run_id', 'int'),
+                     ('metric', 'text'),
+                     ('value', 'real'),
+                     ('unit', 'text')]),
+    ('histograms', [('run_id', 'int'),
+                    ('metric', 'text'),
+                    ('count', 'int'),
+                    ('histogram', 'text')]),
+    ('run_stats', [('run_id', 'int'),
+                   ('metric', 'text'),
+                   ('count', 'int'),
+                   ('mean', 'real'),
+                   ('stddev', 'real'),
+                   ('min', 'real'),
+                   ('max', 'real'),
+                   ('p50', 'real'),
+                   ('p90', 'real'),
+                   ('p99', 'real'),
+                   ('summary', 'text'),
+                   ('target', 'int')]),
+])
+
+INDEXES = ['CREATE INDEX IF NOT EXISTS samples_run_time ON samples (run_id, client_time);',
+           'CREATE INDEX IF NOT EXISTS samples_time ON samples (client_time);',
+           'CREATE INDEX IF NOT EXISTS run_workers_run ON run_workers (run_id);',
+           'CREATE INDEX IF NOT EXISTS histograms_run ON histograms (run_id, metric);',
+           'CREATE INDEX IF NOT EXISTS run_metrics_run ON run_metrics (run_id, metric);',
+           'CREATE INDEX IF NOT EXISTS run_stats_run ON run_stats (run_id, metric);',
+           'CREATE INDEX IF NOT EXISTS run_targets_run ON run_targets (run_id);',
+           'CREATE INDEX IF NOT EXISTS run_targets_device ON run_targets (host_id, major, minor);',
+           'CREATE UNIQUE INDEX IF NOT EXISTS hosts_hash ON hosts (hash);',
+           'CREATE INDEX IF NOT EXISTS tests_test_name ON tests (test_name);',
+           'CREATE INDEX IF NOT EXISTS tests_host ON tests (host_id);',
+           'CREATE INDEX IF NOT EXISTS tests_status ON tests (status);',
+           'CREATE INDEX IF NOT EXISTS tests_run ON tests (run_id);']
+
+# Fill columns added to old databases. Each statement must be safe to run on every start.
+MIGRATIONS = ["""UPDATE tests SET test_name = substr(test, 1, instr(test || char(10), char(10)) - 1)
+                 WHERE test_name IS NULL;"""]
+
+
+def initialize_schema(db):
+    """ Creates missing tables, columns and indexes and fills new columns of old rows.
+        Args:
+            db (sqlite3.Connection): open database connection.
+    """
+    for table, columns in TABLES.iteritems():
+        db.execute('CREATE TABLE IF NOT EXISTS {} ({});'.format(
+            table, ', '.join(name + ' ' + kind for name, kind in columns)))
+        existing = set(row[1] for row in db.execute('PRAGMA table_info({});'.format(table)))
+        for name, kind in columns:
+            if name not in existing:
+                db.execute('ALTER TABLE {} ADD COLUMN {} {};'.format(table, name, kind))
+    for index in INDEXES:
+        db.execute(index)
+    for migration in MIGRATIONS:
+        db.execute(migration)
+    db.commit()
+
+
+def get_last_run_id(db):
+    """ Return:
+            int: highest run_id stored in the database, 0 if there are none.
+    """
+    return max(db.execute('SELECT max(run_id) FROM tests;').fetchone()[0],
+               db.execute('SELECT max(run_id) FROM samples;').fetchone()[0]) or 0
+
+
+def get_hosts(db):
+    """ Return:
+            dict: hash mapped to host_id for every stored host.
+    """
+    return dict(db.execute('SELECT hash, host_id FROM hosts;').fetchall())
+
+
+def get_host_infos(db):
+    """ Return:
+            dict: host_id mapped to the encoded info of every stored host.
+    """
+    return dict(db.execute('SELECT host_id, info FROM hosts;').fetchall())
+
+
+def downsample_run(db, run_id, max_samples):
+    """ Collapses the samples of a run into max_samples equal time buckets per kind and target.
+        Fractions are averaged, value and byte counters are summed, the longest duration is
+        kept and each bucket keeps its first timestamp.
+
+        Args:
+            db (sqlite3.Connection): open database connection.
+            run_id (int): run to downsample.
+            max_samples (int): buckets per kind of sample.
+    """
+    start, stop = db.execute('SELECT min(client_time), max(client_time) FROM samples WHERE run_id=?;',
+                             (run_id,)).fetchone()
+    if start is None or stop <= start:
+        return
+    width = (stop - start) / max_samples
+    rows = db.execute('''SELECT run_id, min(client_time), kind, avg(cpu), avg(mem), sum(value), avg(client_cpu),
+                                sum(read_bytes), sum(write_bytes), sum(disk_read_bytes), sum(disk_write_bytes),
+                                avg(disk_busy), max(duration), target
+                         FROM samples WHERE run_id=?
+                         GROUP BY kind, target, min(CAST((client_time - ?) / ? AS int), ?);''',
+                      (run_id, start, width, max_samples - 1)).fetchall()
+    db.execute('DELETE FROM samples WHERE run_id=?;', (run_id,))
+    db.executemany('''INSERT INTO samples (run_id, client_time, kind, cpu, mem, value, client_cpu, read_bytes,
+                                           write_bytes, disk_read_bytes, disk_write_bytes, disk_busy, duration,
+                                           target)
+                      VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);''', rows)
+
+
+def run_stats_row(run_id, metric, stats, target=None):
+    """ Returns the run_stats row of the RunningStats of metric, of the whole run if target is None. """
+    row = stats.summary()
+    row.update(run_id=run_id, metric=metric, summary=stats.encode(), target=target)
+    return row
+
+
+def expire_samples(db, before):
+    """ Deletes samples older than before (seconds since epoch). """
+    db.execute('DELETE FROM samples WHERE client_time < ?;', (before,))
+
+
+class DatabaseWriterError(Exception):
+    pass
+
+
+class DatabaseWriter(threading.Thread):
+    """ Thread that writes queued statements to the database.
+
+        Args:
+            database_location (str): location of db.
+            synchronous (optional[str]): sqlite PRAGMA synchronous value (OFF, NORMAL, FULL).
+            queue_size (optional[int]): max number of queued rows before execute() blocks.
+            commit_rows (optional[int]): pending rows that trigger a commit.
+            commit_interval (optional[float]): max seconds between commits of pending rows.
+    """
+    _STOP = None
+
+    def __init__(self, database_location, synchronous=Config.DB_SYNCHRONOUS, queue_size=Config.DB_QUEUE_SIZE,
+                 commit_rows=Config.DB_COMMIT_ROWS, commit_interval=Config.DB_COMMIT_INTERVAL):
+        threading.Thread.__init__(self, name='DatabaseWriter')
+        self.daemon = True
+        self.database_location = database_location
+        self.synchronous = synchronous
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.insert_statements = {}
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.error = None
+        self.commits = 0
+        self.queue_full_waits = 0
+        self.max_queue_depth = 0
+        self.commit_time_total = 0
+        self.commit_time_last = 0
+        self.commit_time_max = 0
+
+    def execute(self, statement, parameters):
+        """ Queues one row for the writer thread.
+            Args:
+                statement (str): sql statement with ? placeholders.
+                parameters (tuple): values for statement.
+        """
+        self.put((statement, parameters))
+
+    def insert(self, table, row):
+        """ Queues one row for table.
+            Args:
+                table (str): table name.
+                row (dict): column names mapped to values.
+        """
+        columns = tuple(sorted(row))
+        statement = self.insert_statements.get((table, columns))
+        if statement is None:
+            statement = 'INSERT INTO {} ({}) VALUES ({});'.format(table, ', '.join(columns),
+                                                                ','.join('?' * len(columns)))
+            self.insert_statements[(table, columns)] = statement
+        self.put((statement, tuple(row[column] for column in columns)))
+
+    def call(self, function, *args):
+        """ Queues function(db, *args) to run in the writer thread after pending rows are written. """
+        self.put((function, args))
+
+    def put(self, item):
+        """ Queues item, waiting while the queue is full. Raises DatabaseWriterError if the writer
+            thread has stopped, nothing would ever take item off the queue.
+        """
+        self.check_alive()
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.queue_full_waits += 1
+            server_log.debug('Database queue full, waiting on writer')
+            while True:
+                try:
+                    self.queue.put(item, timeout=Config.LOOP_TIMEOUT)
+                    break
+                except Queue.Full:
+                    self.check_alive()
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def close(self):
+        """ Flushes every queued row, commits and waits for the writer thread to end. """
+        if self.is_alive():
+            self.queue.put(DatabaseWriter._STOP)
+            self.join()
+
+    def check_alive(self):
+        """ Raises DatabaseWriterError if the writer thread was started and has stopped. """
+        if self.ident is not None and not self.is_alive():
+            raise DatabaseWriterError('database writer stopped{}'.format(
+                ': {!r}'.format(self.error) if self.error is not None else ''))
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def get_counters(self):
+        """ Return:
+                dict: queue depth, rows written and dropped and commit latency in seconds.
+        """
+        return dict(queue_depth=self.queue.qsize(),
+                    max_queue_depth=self.max_queue_depth,
+                    queue_full_waits=self.queue_full_waits,
+                    rows_written=self.rows_written,
+                    rows_dropped=self.rows_dropped,
+                    commits=self.commits,
+                    commit_time_last=self.commit_time_last,
+                    commit_time_max=self.commit_time_max,
+                    commit_time_avg=(self.commit_time_total / self.commits) if self.commits else 0)
+
+    def connect(self):
+        db = sqlite3.connect(self.database_location)
+        db.execute('PRAGMA journal_mode={};'.format(Config.DB_JOURNAL_MODE))
+        db.execute('PRAGMA synchronous={};'.format(self.synchronous))
+        return db
+
+    def run(self):
+        """ Collects rows until a commit is due, then writes them as one transaction. """
+        db = self.connect()
+        pending = OrderedDict()
+        pending_rows = 0
+        commit_deadline = None
+        running = True
+        try:
+            while running:
+                timeout = None
+                if pending_rows:
+                    timeout = max(commit_deadline - time.time(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout is not None else self.queue.get()
+                except Queue.Empty:
+                    item = False
+
+                if item is DatabaseWriter._STOP:
+                    running = False
+                elif item and callable(item[0]):
+                    self.commit(db, pending, pending_rows)
+                    pending.clear()
+                    pending_rows = 0
+                    self.run_call(db, *item)
+                elif item:
+                    statement, parameters = item
+                    pending.setdefault(statement, []).append(parameters)
+                    pending_rows += 1
+                    if pending_rows == 1:
+                        commit_deadline = time.time() + self.commit_interval
+
+                if pending_rows and (not running or pending_rows >= self.commit_rows or
+                                     time.time() >= commit_deadline):
+                    self.commit(db, pending, pending_rows)
+                    pending.clear()
+                    pending_rows = 0
+        except Exception as e:
+            self.error = e
+            server_log.error('Database writer stopped: {!r}'.format(e))
+            raise
+        finally:
+            db.close()
+
+    @staticmethod
+    def run_call(db, function, args):
+        """ Runs a queued call in its own transaction. """
+        try:
+            function(db, *args)
+            db.commit()
+        except Exception as e:
+            server_log.debug('Database call {} failed: {!r}'.format(function.__name__, e))
+            db.rollback()
+
+    def commit(self, db, pending, pending_rows):
+        """ Writes pending rows with executemany per statement and commits them together. If the
+            batch fails, e.g. on a value sqlite cannot store, its rows are written one by one so
+            only the failing rows are dropped.
+        """
+        if not pending_rows:
+            return
+        start = time.time()
+        try:
+            for statement, rows in pending.iteritems():
+                db.executemany(statement, rows)
+            db.commit()
+            written = pending_rows
+        except Exception as e:
+            server_log.debug('Database batch of {} rows failed, writing rows one by one: {!r}'.format(pending_rows,
+                                                                                                     e))
+            db.rollback()
+            written = self.write_rows(db, pending)
+        elapsed = time.time() - start
+        self.rows_written += written
+        self.commits += 1
+        self.commit_time_last = elapsed
+        self.commit_time_total += elapsed
+        if elapsed > self.commit_time_max:
+            self.commit_time_max = elapsed
+
+    def write_rows(self, db, pending):
+        """ Writes pending rows one at a time and commits those that succeed.
+
+            Return:
+                int: rows written.
+        """
+        written = 0
+        for statement, rows in pending.iteritems():
+            for parameters in rows:
+                try:
+                    db.execute(statement, parameters)
+                    written += 1
+                except Exception as e:
+                    self.rows_dropped += 1
+                    server_log.error('Database row dropped, {!r}: {} {!r}'.format(e, statement, parameters))
+        try:
+            db.commit()
+        except Exception as e:
+            server_log.error('Database write failed, {} rows lost: {!r}'.format(written, e))
+            db.rollback()
+            self.rows_dropped += written
+            written = 0
+        return written
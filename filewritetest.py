@@ -1,159 +1,201 @@
 from __future__ import division
 __author__ = 'Tristan Storz'
 import os
-import datetime
 import time
 import utilities
-import multiprocessing
-from loggers import test_log
+import calibration
+import ioengines
+import testregistry
+from testregistry import Parameter, Metric
+from histogram import LogHistogram
+from loggers import test_log, log_category
 from config import Config
+from workload import Workload
 """ File Write Test
 
 Test writes file_size files for timeout seconds. The test writes all
-information to message_queue. A timeout check is performed to guarantee
-that the test will write at least two files within the timeout time.
+information to message_channel. A timeout check is performed to guarantee
+that the test will write at least two files within the timeout time. It
+uses the device's write rate cached by calibration.py, so only the first
+test per device, filesystem and engine settings in a day probes it.
+
+Files are written through a write engine (see ioengines.py). The engine,
+block size, I/O size, preallocation and durability mode are reported in
+get_test_args so they are stored with the results. With the buffered
+mode each worker syncs the target's filesystem once when it stops, the
+time is sent as the final_sync_time result and counts in its
+write_speed.
+
+By default every rollover creates a file and removes it when it is
+written, so a file's duration includes creating, allocating and
+unlinking it and the journal commits they cause. With reuse_files each
+worker writes and syncs that many files before it starts and then
+overwrites them in rotation, so only the data path is measured. Runs with
+and without reuse_files, e.g. a sweep over both, compare the data path
+with the metadata path. Filling the files takes from the test's time.
+
+The write loop runs in workers processes at once, each with its own set
+of files, so the device sees workers outstanding writes. With targets,
+every target directory gets workers writers and an engine with the block
+size of its own filesystem, so all data disks of a host are tested in
+one run. Every rollover message carries the worker index, bytes written
+and the monotonic start and end of the file, so the server can report
+per-worker and aggregate throughput over the client's own intervals and
+spot slow files.
+
+Every write call is timed into a LogHistogram per worker. Each worker
+sends the histogram of writes since its last snapshot at rollovers at
+most every Config.TEST_LATENCY_TIME seconds and once more when the test
+ends, so the server can merge them into run percentiles. Each worker
+reports its write_speed when it stops.
+
+FileWriteTest is registered in testregistry as Config.TEST_FILE_WRITE_NAME.
 
 To run test, call the run method.
 
 Example:
     test = FileWriteTest(10, 10)
     test.run()
-    while not test.message_queue.empty():
-        print test.message_queue.get()
+    print test.message_channel.read_available()
 """
 
 
-class FileWriteTest(object):
+@testregistry.register
+class FileWriteTest(Workload):
     """ Initializes test.
 
         Args:
             timeout (int): test timeout time in seconds.
             file_size (int): size of files to write in MB.
+            engine (optional[str]): write engine name from ioengines.ENGINES.
+            block_size (optional[int]): bytes per block, defaults to the filesystem block size.
+            io_size (optional[int]): bytes per write call, defaults to block_size.
+            preallocate (optional[bool]): posix_fallocate each file before writing it.
+            workers (optional[int]): number of concurrent writer processes per target.
+            stats_interval (optional[float]): seconds between stats samples.
+            targets (optional[str]): comma separated directories to write to at once,
+                Config.TEST_LOG_DIR if None.
+            durability (optional[str]): when data is synced, one of ioengines.DURABILITY_MODES.
+            sync_mb (optional[int]): MB between syncs of the fdatasync and writeback modes.
+            reuse_files (optional[int]): files per worker overwritten in rotation, 0 creates and
+                removes a file per rollover.
     """
-
-    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, file_size=Config.TEST_DEFAULT_FILE_SIZE_MB):
-        self.test_timeout_sec = timeout
+    name = Config.TEST_FILE_WRITE_NAME
+    parameters = [Parameter('timeout', float, Config.TEST_DEFAULT_TIMEOUT_SEC, 'runtime in seconds'),
+                  Parameter('file_size', int, Config.TEST_DEFAULT_FILE_SIZE_MB, 'size of test files in MB'),
+                  Parameter('engine', str, Config.TEST_DEFAULT_ENGINE, 'write engine: sync, direct or writev'),
+                  Parameter('block_size', int, None, 'block size in bytes, defaults to the filesystem block size'),
+                  Parameter('io_size', int, None, 'bytes per write call, defaults to the block size'),
+                  Parameter('preallocate', bool, False, 'preallocate test files with posix_fallocate'),
+                  Parameter('workers', int, 1, 'concurrent writer processes per target'),
+                  Parameter('stats_interval', float, Config.TEST_STATS_TIME, 'seconds between stats samples'),
+                  Parameter('targets', str, None, 'comma separated directories to write to, one device each'),
+                  Parameter('durability', str, Config.TEST_DEFAULT_DURABILITY,
+                            'when data is synced: ' + ', '.join(ioengines.DURABILITY_MODES)),
+                  Parameter('sync_mb', int, Config.TEST_DEFAULT_SYNC_MB,
+                            'MB between syncs of the fdatasync and writeback modes'),
+                  Parameter('reuse_files', int, 0, 'files per worker overwritten in rotation, 0 creates new files')]
+    metrics = [Metric('write_speed', 'MB/s', 'sum', 'write throughput of all workers'),
+               Metric('calibration_time', 's', 'max', 'time spent checking the timeout before the test'),
+               Metric('final_sync_time', 's', 'max', 'time to sync buffered writes when a worker stops')]
+
+    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, file_size=Config.TEST_DEFAULT_FILE_SIZE_MB,
+                 engine=Config.TEST_DEFAULT_ENGINE, block_size=None, io_size=None, preallocate=False, workers=1,
+                 stats_interval=Config.TEST_STATS_TIME, targets=None, durability=Config.TEST_DEFAULT_DURABILITY,
+                 sync_mb=Config.TEST_DEFAULT_SYNC_MB, reuse_files=0):
+        Workload.__init__(self, timeout, workers, stats_interval, targets)
         self.file_size_mb = file_size
-        self.message_queue = multiprocessing.Queue()
-        self.end_of_test = multiprocessing.Event()
-        self.block_size = os.statvfs('/').f_bsize
-        self.processes = []
+        self.target_paths = targets
+        self.reuse_files = max(int(reuse_files or 0), 0)
+        self.engines = []
+        for target in self.targets:
+            target.block_size = block_size or target.block_size
+            self.engines.append(ioengines.get_engine(engine, target.block_size, io_size, preallocate, durability,
+                                                     sync_mb))
+        self.engine = self.engines[0]
+        self.block_size = self.engine.block_size
         self.timeout_check()
 
-    @staticmethod
-    def get_test_name():
-        return Config.TEST_FILE_WRITE_NAME
-
-    def get_test_args(self):
-        return str(dict([('timeout', self.test_timeout_sec), ('file_size', self.file_size_mb)]))
+    def get_args(self):
+        args = Workload.get_args(self) + [('file_size', self.file_size_mb)] + self.engine.get_args()
+        if self.target_paths:
+            args.append(('targets', ','.join(target.path for target in self.targets)))
+        return args + [('reuse_files', self.reuse_files)]
 
     def timeout_check(self):
-        """ Writes one block out to file and times it. Checks time against test_timeout_sec.
-            If timeout is too short for file_size, sets test_timeout_sec to calculated time.
+        """ Checks test_timeout_sec against the engine's write rate on every target's device (see
+            calibration.py). If timeout is too short for file_size on the slowest target, sets
+            test_timeout_sec to calculated time. A target's workers share its device, so the time
+            needed grows with the number of workers. The time the check took is sent as the
+            calibration_time result.
         """
         test_log.debug('Checking timeout')
-        utilities.verify_dir_exists(Config.TEST_LOG_DIR)
-        file_name = Config.TEST_LOG_DIR + str(os.getpid())
-        buf = b'\x50' * self.block_size
-        num_of_blocks = Config.TEST_TIMEOUT_NUM_OF_BLOCKS
-
-        file_descriptor = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_DSYNC | os.O_CREAT)
-        try:
-            start = datetime.datetime.now()
-            for _ in xrange(num_of_blocks):
-                os.write(file_descriptor, buf)
-            total_time = (datetime.datetime.now() - start)
-        except Exception as e:
-            test_log.debug('failed to write temp file {}'.format(file_name))
-            raise e
-        finally:
-            os.close(file_descriptor)
-            os.remove(file_name)
-
-        total_time = total_time.seconds + (total_time.microseconds / Config.MICRO_SECONDS_PER_SECOND)
-        min_time = ((self.file_size_mb * Config.BYTES_PER_MEGABYTE) /
-                    (num_of_blocks * self.block_size)) * total_time * Config.TEST_MIN_FILE_WRITES
+        min_time = 0
+        elapsed = 0
+        for target, engine in zip(self.targets, self.engines):
+            try:
+                result = calibration.calibrate(engine, target.path)
+            except (IOError, OSError) as e:
+                test_log.debug('failed to calibrate write rate of {}: {}'.format(target.path, e))
+                raise e
+            test_log.debug('Write rate of {} {:.2f} MB/s ({}, {:.3f}s)'.format(
+                target.path, result.rate / Config.BYTES_PER_MEGABYTE, 'cached' if result.cached else 'probed',
+                result.elapsed))
+            elapsed += result.elapsed
+            min_time = max(min_time, (self.file_size_mb * Config.BYTES_PER_MEGABYTE) / result.rate *
+                           Config.TEST_MIN_FILE_WRITES * self.workers)
+        self.send_result(0, 'calibration_time', elapsed)
         if min_time > self.test_timeout_sec:
             self.test_timeout_sec = min_time
-            self.message_queue.put(Config.API_BAD_TIMEOUT + Config.API_DELIMITER)
+            self.message_channel.put(Config.API_BAD_TIMEOUT, self.test_timeout_sec)
             test_log.debug('Timeout too low for file size. Timeout set to {}'.format(self.test_timeout_sec))
 
-    def run(self):
-        """ Spawns three processes and then waits for test time to end.
-            Upon ending, sets the end_of_test Event to signal that the
-            three processes should end.
-        """
-        test_log.debug('Creating processes')
-        test = multiprocessing.Process(target=self.file_write_test)
-        test.start()
-        test_pid = test.pid
-        multiprocessing.Process(target=self.send_heartbeat).start()
-        multiprocessing.Process(target=self.gather_stats, args=(test_pid,)).start()
-
-        test_log.debug('Beginning test loop')
-        end_time = time.time() + self.test_timeout_sec
-        while time.time() < end_time:
-            time.sleep(Config.TEST_TIMEOUT_CHECK)
-        test_log.debug('Test ended')
-        self.end_of_test.set()
-
-    def send_heartbeat(self):
-        """ Continues writing out message event until end_of_test is set """
-        while not self.end_of_test.is_set():
-            time.sleep(Config.TEST_HEARTBEAT_TIME)
-            self.message_queue.put(Config.API_HEARTBEAT + Config.TERMINATOR)
-            test_log.debug('Heartbeat')
-
-    def gather_stats(self, test_pid):
-        """ Continues writing out cpu/mem info for input pid until end_of-test is set
-            Args:
-                test_pid (int): pid of process to monitor.
-        """
-        cpu, cpu_total_new, cpu_pid_new = 0, 0, 0
-        while not self.end_of_test.is_set():
-            time.sleep(Config.TEST_STATS_TIME)
-            try:
-                cpu_pid_old = cpu_pid_new
-                cpu_total_old = cpu_total_new
-                cpu_pid_new = utilities.get_cpu_clock_cycles_of_pid(test_pid)
-                cpu_total_new = utilities.get_total_cpu_clock_cycles()
-                mem_total = utilities.get_total_memory()
-                mem_new = utilities.get_memory_of_pid(test_pid)
-                if mem_total and mem_new:
-                    mem = mem_new / mem_total
-                if cpu_total_new and cpu_pid_new:
-                    cpu = (cpu_pid_new - cpu_pid_old) / (cpu_total_new - cpu_total_old)
-            except IOError:
-                if not self.end_of_test.is_set():
-                    test_log('file write test process data could not be gathered from Linux proc files')
-                return
-            self.message_queue.put(Config.API_TEST_STATS + Config.API_DELIMITER + 'CPU' + Config.API_DELIMITER +
-                                   str(cpu) + Config.API_DELIMITER + 'MEM' + Config.API_DELIMITER + str(mem)
-                                   + Config.TERMINATOR)
-            test_log.debug('Stats: CPU {:3.5f}%% MEM {:3.5f}%%'.format(cpu, mem))
-
-    def file_write_test(self):
+    def run_worker(self, worker=0):
         """ Write file of given file_size. When finished, write out a new file
-            with the same size. Continues until end_of_test is set. Writes out
-            every time file rollover occurs.
+            with the same size, or overwrite the next of the reused files.
+            Continues until stop is set. Writes out every time file rollover occurs.
+            Args:
+                worker (int): index of this writer, used in its file names and messages.
         """
-        utilities.verify_dir_exists(Config.TEST_LOG_DIR)
-
         file_number = 0
-        buf = b'\xab' * self.block_size
-        num_of_blocks = int((self.file_size_mb * Config.BYTES_PER_MEGABYTE) / self.block_size)
-        while not self.end_of_test.is_set():
-            test_file = Config.TEST_LOG_DIR + str(os.getpid()) + str(file_number)
-            file_number += 1
-            file_descriptor = os.open(test_file,  os.O_WRONLY | os.O_APPEND | os.O_DSYNC | os.O_CREAT)
-            try:
-                for _ in xrange(num_of_blocks):
-                    os.write(file_descriptor, buf)
-            except Exception as e:
-                test_log.debug('failed to write temp file {}'.format(test_file))
-                raise e
-            finally:
-                os.close(file_descriptor)
+        file_bytes = self.file_size_mb * Config.BYTES_PER_MEGABYTE
+        target = self.target_of(worker)
+        engine = self.engines[target.index]
+        reused = []
+        try:
+            for number in xrange(self.reuse_files):
+                reused.append(self.create_test_file(worker, file_bytes, 'reuse{}'.format(number)))
+            total_bytes = 0
+            latency = LogHistogram()
+            start = time.time()
+            while not self.stop.is_set():
+                if reused:
+                    test_file = reused[file_number % len(reused)]
+                else:
+                    test_file = self.test_file_name(worker, file_number)
+                file_number += 1
+                bytes_written = 0
+                file_start = utilities.monotonic_ns()
+                file_descriptor = engine.open(test_file, file_bytes, overwrite=bool(reused))
+                try:
+                    bytes_written = engine.write_file(file_descriptor, file_bytes, latency)
+                except Exception as e:
+                    test_log.debug('failed to write temp file {}'.format(test_file))
+                    raise e
+                finally:
+                    os.close(file_descriptor)
+                    if not reused:
+                        os.remove(test_file)
+                    self.send_rollover(worker, bytes_written, file_start)
+                    test_log.debug('file roll over', extra=log_category(Config.API_TEST_FILE_WRITE))
+                total_bytes += bytes_written
+                self.report_latency(worker, latency)
+            self.report_latency(worker, latency, final=True)
+            if engine.durability == ioengines.DURABILITY_BUFFERED:
+                self.send_result(worker, 'final_sync_time', engine.final_sync(target.path))
+        finally:
+            for test_file in reused:
                 os.remove(test_file)
-                self.message_queue.put(Config.API_TEST_FILE_WRITE + Config.TERMINATOR)
-                test_log.debug('file roll over')
+        elapsed = time.time() - start
+        if elapsed:
+            self.send_result(worker, 'write_speed', total_bytes / Config.BYTES_PER_MEGABYTE / elapsed)
@@ -0,0 +1,163 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+""" Fixed memory log-bucketed histogram for latencies.
+
+Values are non-negative integers (FileWriteTest records microseconds).
+Values below 2 * SUB_BUCKETS get a bucket each. Above that every power
+of two is split into SUB_BUCKETS linear buckets, so a recorded value is
+off by at most 1 / SUB_BUCKETS (about 3%) no matter how large it is.
+The bucket array never grows. Values above MAX_VALUE land in the last
+bucket, the exact maximum is tracked on its own.
+
+Histograms are merged by adding bucket counts, so snapshots from many
+writers and many runs combine without losing precision. encode() returns
+a compact sparse text form (index:count,...) for the wire and the db,
+encode_parts() splits it for channels with a message size limit.
+
+Example:
+    histogram = LogHistogram()
+    for latency in (120, 95, 4000, 130):
+        histogram.record(latency)
+    print histogram.percentile(99), histogram.max
+    merged = LogHistogram.decode(histogram.encode())
+"""
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_SHIFT = 40
+NUM_BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+MAX_VALUE = ((2 * SUB_BUCKETS) << MAX_SHIFT) - 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value):
+    """ Returns the bucket for value. """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    if value > MAX_VALUE:
+        value = MAX_VALUE
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index):
+    """ Returns the midpoint of the values counted in bucket index. """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    low = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return low + ((1 << shift) - 1) // 2
+
+
+class LogHistogram(object):
+    """ Constant memory histogram with mergeable bucket counts. """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        """ Adds one value. Negative values are counted as 0. """
+        value = int(value)
+        if value < 0:
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Adds the counts of other into this histogram. """
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def reset(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, percent):
+        """ Returns the value at percent (0-100), 0 for an empty histogram. """
+        if not self.count:
+            return 0
+        rank = max(int(round(self.count * percent / 100)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def percentiles(self, percents=PERCENTILES):
+        """ Returns dict of percent to value for percents in one pass. """
+        result = {}
+        if not self.count:
+            return dict((percent, 0) for percent in percents)
+        ranks = sorted((max(int(round(self.count * percent / 100)), 1), percent) for percent in percents)
+        seen = 0
+        position = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while position < len(ranks) and seen >= ranks[position][0]:
+                result[ranks[position][1]] = min(bucket_value(index), self.max)
+                position += 1
+            if position == len(ranks):
+                break
+        return result
+
+    def encode(self):
+        """ Returns the sparse text form: max;total;index:count,index:count,... """
+        buckets = ','.join('{}:{}'.format(index, count) for index, count in enumerate(self.counts) if count)
+        return '{};{};{}'.format(self.max, self.total, buckets)
+
+    def encode_parts(self, max_length):
+        """ Returns encode() output split into strings of at most max_length characters.
+            Each part is a histogram of its own and merging the parts gives this one back.
+        """
+        parts = []
+        head = '{};{};'.format(self.max, self.total)
+        buckets = []
+        length = len(head)
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            bucket = '{}:{}'.format(index, count)
+            if buckets and length + len(bucket) + 1 > max_length:
+                parts.append(head + ','.join(buckets))
+                head = '0;0;'
+                buckets = []
+                length = len(head)
+            buckets.append(bucket)
+            length += len(bucket) + 1
+        parts.append(head + ','.join(buckets))
+        return parts
+
+    @classmethod
+    def decode(cls, encoded):
+        """ Returns a histogram built from encode() output. """
+        histogram = cls()
+        maximum, total, buckets = encoded.split(';')
+        histogram.max = int(maximum)
+        histogram.total = int(total)
+        if buckets:
+            for bucket in buckets.split(','):
+                index, count = bucket.split(':')
+                count = int(count)
+                histogram.counts[int(index)] += count
+                histogram.count += count
+        return histogram
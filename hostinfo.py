@@ -0,0 +1,198 @@
+__author__ = 'Tristan Storz'
+import hashlib
+import json
+import os
+import platform
+import utilities
+from config import Config
+from procsampler import block_device_of_path, SYS_DEV_BLOCK_LOCATION
+""" Host fingerprint sent by TestClient and deduplicated by TestServer.
+
+get_host_info() builds a small dict describing the machine a test runs
+on. The data comes from /proc/cpuinfo, /proc/meminfo, /proc/mounts, and
+/sys/dev/block for the device holding Config.TEST_LOG_DIR. Values that
+change while a machine runs (cpu MHz, free memory) are left out, so the
+fingerprint only changes with the hardware, kernel or device.
+host_hash() is the sha1 of the info's canonical JSON.
+
+The client caches the info in Config.HOST_INFO_CACHE together with the
+boot id, so it is gathered once per boot instead of on every connect.
+
+On the server, Hosts maps hashes to host ids. A client sends its hash
+(host::hash) and the server answers known or unknown. Only an unknown
+host sends the full info, and tests rows reference hosts by host_id.
+Hosts also keeps the decoded info of every host for the scheduler's
+constraints (see scheduler.py).
+
+Example:
+    info, digest = load_host_info()
+    print digest, info['cpu_model'], info['device']['model']
+"""
+
+LINUX_CPU_INFO_LOCATION = '/proc/cpuinfo'
+LINUX_MOUNTS_LOCATION = '/proc/mounts'
+LINUX_BOOT_ID_LOCATION = '/proc/sys/kernel/random/boot_id'
+SECTOR_BYTES = 512
+
+HOST_KNOWN = 'known'
+HOST_UNKNOWN = 'unknown'
+
+
+def read_file(location, default=None):
+    try:
+        with open(location, 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return default
+
+
+def get_cpu_info():
+    """ Returns (model, logical cpus) from /proc/cpuinfo. """
+    model, count = None, 0
+    for line in (read_file(LINUX_CPU_INFO_LOCATION) or '').splitlines():
+        key, _, value = line.partition(':')
+        key = key.strip()
+        if key == 'processor':
+            count += 1
+        elif key == 'model name' and model is None:
+            model = value.strip()
+    return model, count
+
+
+def get_filesystem(path):
+    """ Returns the filesystem type of the mount holding path from /proc/mounts. """
+    path = os.path.realpath(path)
+    best, filesystem = '', None
+    for line in (read_file(LINUX_MOUNTS_LOCATION) or '').splitlines():
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1]
+        inside = path == mount_point or path.startswith(mount_point.rstrip('/') + '/')
+        if inside and len(mount_point) >= len(best):
+            best, filesystem = mount_point, fields[2]
+    return filesystem
+
+
+def get_device_info(path):
+    """ Returns name, model, size, rotational, scheduler and logical block size of the
+        block device backing path, only the filesystem if there is none. Partitions report
+        their own name and size and the queue settings of their disk.
+    """
+    major, minor = block_device_of_path(path) or (None, None)
+    device = dict(major=major, minor=minor, filesystem=get_filesystem(path))
+    if major is None:
+        return device
+    location = os.path.realpath(SYS_DEV_BLOCK_LOCATION.format(major, minor))
+    if not os.path.isdir(location):
+        return device
+    disk = location
+    if os.path.exists(os.path.join(location, 'partition')):
+        disk = os.path.dirname(location)
+    size = read_file(os.path.join(location, 'size'))
+    scheduler = read_file(os.path.join(disk, 'queue', 'scheduler')) or ''
+    if '[' in scheduler:
+        scheduler = scheduler[scheduler.index('[') + 1:scheduler.index(']')]
+    rotational = read_file(os.path.join(disk, 'queue', 'rotational'))
+    block_size = read_file(os.path.join(disk, 'queue', 'logical_block_size'))
+    device.update(name=os.path.basename(location),
+                  model=read_file(os.path.join(disk, 'device', 'model')),
+                  size=int(size) * SECTOR_BYTES if size else None,
+                  rotational=rotational == '1' if rotational is not None else None,
+                  scheduler=scheduler or None,
+                  logical_block_size=int(block_size) if block_size else None)
+    return device
+
+
+def get_host_info():
+    """ Return:
+            dict: hostname, kernel, cpu, memory and test device of this machine.
+    """
+    utilities.verify_dir_exists(Config.TEST_LOG_DIR)
+    cpu_model, cpu_count = get_cpu_info()
+    return dict(hostname=platform.node(),
+                kernel=platform.release(),
+                machine=platform.machine(),
+                cpu_model=cpu_model,
+                cpu_count=cpu_count,
+                mem_total=utilities.get_total_memory(),
+                device=get_device_info(Config.TEST_LOG_DIR))
+
+
+def encode_host_info(info):
+    """ Returns the canonical JSON of info, the text that is hashed, sent and stored. """
+    return json.dumps(info, sort_keys=True)
+
+
+def host_hash(encoded):
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def load_host_info(cache_location=Config.HOST_INFO_CACHE):
+    """ Returns (encoded info, hash) from the cache if it was written since the last
+        boot, otherwise gathers the info and rewrites the cache. Each process writes a
+        temporary file of its own and renames it, so clients starting at once never
+        read or rename a partly written cache.
+    """
+    boot_id = read_file(LINUX_BOOT_ID_LOCATION)
+    try:
+        with open(cache_location, 'r') as f:
+            cached = json.load(f)
+        if boot_id and cached['boot_id'] == boot_id and host_hash(cached['info']) == cached['hash']:
+            return str(cached['info']), str(cached['hash'])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    encoded = encode_host_info(get_host_info())
+    digest = host_hash(encoded)
+    temporary = '{}.{}.tmp'.format(cache_location, os.getpid())
+    try:
+        utilities.verify_dir_exists(os.path.dirname(cache_location) or '.')
+        with open(temporary, 'w') as f:
+            json.dump(dict(boot_id=boot_id, hash=digest, info=encoded), f)
+        os.rename(temporary, cache_location)
+    except (IOError, OSError):
+        pass
+    return encoded, digest
+
+
+class Hosts(object):
+    """ Server side map of host hashes to host ids.
+
+        Args:
+            known (dict): hash mapped to host_id for hosts stored in the db.
+            infos (optional[dict]): host_id mapped to the encoded info of hosts stored in the db.
+    """
+    def __init__(self, known, infos=None):
+        self.known = dict(known)
+        self.last_host_id = max(self.known.values() or [0])
+        self.infos = {}
+        for host_id, encoded in (infos or {}).iteritems():
+            self.set_info(host_id, encoded)
+
+    def lookup(self, digest):
+        """ Returns the host_id of digest, None for unknown hosts. """
+        return self.known.get(digest)
+
+    def add(self, digest):
+        """ Return:
+                (int, bool): host_id of digest and True if the host was not known before.
+        """
+        host_id = self.known.get(digest)
+        if host_id is not None:
+            return host_id, False
+        self.last_host_id += 1
+        self.known[digest] = self.last_host_id
+        return self.last_host_id, True
+
+    def set_info(self, host_id, encoded):
+        """ Stores the info of host_id. Info of older clients is lscpu text, stored as empty. """
+        try:
+            info = json.loads(encoded)
+        except (TypeError, ValueError):
+            info = {}
+        self.infos[host_id] = info if isinstance(info, dict) else {}
+
+    def get_info(self, host_id):
+        """ Returns the decoded info of host_id, empty if unknown. """
+        return self.infos.get(host_id, {})
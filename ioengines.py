@@ -0,0 +1,244 @@
+__author__ = 'Tristan Storz'
+import os
+import mmap
+import time
+import utilities
+from config import Config
+""" Write engines for FileWriteTest.
+
+An engine decides how a test file is opened and how its bytes are
+handed to the kernel. Every engine writes io_size bytes per system call
+from a buffer made of block_size blocks, so block size (alignment and
+buffer unit) and I/O size (bytes per call) can be tuned separately.
+
+    sync    one os.write per io_size. With the default io_size and
+            durability this is the original test.
+    direct  O_DIRECT writes from a page aligned mmap buffer. io_size
+            must be a multiple of block_size.
+    writev  io_size / block_size blocks per writev call.
+
+The durability mode decides when written data is made durable, so the
+cost of a sync can be told apart from the cost of the writes:
+
+    dsync      every write is opened with O_DSYNC (the default).
+    fdatasync  fdatasync after every sync_mb MB and at the end of a file.
+    fsync      one fsync per file, after its last write.
+    buffered   no syncs while writing. The caller syncs once at the end
+               with final_sync().
+    writeback  sync_file_range starts writeback of every sync_mb MB and
+               waits for the MB before it. Data reaches the device but
+               neither metadata nor the device's cache are flushed.
+               Linux only.
+
+Any engine can preallocate each file with posix_fallocate before the
+first write, or overwrite an existing file from its start (open with
+overwrite), which leaves out the cost of creating and allocating files.
+write_file can record the latency of every write call in microseconds
+into a histogram.LogHistogram, syncs are not part of it.
+
+Example:
+    engine = get_engine('direct', block_size=4096, io_size=1024 * 1024, durability='fdatasync')
+    file_descriptor = engine.open('test_file', 10 * 1024 * 1024)
+    try:
+        engine.write_file(file_descriptor, 10 * 1024 * 1024)
+    finally:
+        os.close(file_descriptor)
+"""
+
+ENGINE_SYNC = 'sync'
+ENGINE_DIRECT = 'direct'
+ENGINE_WRITEV = 'writev'
+DURABILITY_DSYNC = 'dsync'
+DURABILITY_FDATASYNC = 'fdatasync'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_BUFFERED = 'buffered'
+DURABILITY_WRITEBACK = 'writeback'
+DURABILITY_MODES = (DURABILITY_DSYNC, DURABILITY_FDATASYNC, DURABILITY_FSYNC, DURABILITY_BUFFERED,
+                    DURABILITY_WRITEBACK)
+WRITEBACK_WAIT = (utilities.SYNC_FILE_RANGE_WAIT_BEFORE | utilities.SYNC_FILE_RANGE_WRITE |
+                  utilities.SYNC_FILE_RANGE_WAIT_AFTER)
+FILL_BYTE = Config.TEST_FILL_BYTE
+
+
+class SyncEngine(object):
+    """ Writes through the page cache, made durable as durability says.
+
+        Args:
+            block_size (int): bytes per block, the unit buffers are built from.
+            io_size (optional[int]): bytes per write call, defaults to block_size.
+            preallocate (optional[bool]): posix_fallocate each file before writing.
+            durability (optional[str]): one of DURABILITY_MODES.
+            sync_mb (optional[int]): MB written between syncs of the fdatasync and writeback modes.
+    """
+    name = ENGINE_SYNC
+    open_flags = os.O_WRONLY
+
+    def __init__(self, block_size, io_size=None, preallocate=False, durability=Config.TEST_DEFAULT_DURABILITY,
+                 sync_mb=Config.TEST_DEFAULT_SYNC_MB):
+        self.block_size = block_size
+        self.io_size = io_size or block_size
+        self.preallocate = preallocate
+        if self.io_size % self.block_size:
+            raise ValueError('io_size {} is not a multiple of block_size {}'.format(self.io_size, self.block_size))
+        if durability not in DURABILITY_MODES:
+            raise ValueError('unknown durability {}, expected one of {}'.format(durability,
+                                                                               ', '.join(DURABILITY_MODES)))
+        self.durability = durability
+        self.sync_mb = max(int(sync_mb or Config.TEST_DEFAULT_SYNC_MB), 1)
+        self.sync_writes = None
+        if durability in (DURABILITY_FDATASYNC, DURABILITY_WRITEBACK):
+            self.sync_writes = max(self.sync_mb * Config.BYTES_PER_MEGABYTE // self.io_size, 1)
+        self.buffer = self.make_buffer()
+
+    def make_buffer(self):
+        return FILL_BYTE * self.io_size
+
+    def get_args(self):
+        """ Return:
+                list[tuple]: engine parameters reported with test args.
+        """
+        args = [('engine', self.name), ('block_size', self.block_size),
+                ('io_size', self.io_size), ('preallocate', self.preallocate), ('durability', self.durability)]
+        if self.sync_writes is not None:
+            args.append(('sync_mb', self.sync_mb))
+        return args
+
+    def open(self, file_name, file_bytes, overwrite=False):
+        """ Opens a new test file, preallocating file_bytes if requested. With overwrite an
+            existing file is opened to be written from its start, it is neither created nor
+            preallocated.
+
+            Return:
+                int: file descriptor.
+        """
+        flags = self.open_flags
+        if self.durability == DURABILITY_DSYNC:
+            flags |= os.O_DSYNC
+        if overwrite:
+            return os.open(file_name, flags)
+        flags |= os.O_CREAT
+        if not self.preallocate:
+            flags |= os.O_APPEND
+        file_descriptor = os.open(file_name, flags)
+        if self.preallocate:
+            try:
+                utilities.posix_fallocate(file_descriptor, 0, file_bytes)
+            except OSError:
+                os.close(file_descriptor)
+                raise
+        return file_descriptor
+
+    def write_file(self, file_descriptor, file_bytes, latency=None):
+        """ Writes file_bytes rounded down to whole io_size writes at the file's position and
+            syncs them as the durability mode says.
+
+            Args:
+                file_descriptor (int): file opened with open().
+                file_bytes (int): bytes to write.
+                latency (optional[LogHistogram]): records microseconds per write call.
+
+            Return:
+                int: bytes written.
+        """
+        writes = file_bytes // self.io_size
+        if self.sync_writes is None:
+            self.write_blocks(file_descriptor, writes, latency)
+        else:
+            offset = os.lseek(file_descriptor, 0, os.SEEK_CUR)
+            chunk_bytes = self.sync_writes * self.io_size
+            done = 0
+            while done < writes:
+                chunk = min(self.sync_writes, writes - done)
+                self.write_blocks(file_descriptor, chunk, latency)
+                if self.durability == DURABILITY_FDATASYNC:
+                    os.fdatasync(file_descriptor)
+                else:
+                    chunk_offset = offset + done * self.io_size
+                    utilities.sync_file_range(file_descriptor, chunk_offset, chunk * self.io_size,
+                                              utilities.SYNC_FILE_RANGE_WRITE)
+                    if done:
+                        utilities.sync_file_range(file_descriptor, chunk_offset - chunk_bytes, chunk_bytes,
+                                                  WRITEBACK_WAIT)
+                done += chunk
+            if self.durability == DURABILITY_WRITEBACK and writes:
+                utilities.sync_file_range(file_descriptor, offset, writes * self.io_size, WRITEBACK_WAIT)
+        if self.durability == DURABILITY_FSYNC:
+            os.fsync(file_descriptor)
+        return writes * self.io_size
+
+    def write_blocks(self, file_descriptor, writes, latency=None):
+        """ Makes writes write calls of io_size bytes. """
+        if latency is None:
+            for _ in xrange(writes):
+                self.write(file_descriptor)
+        else:
+            clock = time.time
+            write = self.write
+            record = latency.record
+            for _ in xrange(writes):
+                start = clock()
+                write(file_descriptor)
+                record((clock() - start) * Config.MICRO_SECONDS_PER_SECOND)
+
+    def final_sync(self, directory):
+        """ Writes out the data left in the page cache by the buffered mode for the filesystem
+            holding directory, nothing for the other modes.
+
+            Return:
+                float: seconds the sync took.
+        """
+        if self.durability != DURABILITY_BUFFERED:
+            return 0.0
+        start = time.time()
+        file_descriptor = os.open(directory, os.O_RDONLY)
+        try:
+            utilities.syncfs(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+        return time.time() - start
+
+    def write(self, file_descriptor):
+        os.write(file_descriptor, self.buffer)
+
+
+class DirectEngine(SyncEngine):
+    """ O_DIRECT writes from a page aligned buffer. The filesystem must support O_DIRECT. """
+    name = ENGINE_DIRECT
+    open_flags = os.O_WRONLY | getattr(os, 'O_DIRECT', 0)
+
+    def make_buffer(self):
+        buf = mmap.mmap(-1, self.io_size)
+        buf.write(FILL_BYTE * self.io_size)
+        return buf
+
+
+class WritevEngine(SyncEngine):
+    """ Writes of io_size / block_size blocks per writev call. """
+    name = ENGINE_WRITEV
+
+    def make_buffer(self):
+        self.blocks = [FILL_BYTE * self.block_size] * (self.io_size // self.block_size)
+        self.iovecs = utilities.make_iovecs(self.blocks)
+        return self.blocks
+
+    def write(self, file_descriptor):
+        written = utilities.writev(file_descriptor, self.blocks, self.iovecs)
+        if written < self.io_size:
+            os.write(file_descriptor, ''.join(self.blocks)[written:])
+
+
+ENGINES = {ENGINE_SYNC: SyncEngine,
+           ENGINE_DIRECT: DirectEngine,
+           ENGINE_WRITEV: WritevEngine}
+
+
+def get_engine(name, block_size, io_size=None, preallocate=False, durability=Config.TEST_DEFAULT_DURABILITY,
+               sync_mb=Config.TEST_DEFAULT_SYNC_MB):
+    """ Returns an engine instance for name. Raises ValueError for unknown engines and durability
+        modes.
+    """
+    try:
+        engine = ENGINES[name]
+    except KeyError:
+        raise ValueError('unknown write engine {}, expected one of {}'.format(name, ', '.join(sorted(ENGINES))))
+    return engine(block_size, io_size, preallocate, durability, sync_mb)
@@ -0,0 +1,211 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import asyncore
+import heapq
+import multiprocessing
+import os
+import time
+import hostinfo
+import protocol
+import testregistry
+from testclient import TestClient
+from messagechannel import MessageChannel
+from config import Config
+import loggers
+from loggers import test_log
+""" Launches many TestClients from a pool of preforked worker processes.
+
+Starting every client as its own 'python testclient.py' pays for a shell,
+an interpreter and all imports per client. Launcher imports the client,
+the registered tests and the host info once, then forks a pool of
+workers. Each worker runs one asyncore loop that any number of
+TestClients share, clients spend their time waiting on the server and
+their test's message channel, so one worker keeps up with many of them.
+Tests still run in their own process forked from the warm worker, but
+they are created in the worker's loop: whatever a test does in __init__,
+e.g. FileWriteTest's timeout check probing an uncached device (see
+calibration.py), stalls the worker's other clients meanwhile. A client
+whose test name or arguments are bad is logged and skipped.
+
+Clients are put on a schedule before run(): launch() adds one client at
+a delay, ramp() adds clients at a rate per second. run() sends every
+client to the next worker round robin over the worker's MessageChannel
+when its time comes, then tells the workers to stop and waits until all
+of their clients have ended.
+
+Example:
+    launcher = Launcher(Config.HOST, Config.PORT, workers=4)
+    launcher.launch(1, Config.TEST_FILE_WRITE_NAME, timeout=9, file_size=2)
+    launcher.ramp(200, rate=50, delay=2)
+    launcher.run()
+"""
+
+LAUNCH_CLIENT = 'launch client'
+LAUNCH_STOP = 'launch stop'
+
+
+class LaunchDispatcher(asyncore.file_dispatcher):
+    """ Worker side of a MessageChannel. Starts a TestClient for every launch message
+        in the worker's loop and leaves the loop on stop.
+
+        Args:
+            host (str): test server address.
+            port (int): test server port.
+            channel (MessageChannel): launch messages from Launcher.
+    """
+    def __init__(self, host, port, channel):
+        asyncore.file_dispatcher.__init__(self, channel.fileno())
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.frame_reader = protocol.FrameReader()
+        self.clients = 0
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        for header, fields in self.frame_reader.feed(self.recv(Config.CHANNEL_READ_SIZE)):
+            if header == LAUNCH_CLIENT:
+                self.start_client(*fields)
+            elif header == LAUNCH_STOP:
+                self.handle_close()
+                return
+
+    def start_client(self, test_name='', args_string=''):
+        """ Connects a TestClient, with test_name or requesting a test from the server. A client
+            that cannot be started is logged and skipped, the worker keeps serving the others.
+        """
+        try:
+            run_test = None
+            if test_name:
+                args, kwargs = testregistry.parse_args_string(args_string)
+                run_test = testregistry.create(test_name, args, kwargs)
+            client = TestClient(self.host, self.port, run_test)
+            client.open_connection()
+        except (ValueError, EnvironmentError) as e:
+            test_log.debug('Launcher worker {} could not start client {} {}: {}'.format(os.getpid(), test_name,
+                                                                                        args_string, e))
+            return
+        self.clients += 1
+
+    def handle_close(self):
+        """ On stop or when the launcher is gone. Clients already started run to their end. """
+        test_log.debug('Launcher worker {} stopping after {} clients'.format(os.getpid(), self.clients))
+        self.close()
+        os.close(self.channel.read_fd)
+
+
+def run_worker(host, port, channels, index):
+    """ Worker process. Keeps its own channel's read end, runs the loop until every
+        client has ended and stop was received.
+    """
+    for other, channel in enumerate(channels):
+        if other != index:
+            channel.close()
+    os.close(channels[index].write_fd)
+    loggers.restart_async_handlers()
+    try:
+        LaunchDispatcher(host, port, channels[index])
+        asyncore.loop(timeout=Config.LOOP_TIMEOUT)
+    finally:
+        loggers.close_async_handlers()
+
+
+class Launcher(object):
+    """ Schedule of clients and the worker pool that starts them.
+
+        Args:
+            host (optional[str]): test server address.
+            port (optional[int]): test server port.
+            workers (optional[int]): worker processes, one per cpu if None.
+    """
+    def __init__(self, host=Config.HOST, port=Config.PORT, workers=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.schedule = []
+
+    def launch(self, delay, test_name=None, **kwargs):
+        """ Starts one client delay seconds after run() is called. Without test_name the client
+            requests a test from the server, kwargs are the test's parameters.
+        """
+        args_string = testregistry.TestRequest(test_name, **kwargs).get_args_string() if test_name else ''
+        heapq.heappush(self.schedule, (delay, len(self.schedule), test_name or '', args_string))
+
+    def ramp(self, clients, rate, delay=0, test_name=None, **kwargs):
+        """ Starts clients at rate clients per second, the first one delay seconds after run(). """
+        for number in xrange(clients):
+            self.launch(delay + number / rate, test_name, **kwargs)
+
+    def run(self):
+        """ Forks the workers, hands out the scheduled clients and waits for the workers to end. """
+        testregistry.get_tests()
+        hostinfo.load_host_info()
+        channels = [MessageChannel() for _ in xrange(self.workers)]
+        processes = [multiprocessing.Process(target=run_worker, args=(self.host, self.port, channels, index))
+                     for index in xrange(self.workers)]
+        for process in processes:
+            process.start()
+        for channel in channels:
+            os.close(channel.read_fd)
+        test_log.debug('Launcher started {} workers for {} clients'.format(self.workers, len(self.schedule)))
+
+        start = time.time()
+        launched = 0
+        try:
+            while self.schedule:
+                delay, _, test_name, args_string = heapq.heappop(self.schedule)
+                wait = start + delay - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                channels[launched % self.workers].put(LAUNCH_CLIENT, test_name, args_string)
+                launched += 1
+        finally:
+            for channel in channels:
+                try:
+                    channel.put(LAUNCH_STOP)
+                except OSError:
+                    pass
+                os.close(channel.write_fd)
+            for process in processes:
+                process.join()
+        return launched
+
+    def start(self):
+        """ Runs the launcher in a background process, e.g. next to a TestServer in the foreground.
+
+            Return:
+                multiprocessing.Process: the launcher process.
+        """
+        process = multiprocessing.Process(target=self.run)
+        process.start()
+        return process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--clients', dest='clients', default=10, type=int,
+                        help='clients to start')
+    parser.add_argument('-r', '--rate', dest='rate', default=50, type=float,
+                        help='clients started per second')
+    parser.add_argument('-d', '--delay', dest='delay', default=0, type=float,
+                        help='seconds before the first client starts')
+    parser.add_argument('-w', '--workers', dest='workers', default=None, type=int,
+                        help='worker processes, defaults to one per cpu')
+    parser.add_argument('-T', '--test', dest='test', default=None,
+                        help='test to run, clients request one from the server if not set')
+    parser.add_argument('-o', '--option', dest='options', default=[], action='append',
+                        help='test parameter as name=value, may be repeated')
+    parser.add_argument('--host', dest='host', default=Config.HOST, help='test server address')
+    parser.add_argument('--port', dest='port', default=Config.PORT, type=int, help='test server port')
+    cmd_input = parser.parse_args()
+
+    test_kwargs = dict(option.split('=', 1) for option in cmd_input.options)
+    launcher = Launcher(cmd_input.host, cmd_input.port, cmd_input.workers)
+    launcher.ramp(cmd_input.clients, cmd_input.rate, cmd_input.delay, cmd_input.test, **test_kwargs)
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        test_log.debug('Ended via keyboard interrupt')
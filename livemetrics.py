@@ -0,0 +1,254 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import asyncore
+import json
+import socket
+import time
+from config import Config
+from loggers import server_log
+""" Live metrics of a running TestServer, streamed as Server-Sent Events.
+
+LiveMetrics keeps the latest state of every connected client in memory.
+ClientAPI updates it as stats and rollovers arrive, which only touches a
+dict, so watching a run adds no load on the db. LiveMetricsServer is an
+asyncore dispatcher that listens on Config.LIVE_PORT and runs in the same
+loop as TestServer:
+
+    GET /events    text/event-stream. A 'snapshot' event with every client
+                   on connect, then every Config.LIVE_INTERVAL seconds a
+                   'clients' event with the clients that changed and a
+                   'counters' event. Closed clients are sent once with
+                   their final status.
+    GET /snapshot  the same snapshot as one JSON document.
+
+Client entries hold run_id, client_id, test, host_id, status, cpu, mem,
+client_cpu, files, bytes, throughput (MB/s since the last event) and
+write_speed (MB/s since the test started). Counters are the TestServer
+counters plus messages and messages_per_sec.
+
+Subscribers that do not read fast enough are disconnected once
+Config.LIVE_MAX_BUFFER bytes are waiting for them, so a stalled browser
+cannot grow the server's memory.
+
+Example:
+    curl -N localhost:8001/events
+"""
+
+STATUS_RUNNING = 'RUNNING'
+HTTP_HEADER_END = '\r\n\r\n'
+HTTP_MAX_REQUEST = 8192
+
+
+def format_event(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, separators=(',', ':')))
+
+
+class LiveMetrics(object):
+    """ In memory state of connected clients and session counters.
+
+        Args:
+            get_counters (callable): returns a dict of server counters for the counters event.
+            interval (optional[float]): seconds between published events.
+    """
+    def __init__(self, get_counters, interval=Config.LIVE_INTERVAL):
+        self.get_counters = get_counters
+        self.interval = interval
+        self.clients = {}
+        self.closed = {}
+        self.changed = set()
+        self.subscribers = set()
+        self.messages = 0
+        self.last_messages = 0
+        self.last_publish = time.time()
+        self.messages_per_sec = 0
+
+    def client_open(self, run_id, client_id):
+        self.clients[run_id] = dict(run_id=run_id, client_id=client_id, test=None, host_id=None,
+                                    status=None, cpu=None, mem=None, client_cpu=None, files=0, bytes=0,
+                                    throughput=0, write_speed=0, last_bytes=0, start=None)
+        self.changed.add(run_id)
+
+    def client_close(self, run_id, status):
+        client = self.clients.pop(run_id, None)
+        if client is not None:
+            client['status'] = status
+            self.closed[run_id] = client
+            self.changed.add(run_id)
+
+    def update(self, run_id, **values):
+        """ Sets values of an open client, e.g. update(run_id, cpu=0.5, mem=0.1). """
+        client = self.clients.get(run_id)
+        if client is not None:
+            client.update(values)
+            self.changed.add(run_id)
+
+    def test_start(self, run_id, test, host_id):
+        self.update(run_id, test=test, host_id=host_id, status=STATUS_RUNNING, start=time.time())
+
+    def rollover(self, run_id, nbytes):
+        client = self.clients.get(run_id)
+        if client is not None:
+            client['files'] += 1
+            client['bytes'] += nbytes
+            self.changed.add(run_id)
+
+    def client_state(self, client, elapsed=None):
+        """ Returns the published fields of client. With elapsed, throughput is updated from the
+            bytes moved since the last event.
+        """
+        if elapsed:
+            client['throughput'] = (client['bytes'] - client['last_bytes']) / Config.BYTES_PER_MEGABYTE / elapsed
+            client['last_bytes'] = client['bytes']
+        if client['start']:
+            running = time.time() - client['start']
+            client['write_speed'] = client['bytes'] / Config.BYTES_PER_MEGABYTE / running if running > 0 else 0
+        return dict((key, value) for key, value in client.iteritems() if key not in ('last_bytes', 'start'))
+
+    def counters(self):
+        counters = self.get_counters()
+        counters.update(clients_open=len(self.clients), messages=self.messages,
+                        messages_per_sec=self.messages_per_sec, subscribers=len(self.subscribers))
+        return counters
+
+    def snapshot(self):
+        return dict(clients=[self.client_state(client) for _, client in sorted(self.clients.iteritems())],
+                    counters=self.counters())
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+        subscriber.send_event('snapshot', self.snapshot())
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def close(self):
+        """ Publishes the last events and disconnects every subscriber. """
+        self.last_publish -= self.interval
+        self.tick()
+        for subscriber in list(self.subscribers):
+            subscriber.handle_write()
+            subscriber.handle_close()
+
+    def tick(self):
+        """ Called from TestServer's loop. Publishes events once interval seconds have passed. """
+        now = time.time()
+        elapsed = now - self.last_publish
+        if elapsed < self.interval:
+            return
+        self.last_publish = now
+        self.messages_per_sec = (self.messages - self.last_messages) / elapsed
+        self.last_messages = self.messages
+        for client in self.clients.itervalues():
+            if client['bytes'] != client['last_bytes'] or client['throughput']:
+                self.changed.add(client['run_id'])
+        changed = []
+        for run_id in sorted(self.changed):
+            client = self.clients.get(run_id) or self.closed.get(run_id)
+            if client is not None:
+                changed.append(self.client_state(client, elapsed))
+        self.changed.clear()
+        self.closed.clear()
+        if self.subscribers:
+            events = format_event('counters', self.counters())
+            if changed:
+                events = format_event('clients', changed) + events
+            for subscriber in list(self.subscribers):
+                subscriber.send(events)
+
+
+class LiveMetricsServer(asyncore.dispatcher):
+    """ Accepts HTTP connections for the live metrics.
+
+        Args:
+            host (str): address to listen on.
+            port (int): port to listen on.
+            live (LiveMetrics): metrics to serve.
+            socket_map (optional[dict]): asyncore socket map of the server's loop.
+    """
+    def __init__(self, host, port, live, socket_map=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.live = live
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(Config.LIVE_BACKLOG)
+        server_log.debug('Live metrics at http://{}:{}/events'.format(host, port))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            LiveMetricsConnection(pair[0], self.live, self._map)
+
+
+class LiveMetricsConnection(asyncore.dispatcher):
+    """ One HTTP request. /events stays open as a subscriber of live, other requests are
+        answered and closed.
+    """
+    def __init__(self, sock, live, socket_map=None):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.live = live
+        self.request = ''
+        self.out_buffer = ''
+        self.close_when_sent = False
+        self.subscribed = False
+
+    def handle_read(self):
+        data = self.recv(Config.CHANNEL_READ_SIZE)
+        if self.subscribed or self.close_when_sent:
+            return
+        self.request += data
+        if HTTP_HEADER_END in self.request:
+            self.handle_request(self.request.split('\r\n', 1)[0].split())
+        elif len(self.request) > HTTP_MAX_REQUEST:
+            self.respond('413 Request Entity Too Large', 'text/plain', 'request too large\n')
+
+    def handle_request(self, request_line):
+        if len(request_line) < 2 or request_line[0] != 'GET':
+            return self.respond('405 Method Not Allowed', 'text/plain', 'only GET is supported\n')
+        path = request_line[1].split('?', 1)[0]
+        if path == '/events':
+            self.send('HTTP/1.1 200 OK\r\n'
+                      'Content-Type: text/event-stream\r\n'
+                      'Cache-Control: no-cache\r\n'
+                      'Connection: keep-alive\r\n'
+                      'Access-Control-Allow-Origin: *\r\n\r\n'
+                      'retry: {}\n\n'.format(int(Config.LIVE_INTERVAL * 1000)))
+            self.subscribed = True
+            self.live.subscribe(self)
+        elif path == '/snapshot':
+            self.respond('200 OK', 'application/json', json.dumps(self.live.snapshot()))
+        else:
+            self.respond('404 Not Found', 'text/plain', 'no such resource\n')
+
+    def respond(self, status, content_type, body):
+        self.send('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                  'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n{}'.format(status, content_type,
+                                                                                         len(body), body))
+        self.close_when_sent = True
+
+    def send_event(self, event, data):
+        self.send(format_event(event, data))
+
+    def send(self, data):
+        """ Buffers data, the loop writes it when the socket is writable. """
+        self.out_buffer += data
+        wake = getattr(self._map, 'wake', None)
+        if wake is not None:
+            wake(self)
+        if len(self.out_buffer) > Config.LIVE_MAX_BUFFER:
+            server_log.debug('Live metrics subscriber {} too slow, disconnecting'.format(self.addr))
+            self.handle_close()
+
+    def writable(self):
+        return bool(self.out_buffer) and self.connected
+
+    def handle_write(self):
+        sent = asyncore.dispatcher.send(self, self.out_buffer[:Config.LIVE_WRITE_SIZE])
+        self.out_buffer = self.out_buffer[sent:]
+        if not self.out_buffer and self.close_when_sent:
+            self.handle_close()
+
+    def handle_close(self):
+        self.live.unsubscribe(self)
+        self.out_buffer = ''
+        self.close()
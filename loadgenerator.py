@@ -0,0 +1,452 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import errno
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import select
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import hostinfo
+import protocol
+import serverbenchmark
+import serverengine
+from histogram import LogHistogram
+from config import Config
+""" Load generator of simulated TestClients and server throughput suite.
+
+A few processes each drive thousands of SimulatedClients from one epoll
+loop. A simulated client speaks the protocol the way TestClient does:
+
+    start::binary::1 and id request, protocol::1 once the server answers,
+    then binary frames: host hash (and system info for unknown hosts),
+    optionally a test request, test start, then stats, rollovers,
+    heartbeats and latency snapshots every interval seconds for duration
+    seconds, the final latency snapshot and result, and end.
+
+Clients share hosts host fingerprints, so the first client of every host
+sends its system info and the rest are known. No test is run, the
+messages only carry plausible numbers.
+
+With --spawn ENGINE the suite starts a TestServer with that engine in a
+temporary directory (serverbenchmark.BenchmarkServer) and reports what it
+measured: accepted connections/sec, messages/sec, handler latency
+percentiles and RSS. Against a running server (--port, --server-pid) the
+server's RSS is sampled from /proc instead. The generator side reports
+connect and session setup times (start to id answer) and messages sent.
+Results are written as JSON with the code version, so runs can be
+compared between versions.
+
+Example:
+    python loadgenerator.py --spawn epoll -c 5000 -p 4 -d 20 -o results.json
+"""
+
+CONNECT_BATCH = 256
+SESSION_CONNECTING = 'connecting'
+SESSION_HANDSHAKE = 'handshake'
+SESSION_TEST = 'test'
+SESSION_ENDING = 'ending'
+SESSION_CLOSED = 'closed'
+TEST_ARGS = "{'timeout': 10, 'file_size': 1}"
+
+
+def host_fingerprint(index):
+    """ Returns (encoded info, hash) of simulated host index. """
+    encoded = hostinfo.encode_host_info(dict(hostname='loadgen-{}'.format(index), kernel=platform.release(),
+                                             machine=platform.machine(), cpu_model='simulated', cpu_count=1,
+                                             mem_total=0, device=dict(name='sim{}'.format(index))))
+    return encoded, hostinfo.host_hash(encoded)
+
+
+class SimulatedClient(object):
+    """ Protocol state of one simulated TestClient.
+
+        Args:
+            generator (LoadGenerator): loop the client belongs to.
+            host (tuple): (encoded info, hash) of the client's host.
+    """
+    def __init__(self, generator, host):
+        self.generator = generator
+        self.host_info, self.host_hash = host
+        self.sock = None
+        self.state = SESSION_CONNECTING
+        self.output = []
+        self.text_input = ''
+        self.frame_reader = None
+        self.binary_out = False
+        self.connect_start = 0
+        self.test_end = 0
+        self.rollover = 0
+        self.latency = LogHistogram()
+
+    def connect(self, address, now):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.connect_start = now
+        result = self.sock.connect_ex(address)
+        if result not in (0, errno.EINPROGRESS):
+            raise socket.error(result, os.strerror(result))
+
+    def handle_connect(self, now):
+        self.generator.connect_time.record((now - self.connect_start) * Config.MICRO_SECONDS_PER_SECOND)
+        self.state = SESSION_HANDSHAKE
+        self.send(Config.API_CLIENT_START, Config.PROTOCOL_BINARY, protocol.PROTOCOL_VERSION)
+        self.send(Config.API_ID_REQUEST)
+
+    def send(self, header, *fields):
+        if self.binary_out:
+            self.output.append(protocol.encode(header, *fields))
+        else:
+            self.output.append(protocol.encode_text(header, *fields))
+        self.generator.messages_sent += 1
+
+    def feed(self, data, now):
+        """ Handles server messages in data, text until the protocol answer and binary after it. """
+        if self.frame_reader is not None:
+            messages = self.frame_reader.feed(data)
+        else:
+            messages = []
+            self.text_input += data
+            while self.frame_reader is None and Config.TERMINATOR in self.text_input:
+                message, self.text_input = self.text_input.split(Config.TERMINATOR, 1)
+                header, fields = protocol.decode_text(message)
+                messages.append((header, fields))
+                if header == Config.API_PROTOCOL:
+                    self.frame_reader = protocol.FrameReader()
+                    messages.extend(self.frame_reader.feed(self.text_input))
+                    self.text_input = ''
+        for header, fields in messages:
+            self.handle_message(header, fields, now)
+
+    def handle_message(self, header, fields, now):
+        if header == Config.API_PROTOCOL:
+            self.send(Config.API_PROTOCOL, int(fields[0]))
+            self.binary_out = True
+            self.send(Config.API_HOST, self.host_hash)
+            if self.generator.request_test:
+                self.send(Config.API_TEST_REQUEST)
+            else:
+                self.start_test(Config.TEST_FILE_WRITE_NAME, TEST_ARGS, now)
+        elif header == Config.API_ID_REQUEST:
+            self.generator.setup_time.record((now - self.connect_start) * Config.MICRO_SECONDS_PER_SECOND)
+        elif header == Config.API_HOST:
+            if len(fields) > 1 and fields[1] == hostinfo.HOST_UNKNOWN:
+                self.send(Config.API_SYSTEM_INFO, self.host_info, self.host_hash)
+        elif header == Config.API_TEST_REQUEST:
+            if fields:
+                self.start_test(fields[0], fields[1], now)
+            else:
+                self.start_test(Config.TEST_FILE_WRITE_NAME, TEST_ARGS, now)
+
+    def start_test(self, name, args, now):
+        self.state = SESSION_TEST
+        self.send(Config.API_RUNNING_TEST, name, args)
+        self.test_end = now + self.generator.duration
+        self.generator.schedule(self, now + self.generator.interval)
+
+    def send_batch(self, now):
+        """ Sends one interval of test messages, or the end of the test once duration passed. """
+        if self.state != SESSION_TEST:
+            return
+        if now >= self.test_end:
+            self.send(Config.API_TEST_LATENCY, now, 0, self.latency.encode())
+            self.send(Config.API_TEST_RESULT, now, 0, 'write_speed', 100.0)
+            self.send(Config.API_CLIENT_END)
+            self.state = SESSION_ENDING
+            return
+        generator = self.generator
+        now_ns = int(now * Config.NANO_SECONDS_PER_SECOND)
+        file_ns = int(generator.interval * Config.NANO_SECONDS_PER_SECOND) // max(generator.rollovers, 1)
+        for number in xrange(generator.rollovers):
+            self.latency.record(100 + self.rollover % 400)
+            self.rollover += 1
+            end_ns = now_ns - (generator.rollovers - 1 - number) * file_ns
+            self.send(Config.API_TEST_FILE_WRITE, now, 0, Config.BYTES_PER_MEGABYTE, end_ns - file_ns, end_ns)
+        self.send(Config.API_TEST_STATS, 0.25, 0.01, now, 0.01, 0, Config.BYTES_PER_MEGABYTE, 0,
+                  Config.BYTES_PER_MEGABYTE, 0.5, now_ns)
+        self.send(Config.API_HEARTBEAT, now, now_ns)
+        self.send(Config.API_TEST_LATENCY, now, 0, self.latency.encode())
+        generator.schedule(self, now + generator.interval)
+
+
+class LoadGenerator(object):
+    """ epoll loop of clients SimulatedClients.
+
+        Args:
+            address (tuple): (host, port) of the TestServer.
+            clients (int): simulated clients of this generator.
+            duration (float): seconds every client runs its test.
+            interval (optional[float]): seconds between message batches of a client.
+            rollovers (optional[int]): rollovers per batch.
+            hosts (optional[int]): simulated hosts the clients are spread over.
+            request_test (optional[bool]): ask the server for a test before starting one.
+    """
+    def __init__(self, address, clients, duration, interval=1.0, rollovers=4, hosts=1, request_test=False):
+        self.address = address
+        self.clients = clients
+        self.duration = duration
+        self.interval = interval
+        self.rollovers = rollovers
+        self.hosts = [host_fingerprint(index) for index in xrange(max(hosts, 1))]
+        self.request_test = request_test
+        self.epoll = select.epoll()
+        self.sessions = {}
+        self.timers = []
+        self.connect_time = LogHistogram()
+        self.setup_time = LogHistogram()
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.connecting = 0
+        self.connected = 0
+        self.connect_errors = 0
+        self.closed_by_server = 0
+
+    def schedule(self, client, when):
+        heapq.heappush(self.timers, (when, id(client), client))
+
+    def start_connects(self, started, now):
+        """ Starts connects while fewer than CONNECT_BATCH are in progress. Returns clients started. """
+        while started < self.clients and self.connecting < CONNECT_BATCH:
+            client = SimulatedClient(self, self.hosts[started % len(self.hosts)])
+            started += 1
+            try:
+                client.connect(self.address, now)
+            except socket.error:
+                self.connect_errors += 1
+                client.sock.close()
+                continue
+            self.sessions[client.sock.fileno()] = client
+            self.epoll.register(client.sock.fileno(), select.EPOLLOUT)
+            self.connecting += 1
+        return started
+
+    def flush(self, fd, client):
+        """ Sends buffered output, waits for EPOLLOUT while the socket is full. """
+        if client.output:
+            data = ''.join(client.output)
+            try:
+                sent = client.sock.send(data)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close(fd, client)
+                    return
+                sent = 0
+            self.bytes_sent += sent
+            client.output = [data[sent:]] if sent < len(data) else []
+        self.epoll.modify(fd, select.EPOLLIN | (select.EPOLLOUT if client.output else 0))
+
+    def close(self, fd, client):
+        if client.state in (SESSION_TEST, SESSION_HANDSHAKE):
+            self.closed_by_server += 1
+        client.state = SESSION_CLOSED
+        self.epoll.unregister(fd)
+        client.sock.close()
+        del self.sessions[fd]
+
+    def handle_event(self, fd, flags, now):
+        client = self.sessions[fd]
+        if client.state == SESSION_CONNECTING:
+            self.connecting -= 1
+            error = client.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.connect_errors += 1
+                self.close(fd, client)
+                return
+            self.connected += 1
+            client.handle_connect(now)
+        elif flags & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            try:
+                data = client.sock.recv(Config.CHANNEL_READ_SIZE)
+            except socket.error:
+                data = ''
+            if not data:
+                self.close(fd, client)
+                return
+            client.feed(data, now)
+        self.flush(fd, client)
+
+    def run(self, deadline):
+        """ Runs until every client ended or deadline passes.
+
+            Return:
+                dict: generator results.
+        """
+        started = 0
+        start = time.time()
+        while (started < self.clients or self.sessions) and time.time() < deadline:
+            now = time.time()
+            started = self.start_connects(started, now)
+            timeout = 0.1
+            if self.timers:
+                timeout = min(max(self.timers[0][0] - now, 0), timeout)
+            for fd, flags in self.epoll.poll(timeout):
+                if fd in self.sessions:
+                    self.handle_event(fd, flags, time.time())
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, client = heapq.heappop(self.timers)
+                if client.state == SESSION_TEST:
+                    client.send_batch(now)
+                    self.flush(client.sock.fileno(), client)
+        for fd, client in self.sessions.items():
+            self.close(fd, client)
+        self.epoll.close()
+        return dict(clients=self.clients, connected=self.connected, connect_errors=self.connect_errors,
+                    closed_by_server=self.closed_by_server, messages_sent=self.messages_sent,
+                    bytes_sent=self.bytes_sent, seconds=time.time() - start,
+                    connect_time=self.connect_time.encode(), setup_time=self.setup_time.encode())
+
+
+def generate(address, clients, options, deadline, results):
+    """ Process target, puts the results of one LoadGenerator on results. """
+    serverbenchmark.raise_file_limit()
+    generator = LoadGenerator(address, clients, options['duration'], options['interval'], options['rollovers'],
+                              options['hosts'], options['request_test'])
+    results.put(generator.run(deadline))
+
+
+def merge_results(parts):
+    """ Sums the results of the generator processes and merges their histograms. """
+    merged = dict((key, sum(part[key] for part in parts)) for key in ('clients', 'connected', 'connect_errors',
+                                                                        'closed_by_server', 'messages_sent',
+                                                                        'bytes_sent'))
+    merged['seconds'] = max(part['seconds'] for part in parts)
+    merged['messages_per_sec'] = merged['messages_sent'] / merged['seconds'] if merged['seconds'] else None
+    for name in ('connect_time', 'setup_time'):
+        histogram = LogHistogram()
+        for part in parts:
+            histogram.merge(LogHistogram.decode(part[name]))
+        merged[name + '_us'] = dict(mean=histogram.mean(), max=histogram.max,
+                                    **dict(('p{}'.format(percent).replace('.', ''), value)
+                                           for percent, value in histogram.percentiles().iteritems()))
+    return merged
+
+
+def sample_rss(pid, stop, results):
+    """ Process target, samples the peak RSS of pid until stop is set. """
+    peak = None
+    while not stop.wait(0.5):
+        rss = serverbenchmark.read_rss(pid)[0]
+        if rss is not None and rss > peak:
+            peak = rss
+    results.put(peak)
+
+
+def code_version():
+    """ Returns the git commit of this tree, None outside a git checkout. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(clients, processes, options, port=Config.PORT, spawn=None, server_pid=None):
+    """ Runs processes LoadGenerators against a server, a new one with engine spawn if given.
+
+        Return:
+            dict: run settings, generator results and server results.
+    """
+    timeout = options['duration'] + options['timeout']
+    directory = None
+    server = rss_sampler = None
+    server_results = multiprocessing.Queue()
+    rss_stop = multiprocessing.Event()
+    if spawn:
+        directory = tempfile.mkdtemp(prefix='loadgenerator')
+        cwd = os.getcwd()
+        os.chdir(directory)
+        port = serverbenchmark.free_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=serverbenchmark.serve,
+                                         args=(port, spawn, clients, timeout, ready, server_results))
+        server.start()
+        os.chdir(cwd)
+        ready.wait(timeout)
+    elif server_pid:
+        rss_sampler = multiprocessing.Process(target=sample_rss, args=(server_pid, rss_stop, server_results))
+        rss_sampler.start()
+    try:
+        results = multiprocessing.Queue()
+        deadline = time.time() + timeout
+        shares = [clients // processes + (1 if index < clients % processes else 0) for index in xrange(processes)]
+        workers = [multiprocessing.Process(target=generate, args=((Config.HOST, port), share, options, deadline,
+                                                                  results))
+                   for share in shares if share]
+        for worker in workers:
+            worker.start()
+        parts = [results.get(timeout=timeout + 30) for _ in workers]
+        for worker in workers:
+            worker.join()
+        server_result = None
+        if server:
+            server_result = server_results.get(timeout=timeout + Config.SERVER_DRAIN_TIMEOUT + 30)
+            server.join()
+            server_result['messages_per_sec'] = (server_result['messages'] / server_result['seconds']
+                                                 if server_result['seconds'] else None)
+        elif rss_sampler:
+            rss_stop.set()
+            server_result = dict(peak_rss_kb=server_results.get(timeout=30))
+            rss_sampler.join()
+    finally:
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    return dict(version=code_version(), time=time.strftime('%Y-%m-%d_%H:%M:%S'), hostname=platform.node(),
+                settings=dict(options, clients=clients, processes=processes, engine=spawn, port=port),
+                generator=merge_results(parts), server=server_result)
+
+
+def print_results(result):
+    generator, server = result['generator'], result['server'] or {}
+    print 'clients {} over {} processes, {} connected, {} connect errors'.format(
+        generator['clients'], result['settings']['processes'], generator['connected'], generator['connect_errors'])
+    print 'generator: {:.0f} msgs/sec sent, connect p99 {} us, session setup p99 {} us'.format(
+        generator['messages_per_sec'] or 0, generator['connect_time_us']['p99'], generator['setup_time_us']['p99'])
+    if 'messages' in server:
+        print 'server:    {:.0f} accepts/sec, {:.0f} msgs/sec, handler p50 {} p99 {} p99.9 {} us, peak rss {} KB'.format(
+            server['accepts_per_sec'] or 0, server['messages_per_sec'] or 0, server['p50'], server['p99'],
+            server['p999'], server['peak_rss_kb'])
+        if server['error']:
+            print 'server error: {}'.format(server['error'])
+    elif server:
+        print 'server:    peak rss {} KB'.format(server['peak_rss_kb'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--clients', dest='clients', default=1000, type=int, help='simulated clients')
+    parser.add_argument('-p', '--processes', dest='processes', default=2, type=int,
+                        help='generator processes the clients are spread over')
+    parser.add_argument('-d', '--duration', dest='duration', default=10, type=float,
+                        help='seconds every client runs its test')
+    parser.add_argument('-i', '--interval', dest='interval', default=1.0, type=float,
+                        help='seconds between message batches of a client')
+    parser.add_argument('-r', '--rollovers', dest='rollovers', default=4, type=int, help='rollovers per batch')
+    parser.add_argument('-H', '--hosts', dest='hosts', default=1, type=int, help='simulated hosts')
+    parser.add_argument('-q', '--request-test', dest='request_test', action='store_true',
+                        help='ask the server for a test before starting one')
+    parser.add_argument('-t', '--timeout', dest='timeout', default=60, type=float,
+                        help='seconds to wait for connects and the server beyond duration')
+    parser.add_argument('-s', '--spawn', dest='spawn', default=None, choices=sorted(serverengine.ENGINES),
+                        help='start a TestServer with this engine instead of using a running one')
+    parser.add_argument('-P', '--port', dest='port', default=Config.PORT, type=int, help='port of a running server')
+    parser.add_argument('--server-pid', dest='server_pid', default=None, type=int,
+                        help='pid of a running server to sample RSS from')
+    parser.add_argument('-o', '--output', dest='output', default=None, help='write results as JSON to this file')
+    cmd_input = parser.parse_args()
+
+    serverbenchmark.raise_file_limit()
+    run_options = dict(duration=cmd_input.duration, interval=cmd_input.interval, rollovers=cmd_input.rollovers,
+                       hosts=cmd_input.hosts, request_test=cmd_input.request_test, timeout=cmd_input.timeout)
+    suite_result = run_suite(cmd_input.clients, cmd_input.processes, run_options, cmd_input.port, cmd_input.spawn,
+                             cmd_input.server_pid)
+    print_results(suite_result)
+    if cmd_input.output:
+        with open(cmd_input.output, 'w') as f:
+            json.dump(suite_result, f, indent=2, sort_keys=True)
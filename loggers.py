@@ -1,20 +1,246 @@
 __author__ = 'tristan'
+import atexit
+import json
 import logging
+import os
+import threading
+import time
+import Queue
+from config import Config
+""" Loggers of the server and the client.
+
+With Config.LOG_ASYNC, server_log and test_log hand records to an
+AsyncHandler: the caller only puts the record on a bounded queue and a
+writer thread formats and writes it to the console and log files, so
+the event loop never waits for a terminal or a disk. Records are dropped
+and counted when the queue is full. Forked processes, e.g. the processes
+running tests, write their records directly unless they call
+restart_async_handlers().
+
+High frequency messages pass a category, e.g.
+    server_log.debug('%s: heartbeat', client_id, extra=log_category(Config.API_HEARTBEAT))
+and the logger lets at most Config.LOG_RATE_LIMITS[category] of them
+through per second. The rest are dropped before a record is made, which
+is most of what a logging call costs. Log files are text or, with
+Config.LOG_FORMAT 'json', JSON lines that carry the category and how
+many records of it were suppressed in the window before.
+"""
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object per line. """
+    def format(self, record):
+        entry = dict(time=record.created, logger=record.name, level=record.levelname, module=record.module,
+                     message=record.getMessage())
+        category = getattr(record, 'category', None)
+        if category is not None:
+            entry['category'] = category
+            entry['suppressed'] = getattr(record, 'suppressed', 0)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'))
+
+
+class RateLimiter(object):
+    """ Lets at most rates[category] messages of a category through per one second window.
+
+        Args:
+            rates (dict): category mapped to messages per second.
+    """
+    def __init__(self, rates):
+        self.rates = rates
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def check(self, category, now):
+        """ Return:
+                int: None if the message is suppressed, otherwise the number of messages of category
+                     suppressed in the window before, if this message opens a new window.
+        """
+        rate = self.rates.get(category)
+        if rate is None:
+            return 0
+        with self.lock:
+            window = self.windows.get(category)
+            suppressed = 0
+            if window is None or now - window[0] >= 1:
+                suppressed = window[2] if window else 0
+                window = self.windows[category] = [now, 0, 0]
+            if window[1] >= rate:
+                window[2] += 1
+                return None
+            window[1] += 1
+            return suppressed
+
+
+class RateLimitedLogger(logging.Logger):
+    """ Logger that drops messages of rate limited categories before making their records.
+        Categories are passed as extra=log_category(category).
+    """
+    rate_limiter = None
+
+    def _log(self, level, msg, args, exc_info=None, extra=None):
+        if extra is not None and self.rate_limiter is not None and 'category' in extra:
+            suppressed = self.rate_limiter.check(extra['category'], time.time())
+            if suppressed is None:
+                return
+            extra = dict(extra, suppressed=suppressed)
+        logging.Logger._log(self, level, msg, args, exc_info, extra)
+
+
+class AsyncHandler(logging.Handler):
+    """ Queues records for a writer thread that passes them to the target handlers.
+
+        Args:
+            targets (optional[list]): handlers records are written to.
+            queue_size (optional[int]): records waiting for the writer before new ones are dropped.
+    """
+    def __init__(self, targets=(), queue_size=Config.LOG_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.targets = list(targets)
+        self.queue_size = queue_size
+        self.queue = None
+        self.writer = None
+        self.pid = None
+        self.forked_pid = None
+        self.dropped = 0
+
+    def add_target(self, handler):
+        self.targets.append(handler)
+
+    def start(self):
+        """ Starts the writer thread of this process. Called on the first record, and by forked
+            processes that log from an event loop of their own.
+        """
+        if self.pid is not None and self.pid != os.getpid() and self.forked_pid != os.getpid():
+            self.forked_pid = os.getpid()
+            for handler in self.targets:
+                handler.createLock()
+        self.queue = Queue.Queue(self.queue_size)
+        self.pid = os.getpid()
+        self.writer = threading.Thread(target=self.run, name='log writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        if self.pid is None:
+            self.start()
+        elif self.pid != os.getpid():
+            self.write_forked(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def write_forked(self, record):
+        """ Writes record in a forked process. The targets' locks are created anew first, the
+            parent's writer thread may have held them when the process was forked.
+        """
+        if self.forked_pid != os.getpid():
+            self.forked_pid = os.getpid()
+            for handler in self.targets:
+                handler.createLock()
+        self.write(record)
+
+    def write(self, record):
+        for handler in self.targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                self.write(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Waits until the writer has written every queued record. """
+        if self.pid == os.getpid() and self.writer.is_alive():
+            self.queue.join()
+        for handler in self.targets:
+            handler.flush()
+
+    def close(self):
+        """ Writes the queued records and stops the writer. """
+        if self.pid == os.getpid() and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+            self.pid = None
+            if self.dropped:
+                self.write(logging.makeLogRecord(dict(name='loggers', levelno=logging.WARNING,
+                                                      levelname='WARNING', module='loggers',
+                                                      msg='{} log records dropped'.format(self.dropped))))
+        logging.Handler.close(self)
+
+
+def log_category(category):
+    """ Returns the extra argument of a logging call for records of category. """
+    return {'category': category}
+
+
+def log_file_formatter():
+    return json_formatter if Config.LOG_FORMAT == 'json' else file_formatter
+
+
+def add_handler(logger, handler):
+    """ Adds handler to logger, behind the logger's AsyncHandler if it has one. """
+    for existing in logger.handlers:
+        if isinstance(existing, AsyncHandler):
+            existing.add_target(handler)
+            return
+    logger.addHandler(handler)
+
+
+def async_handlers():
+    return [handler for logger in (server_log, test_log) for handler in logger.handlers
+            if isinstance(handler, AsyncHandler)]
+
+
+def restart_async_handlers():
+    """ Gives a forked process writer threads of its own. It must call close_async_handlers()
+        before it exits, processes of multiprocessing end without running atexit.
+    """
+    for handler in async_handlers():
+        handler.start()
+
+
+def close_async_handlers():
+    for handler in async_handlers():
+        handler.close()
+
+
+def get_rate_limited_logger(name, rates):
+    """ Returns the logger name as a RateLimitedLogger with its own limiter of rates. """
+    logging.setLoggerClass(RateLimitedLogger)
+    try:
+        logger = logging.getLogger(name)
+    finally:
+        logging.setLoggerClass(logging.Logger)
+    logger.rate_limiter = RateLimiter(rates)
+    return logger
+
+
+def setup_logger(name):
+    logger = get_rate_limited_logger(name, Config.LOG_RATE_LIMITS)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(AsyncHandler([console]) if Config.LOG_ASYNC else console)
+    return logger
+
 
 # Global logging handlers
 console_formatter = logging.Formatter('%(module)ls(%(asctime)s)- %(message)s', datefmt='%H:%M:%S')
 file_formatter = logging.Formatter('%(asctime)s- %(message)s', datefmt='%Y%m%d(%H:%M:%S)')
+json_formatter = JsonFormatter()
 
 console = logging.StreamHandler()
 console.setLevel(logging.DEBUG)
 console.setFormatter(console_formatter)
 
-server_log = logging.getLogger('Server_Log')
-server_log.setLevel(logging.DEBUG)
-server_log.addHandler(console)
-
-test_log = logging.getLogger('Test_log')
-test_log.setLevel(logging.DEBUG)
-test_log.addHandler(console)
-
-
+server_log = setup_logger('Server_Log')
+test_log = setup_logger('Test_log')
+atexit.register(close_async_handlers)
@@ -0,0 +1,136 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import loggers
+from config import Config
+""" Benchmark of the time the server's event loop spends in logging.
+
+Logs the messages a TestServer logs for its clients' heartbeats, stats
+and rollovers, timing only the logging calls as the loop sees them:
+
+    sync   the logging before loggers.AsyncHandler. Messages are formatted
+           by the caller and every record is formatted and written to the
+           console and the log file before the call returns.
+    queue  lazy %-style messages with a category handed to an
+           AsyncHandler without rate limits. Its writer thread writes to
+           the same console and log file.
+    async  as queue, rate limited by Config.LOG_RATE_LIMITS as the
+           server's and client's loggers are.
+
+The console is /dev/null so a terminal's speed does not count. The time
+the writer thread needs to write out the queue after the last message is
+reported apart, it is not spent in the loop. On CPython 2 the writer
+thread competes with the loop for the GIL, so with fast output queueing
+alone does not lower the loop's time, it keeps a slow terminal or disk
+from blocking the loop. Most of the saving comes from the rate limit,
+which drops messages before a record is made.
+
+Example:
+    python loggingbenchmark.py -n 100000 -c 1000
+"""
+
+
+def build_messages(count, clients):
+    """ Returns (category, client id, values) of count messages from clients clients. """
+    client_ids = [str(uuid.uuid4()) for _ in xrange(clients)]
+    categories = [Config.API_TEST_STATS, Config.API_TEST_STATS, Config.API_TEST_FILE_WRITE, Config.API_HEARTBEAT]
+    return [(categories[number % len(categories)], client_ids[number % clients], (0.25, 0.5, number % 4))
+            for number in xrange(count)]
+
+
+def log_sync(logger, messages):
+    start = time.time()
+    for category, client_id, (cpu, mem, worker) in messages:
+        if category == Config.API_TEST_STATS:
+            logger.debug(client_id + ': CPU {} MEM {}'.format(cpu, mem))
+        elif category == Config.API_TEST_FILE_WRITE:
+            logger.debug(client_id + ': file roll over (worker {})'.format(worker))
+        else:
+            logger.debug(client_id + ': heartbeat')
+    return time.time() - start
+
+
+def log_async(logger, messages):
+    start = time.time()
+    for category, client_id, (cpu, mem, worker) in messages:
+        if category == Config.API_TEST_STATS:
+            logger.debug('%s: CPU %s MEM %s', client_id, cpu, mem, extra=loggers.log_category(category))
+        elif category == Config.API_TEST_FILE_WRITE:
+            logger.debug('%s: file roll over (worker %s)', client_id, worker, extra=loggers.log_category(category))
+        else:
+            logger.debug('%s: heartbeat', client_id, extra=loggers.log_category(category))
+    return time.time() - start
+
+
+def make_targets(directory, name):
+    console = logging.StreamHandler(open(os.devnull, 'w'))
+    console.setFormatter(loggers.console_formatter)
+    log_file = logging.FileHandler(os.path.join(directory, name), 'a')
+    log_file.setFormatter(loggers.file_formatter)
+    return [console, log_file]
+
+
+def count_lines(location):
+    with open(location, 'r') as f:
+        return sum(1 for _ in f)
+
+
+def benchmark(count, clients):
+    messages = build_messages(count, clients)
+    directory = tempfile.mkdtemp(prefix='loggingbenchmark')
+    results = []
+    try:
+        logger = logging.getLogger('loggingbenchmark.sync')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        targets = make_targets(directory, 'sync.log')
+        for target in targets:
+            logger.addHandler(target)
+        elapsed = log_sync(logger, messages)
+        for target in targets:
+            target.close()
+        results.append(('sync', elapsed, 0, count_lines(os.path.join(directory, 'sync.log')), 0))
+
+        for mode, rates in (('queue', {}), ('async', Config.LOG_RATE_LIMITS)):
+            logger = loggers.get_rate_limited_logger('loggingbenchmark.' + mode, rates)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            handler = loggers.AsyncHandler(make_targets(directory, mode + '.log'), queue_size=count + 1)
+            logger.addHandler(handler)
+            elapsed = log_async(logger, messages)
+            start = time.time()
+            handler.flush()
+            drain = time.time() - start
+            handler.close()
+            for target in handler.targets:
+                target.close()
+            results.append((mode, elapsed, drain, count_lines(os.path.join(directory, mode + '.log')),
+                            handler.dropped))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main(count, clients):
+    print '{} messages from {} clients'.format(count, clients)
+    print '{:<6} {:>10} {:>12} {:>10} {:>10} {:>8}'.format('mode', 'loop s', 'us/message', 'drain s', 'lines',
+                                                          'dropped')
+    for mode, elapsed, drain, lines, dropped in benchmark(count, clients):
+        print '{:<6} {:>10.3f} {:>12.2f} {:>10.3f} {:>10} {:>8}'.format(mode, elapsed, elapsed / count * 1e6, drain,
+                                                                       lines, dropped)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', dest='messages', default=100000, type=int,
+                        help='messages to log')
+    parser.add_argument('-c', '--clients', dest='clients', default=1000, type=int,
+                        help='clients the messages come from')
+    cmd_input = parser.parse_args()
+    main(cmd_input.messages, cmd_input.clients)
@@ -0,0 +1,72 @@
+__author__ = 'Tristan Storz'
+import os
+import errno
+import fcntl
+import protocol
+from config import Config
+""" Message Channel for passing test messages from test processes to TestClient.
+
+MessageChannel wraps an os.pipe(). Test processes write messages to the
+write end with put() as binary frames (see protocol.py) and TestClient
+registers the read end with
+its asyncore loop, so the client sleeps in select() until a test has
+something to say instead of polling a multiprocessing.Queue.
+
+Messages are written with a single os.write, so every message up to
+PIPE_BUF bytes (4096 on Linux) arrives whole even when several test
+processes write at the same time.
+
+Example:
+    channel = MessageChannel()
+    channel.put(Config.API_HEARTBEAT, time.time())
+    for header, fields in protocol.FrameReader().feed(channel.read_available()):
+        print header, fields
+"""
+
+
+class MessageChannel(object):
+    """ Creates the pipe. Must be created before test processes are forked. """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL, 0)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        """ Returns the read end of the pipe for use with select/asyncore. """
+        return self.read_fd
+
+    def put(self, header, *fields):
+        """ Writes a complete message to the channel.
+            Args:
+                header (str): Config.API_* message header.
+                fields: message fields, numbers are sent packed.
+        """
+        os.write(self.write_fd, protocol.encode(header, *fields))
+
+    def read_available(self):
+        """ Reads everything currently in the pipe without blocking.
+
+            Return:
+                str: all pending frames, empty if nothing is pending.
+        """
+        chunks = []
+        while True:
+            try:
+                data = os.read(self.read_fd, Config.CHANNEL_READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            chunks.append(data)
+        return ''.join(chunks)
+
+    def close(self):
+        """ Closes both ends of the pipe in the calling process. """
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
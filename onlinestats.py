@@ -0,0 +1,208 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import math
+from config import Config
+""" Constant memory streaming statistics.
+
+RunningStats keeps the count, mean and variance of a stream (Welford's
+online algorithm), its minimum and maximum and a QuantileSketch, so a
+run's cpu, memory and throughput can be summarised without keeping its
+samples. Both merge: two RunningStats combine as if every value had been
+added to one of them (Chan's parallel update of mean and variance), so
+summaries of many runs, e.g. every run of a host, merge exactly except
+for the quantile error.
+
+QuantileSketch puts positive values into logarithmic buckets, bucket i
+holding the values in (gamma^(i-1), gamma^i] with
+gamma = (1 + accuracy) / (1 - accuracy). The bucket's midpoint is then
+within accuracy (relative) of every value in it, whatever their scale.
+Values at or below MIN_VALUE, e.g. an idle cpu, are counted apart as
+zero. At most max_buckets buckets are kept, the lowest are collapsed
+into one when there are more, so high quantiles stay accurate. Sketches
+with the same accuracy merge by adding bucket counts.
+
+encode() returns a compact text form for the db, decode() reads it back.
+
+Example:
+    cpu = RunningStats()
+    for value in (0.25, 0.5, 0.4):
+        cpu.add(value)
+    print cpu.mean, cpu.stddev(), cpu.min, cpu.max, cpu.quantile(0.99)
+    total = RunningStats.decode(cpu.encode())
+    total.merge(other_run_cpu)
+"""
+
+MIN_VALUE = 1e-9
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class QuantileSketch(object):
+    """ Mergeable quantile sketch with relative accuracy over non-negative values.
+
+        Args:
+            accuracy (optional[float]): relative error of quantiles, e.g. 0.01 for 1%.
+            max_buckets (optional[int]): buckets kept before the lowest are collapsed.
+    """
+    __slots__ = ('accuracy', 'max_buckets', 'log_gamma', 'buckets', 'zero', 'count')
+
+    def __init__(self, accuracy=Config.STATS_SKETCH_ACCURACY, max_buckets=Config.STATS_SKETCH_BUCKETS):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.buckets = {}
+        self.zero = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        self.count += count
+        if value <= MIN_VALUE:
+            self.zero += count
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        """ Folds the lowest buckets into the lowest kept one until max_buckets are left. """
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets
+        if excess <= 0:
+            return
+        folded = sum(self.buckets.pop(index) for index in indexes[:excess])
+        self.buckets[indexes[excess]] += folded
+
+    def bucket_value(self, index):
+        """ Returns the value within accuracy of every value in bucket index. """
+        return 2 * math.exp(index * self.log_gamma) / (1 + math.exp(self.log_gamma))
+
+    def merge(self, other):
+        """ Adds the counts of other, a sketch of the same accuracy, into this one. """
+        if other.accuracy != self.accuracy:
+            raise ValueError('cannot merge sketches of accuracy {} and {}'.format(self.accuracy, other.accuracy))
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.collapse()
+
+    def quantiles(self, quantiles=QUANTILES):
+        """ Returns dict of quantile (0-1) to value in one pass, None values for an empty sketch. """
+        if not self.count:
+            return dict((quantile, None) for quantile in quantiles)
+        ranks = sorted((max(int(math.ceil(self.count * quantile)), 1), quantile) for quantile in quantiles)
+        result = {}
+        seen = self.zero
+        position = 0
+        while position < len(ranks) and ranks[position][0] <= seen:
+            result[ranks[position][1]] = 0.0
+            position += 1
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while position < len(ranks) and ranks[position][0] <= seen:
+                result[ranks[position][1]] = self.bucket_value(index)
+                position += 1
+            if position == len(ranks):
+                break
+        return result
+
+    def encode(self):
+        """ Returns the sparse text form: zero;index:count,index:count,... """
+        return '{};{}'.format(self.zero, ','.join('{}:{}'.format(index, count)
+                                                  for index, count in sorted(self.buckets.iteritems())))
+
+    @classmethod
+    def decode(cls, encoded, accuracy=Config.STATS_SKETCH_ACCURACY, max_buckets=Config.STATS_SKETCH_BUCKETS):
+        sketch = cls(accuracy, max_buckets)
+        zero, buckets = encoded.split(';')
+        sketch.zero = sketch.count = int(zero)
+        if buckets:
+            for bucket in buckets.split(','):
+                index, count = bucket.split(':')
+                count = int(count)
+                sketch.buckets[int(index)] = count
+                sketch.count += count
+        sketch.collapse()
+        return sketch
+
+
+class RunningStats(object):
+    """ Count, mean, variance, extrema and quantiles of a stream in constant memory. """
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        """ Combines other into this as if its values had been added here. """
+        if not other.count:
+            return
+        if not self.count:
+            self.mean, self.m2, self.min, self.max = other.mean, other.m2, other.min, other.max
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+
+    def variance(self):
+        """ Returns the sample variance, 0 for fewer than two values. """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def stddev(self):
+        return math.sqrt(self.variance())
+
+    def quantiles(self, quantiles=QUANTILES):
+        """ Returns dict of quantile (0-1) to value, kept within the exact min and max. """
+        return dict((quantile, value if value is None else min(max(value, self.min), self.max))
+                    for quantile, value in self.sketch.quantiles(quantiles).iteritems())
+
+    def quantile(self, quantile):
+        return self.quantiles((quantile,))[quantile]
+
+    def summary(self, quantiles=QUANTILES):
+        """ Returns dict of count, mean, stddev, min, max and p<quantile * 100> values. """
+        summary = dict(count=self.count, mean=self.mean if self.count else None,
+                       stddev=self.stddev() if self.count else None, min=self.min, max=self.max)
+        for quantile, value in self.quantiles(quantiles).iteritems():
+            summary['p{:g}'.format(quantile * 100)] = value
+        return summary
+
+    def encode(self):
+        """ Returns the text form: count;mean;m2;min;max|sketch """
+        return '{};{!r};{!r};{!r};{!r}|{}'.format(self.count, self.mean, self.m2, self.min, self.max,
+                                                  self.sketch.encode())
+
+    @classmethod
+    def decode(cls, encoded):
+        stats = cls()
+        moments, sketch = encoded.split('|')
+        count, mean, m2, minimum, maximum = moments.split(';')
+        stats.count = int(count)
+        stats.mean = float(mean)
+        stats.m2 = float(m2)
+        stats.min = None if minimum == 'None' else float(minimum)
+        stats.max = None if maximum == 'None' else float(maximum)
+        stats.sketch = QuantileSketch.decode(sketch)
+        return stats
@@ -0,0 +1,233 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import os
+import stat
+import time
+import utilities
+from config import Config
+""" Low overhead sampler of /proc counters for running tests.
+
+ProcSampler opens /proc/stat, /proc/diskstats and the stat and io files
+of every watched pid once and re-reads them with utilities.pread on every
+sample, so a sample costs one read per file and no open or close.
+Only the fields that are used are parsed:
+
+    /proc/stat              first line, total cpu jiffies.
+    /proc/meminfo           MemTotal, read once.
+    /proc/<pid>/stat        utime + stime and vsize.
+    /proc/<pid>/io          read_bytes and write_bytes (storage I/O).
+    /proc/diskstats         sectors read and written and time spent doing
+                            I/O for the watched devices.
+
+Devices are block devices as block_device_of_path() resolves them.
+btrfs, overlayfs and other filesystems report an anonymous device
+(major 0) in st_dev that /proc/diskstats does not list, so their backing
+device is found through /proc/self/mountinfo.
+
+sample() returns the changes since the previous sample: cpu as a share
+of all cpu time and mem as a share of total memory per pid, I/O bytes per
+pid, and bytes and busy share summed over the devices and per device. A
+pid that exits is dropped. Intervals are only limited by the cost of a
+sample, see samplerbenchmark.py.
+
+Example:
+    sampler = ProcSampler([os.getpid()])
+    while True:
+        time.sleep(0.25)
+        stats = sampler.sample()
+        print stats['cpu'], stats['disk_write_bytes'], stats['disk_busy']
+"""
+
+LINUX_DISK_STATS_LOCATION = '/proc/diskstats'
+LINUX_PROCESS_IO_LOCATION = '/proc/%d/io'
+LINUX_MOUNT_INFO_LOCATION = '/proc/self/mountinfo'
+SYS_DEV_BLOCK_LOCATION = '/sys/dev/block/{}:{}'
+PROC_READ_SIZE = 4096
+DISK_STATS_READ_SIZE = 65536
+SECTOR_BYTES = 512
+
+
+def device_of_path(path):
+    """ Returns (major, minor) of the device holding path, as st_dev reports it. """
+    device = os.stat(path).st_dev
+    return os.major(device), os.minor(device)
+
+
+def block_device_of_path(path):
+    """ Returns (major, minor) of the block device backing the filesystem holding path, None if
+        it cannot be found. st_dev is used when it is a block device, otherwise the mount's
+        entry in /proc/self/mountinfo: its source if that is a block device (btrfs) or the
+        device of its upperdir (overlayfs).
+    """
+    major, minor = device_of_path(path)
+    if os.path.exists(SYS_DEV_BLOCK_LOCATION.format(major, minor)):
+        return major, minor
+    try:
+        with open(LINUX_MOUNT_INFO_LOCATION, 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    device = '{}:{}'.format(major, minor)
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3 or fields[2] != device or ' - ' not in line:
+            continue
+        source_fields = line.split(' - ', 1)[1].split()
+        if len(source_fields) > 1 and source_fields[1].startswith('/dev/'):
+            try:
+                source = os.stat(source_fields[1])
+            except OSError:
+                source = None
+            if source is not None and stat.S_ISBLK(source.st_mode):
+                return os.major(source.st_rdev), os.minor(source.st_rdev)
+        for option in (source_fields[2] if len(source_fields) > 2 else '').split(','):
+            if option.startswith('upperdir='):
+                upper = option[len('upperdir='):]
+                try:
+                    if device_of_path(upper) != (major, minor):
+                        return block_device_of_path(upper)
+                except OSError:
+                    pass
+    return None
+
+
+class ProcSampler(object):
+    """ Opens the proc files for pids and devices.
+
+        Args:
+            pids (list[int]): processes to watch.
+            devices (optional[list[tuple]]): (major, minor) of block devices to watch,
+                defaults to the device backing Config.TEST_LOG_DIR.
+    """
+    def __init__(self, pids, devices=None):
+        if devices is None:
+            utilities.verify_dir_exists(Config.TEST_LOG_DIR)
+            devices = [device for device in [block_device_of_path(Config.TEST_LOG_DIR)] if device]
+        self.devices = set((str(major), str(minor)) for major, minor in devices)
+        self.stat_fd = os.open(utilities.LINUX_STAT_LOCATION, os.O_RDONLY)
+        self.disk_fd = self.open_optional(LINUX_DISK_STATS_LOCATION)
+        self.mem_total = (utilities.get_total_memory() or 0)
+        self.pid_fds = {}
+        self.last = None
+        for pid in pids:
+            self.add_pid(pid)
+        self.last = self.read()
+
+    @staticmethod
+    def open_optional(location):
+        try:
+            return os.open(location, os.O_RDONLY)
+        except OSError:
+            return None
+
+    def add_pid(self, pid):
+        """ Starts watching pid. Its first sample covers the time since it was added. """
+        if pid in self.pid_fds:
+            return
+        stat_fd = os.open(utilities.LINUX_PROCESS_STAT_LOCATION % pid, os.O_RDONLY)
+        io_fd = self.open_optional(LINUX_PROCESS_IO_LOCATION % pid)
+        self.pid_fds[pid] = (stat_fd, io_fd)
+        if self.last is not None:
+            self.last['pids'][pid] = self.read_pid_stat(stat_fd) + self.read_pid_io(io_fd)
+
+    def remove_pid(self, pid):
+        for fd in self.pid_fds.pop(pid, ()):
+            if fd is not None:
+                os.close(fd)
+
+    def read_cpu_total(self):
+        data = utilities.pread(self.stat_fd, PROC_READ_SIZE)
+        return sum(int(field) for field in data[:data.index('\n')].split()[1:])
+
+    @staticmethod
+    def read_pid_stat(stat_fd):
+        """ Return:
+                (int, int): cpu jiffies (utime + stime) and virtual memory in bytes.
+        """
+        data = utilities.pread(stat_fd, PROC_READ_SIZE)
+        # comm may contain spaces, the fields after it start two bytes past the closing paren
+        fields = data[data.rindex(')') + 2:].split(' ', 22)
+        return int(fields[11]) + int(fields[12]), int(fields[20])
+
+    @staticmethod
+    def read_pid_io(io_fd):
+        """ Return:
+                (int, int): bytes the process caused to be read from and written to storage.
+        """
+        if io_fd is None:
+            return 0, 0
+        read_bytes = write_bytes = 0
+        for line in utilities.pread(io_fd, PROC_READ_SIZE).splitlines():
+            if line.startswith('read_bytes:'):
+                read_bytes = int(line[11:])
+            elif line.startswith('write_bytes:'):
+                write_bytes = int(line[12:])
+        return read_bytes, write_bytes
+
+    def read_disk(self):
+        """ Return:
+                dict: (major, minor) strings mapped to sectors read, sectors written and ms doing I/O.
+        """
+        devices = {}
+        if self.disk_fd is None or not self.devices:
+            return devices
+        for line in utilities.pread(self.disk_fd, DISK_STATS_READ_SIZE).splitlines():
+            fields = line.split(None, 2)
+            device = (fields[0], fields[1])
+            if device in self.devices:
+                fields = line.split()
+                devices[device] = (int(fields[5]), int(fields[9]), int(fields[12]))
+        return devices
+
+    def read(self):
+        """ Return:
+                dict: raw counters of every file, keyed like sample().
+        """
+        pids = {}
+        for pid, (stat_fd, io_fd) in self.pid_fds.items():
+            try:
+                pids[pid] = self.read_pid_stat(stat_fd) + self.read_pid_io(io_fd)
+            except (OSError, IOError, ValueError, IndexError):
+                self.remove_pid(pid)
+        return dict(time=time.time(), cpu_total=self.read_cpu_total(), pids=pids, disk=self.read_disk())
+
+    def sample(self):
+        """ Reads every counter and returns the changes since the previous sample.
+
+            Return:
+                dict: time, cpu, mem, read_bytes, write_bytes (dicts keyed by pid),
+                      disk_read_bytes, disk_write_bytes and disk_busy (share of the interval) of
+                      all devices and devices, (major, minor) mapped to the three of each device.
+        """
+        last, current = self.last, self.read()
+        self.last = current
+        cpu_elapsed = current['cpu_total'] - last['cpu_total']
+        interval_ms = (current['time'] - last['time']) * 1000
+        cpu, mem, read_bytes, write_bytes = {}, {}, {}, {}
+        for pid, (jiffies, vsize, pid_read, pid_write) in current['pids'].iteritems():
+            last_jiffies, _, last_read, last_write = last['pids'].get(pid, (0, 0, 0, 0))
+            cpu[pid] = (jiffies - last_jiffies) / cpu_elapsed if cpu_elapsed > 0 else 0
+            mem[pid] = vsize / self.mem_total if self.mem_total else 0
+            read_bytes[pid] = pid_read - last_read
+            write_bytes[pid] = pid_write - last_write
+        devices = {}
+        total = [0, 0, 0]
+        for device, counters in current['disk'].iteritems():
+            disk = [now - before for now, before in zip(counters, last['disk'].get(device, counters))]
+            total = [summed + delta for summed, delta in zip(total, disk)]
+            devices[(int(device[0]), int(device[1]))] = (
+                disk[0] * SECTOR_BYTES, disk[1] * SECTOR_BYTES,
+                min(disk[2] / interval_ms, 1) if interval_ms > 0 else 0)
+        return dict(time=current['time'], cpu=cpu, mem=mem, read_bytes=read_bytes, write_bytes=write_bytes,
+                    disk_read_bytes=total[0] * SECTOR_BYTES,
+                    disk_write_bytes=total[1] * SECTOR_BYTES,
+                    disk_busy=min(total[2] / interval_ms, 1) if interval_ms > 0 else 0,
+                    devices=devices)
+
+    def close(self):
+        for pid in self.pid_fds.keys():
+            self.remove_pid(pid)
+        for fd in (self.stat_fd, self.disk_fd):
+            if fd is not None:
+                os.close(fd)
+        self.stat_fd = self.disk_fd = None
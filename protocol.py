@@ -0,0 +1,254 @@
+__author__ = 'Tristan Storz'
+import asynchat
+import struct
+from config import Config
+""" Message framing shared by TestServer, TestClient and running tests.
+
+Two framings are supported on the wire:
+
+Text (version 0): header::field::field|| as used by every client before
+binary framing existed. Fields are strings and a field containing the
+delimiter or terminator breaks the message. Stats keep their labelled
+text layout (stats::CPU::cpu::MEM::mem::...) for old servers, decode_text
+strips the labels so handlers always see cpu, mem, ...
+
+Binary (version 1): every frame starts with a 5 byte header holding the
+body length (uint32, network order) and a message type byte. The body is
+a field count byte, one tag per field ('d' double, 'q' int64, 'n' None,
+'s' string), the numbers and string lengths packed with one struct and
+then the raw string bytes. Any payload is safe and numbers are struct
+packed instead of sent as str(float). The struct for each tag signature
+is cached, so a frame is decoded with a single unpack_from. Message
+types missing from MESSAGE_TYPES are sent with type 0 and their header
+as the first field.
+
+Connections always start in text. The client offers binary framing in
+its start message (start::binary::1||) and the server answers with
+protocol::1|| before switching its output to binary. When the client
+reads the answer it sends protocol::1|| as its last text message and
+switches its output as well. Old servers never answer, so the client
+keeps text framing once its id request comes back. Old clients never
+offer, so the server keeps text framing for them.
+
+Tests always write binary frames to their MessageChannel. TestClient
+decodes them with a FrameReader and re-sends them in whatever framing
+was negotiated with the server.
+
+Example:
+    frame = encode(Config.API_TEST_STATS, 0.25, 0.01, 1431000000.5)
+    reader = FrameReader()
+    for header, fields in reader.feed(frame):
+        print header, fields
+"""
+
+PROTOCOL_VERSION = 1
+
+FRAME_HEADER = struct.Struct('!IB')
+FIELD_FORMATS = {'d': 'd', 'q': 'q', 's': 'I', 'n': ''}
+MAX_FIELDS = 255
+
+TYPE_NAMED = 0
+MESSAGE_TYPES = {Config.API_CLIENT_START: 1,
+                 Config.API_CLIENT_END: 2,
+                 Config.API_ID_REQUEST: 3,
+                 Config.API_TEST_REQUEST: 4,
+                 Config.API_SYSTEM_INFO: 5,
+                 Config.API_BAD_TIMEOUT: 6,
+                 Config.API_RUNNING_TEST: 7,
+                 Config.API_HEARTBEAT: 8,
+                 Config.API_TEST_STATS: 9,
+                 Config.API_TEST_FILE_WRITE: 10,
+                 Config.API_PROTOCOL: 11,
+                 Config.API_TEST_LATENCY: 12,
+                 Config.API_TEST_RESULT: 13,
+                 Config.API_HOST: 14,
+                 Config.API_TEST_TARGET: 15,
+                 Config.API_TEST_TARGET_STATS: 16}
+MESSAGE_HEADERS = dict((message_type, header) for header, message_type in MESSAGE_TYPES.iteritems())
+
+
+class ProtocolError(Exception):
+    pass
+
+
+_field_structs = {}
+
+
+def field_struct(tags):
+    """ Returns the cached struct packing the numbers and string lengths for tags. """
+    packer = _field_structs.get(tags)
+    if packer is None:
+        packer = struct.Struct('!' + ''.join(FIELD_FORMATS[tag] for tag in tags))
+        _field_structs[tags] = packer
+    return packer
+
+
+def encode(header, *fields):
+    """ Returns a binary frame for header and fields. """
+    message_type = MESSAGE_TYPES.get(header, TYPE_NAMED)
+    if message_type == TYPE_NAMED:
+        fields = (header,) + fields
+    if len(fields) > MAX_FIELDS:
+        raise ProtocolError('too many fields ({})'.format(len(fields)))
+    tags = []
+    values = []
+    strings = []
+    for field in fields:
+        if isinstance(field, float):
+            tags.append('d')
+            values.append(field)
+        elif isinstance(field, (int, long)):
+            tags.append('q')
+            values.append(field)
+        elif field is None:
+            tags.append('n')
+        else:
+            if isinstance(field, unicode):
+                field = field.encode('utf-8')
+            else:
+                field = str(field)
+            tags.append('s')
+            values.append(len(field))
+            strings.append(field)
+    tags = ''.join(tags)
+    body = chr(len(tags)) + tags + field_struct(tags).pack(*values) + ''.join(strings)
+    return FRAME_HEADER.pack(len(body), message_type) + body
+
+
+def decode_body(message_type, body):
+    """ Returns (header, fields) for the body of one binary frame. """
+    try:
+        count = ord(body[0])
+        tags = body[1:1 + count]
+        packer = field_struct(tags)
+        offset = 1 + count
+        values = packer.unpack_from(body, offset)
+    except (IndexError, KeyError, struct.error) as e:
+        raise ProtocolError('malformed frame: {!r}'.format(e))
+    if 's' in tags or 'n' in tags:
+        offset += packer.size
+        fields = []
+        value = iter(values)
+        for tag in tags:
+            if tag == 's':
+                length = next(value)
+                fields.append(body[offset:offset + length])
+                offset += length
+            elif tag == 'n':
+                fields.append(None)
+            else:
+                fields.append(next(value))
+    else:
+        fields = list(values)
+    if message_type == TYPE_NAMED:
+        return fields[0], fields[1:]
+    return MESSAGE_HEADERS.get(message_type, str(message_type)), fields
+
+
+def text_field(field):
+    if isinstance(field, float):
+        return repr(field)
+    if isinstance(field, unicode):
+        return field.encode('utf-8')
+    return str(field)
+
+
+def encode_text(header, *fields):
+    """ Returns a text message for header and fields. """
+    if header == Config.API_TEST_STATS and len(fields) > 1:
+        fields = ('CPU', fields[0], 'MEM', fields[1]) + fields[2:]
+    return Config.API_DELIMITER.join([header] + [text_field(field) for field in fields]) + Config.TERMINATOR
+
+
+def decode_text(data):
+    """ Returns (header, fields) for one text message without its terminator. """
+    message = data.split(Config.API_DELIMITER)
+    if message[0] == Config.API_TEST_STATS and len(message) > 4 and message[1] == 'CPU':
+        return message[0], [message[2], message[4]] + message[5:]
+    return message[0], message[1:]
+
+
+class FrameReader(object):
+    """ Splits a byte stream into binary frames. Partial frames are kept until
+        the rest of the frame arrives.
+    """
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        """ Adds data and returns [(header, fields)] for every complete frame. """
+        if self.buffer:
+            data = self.buffer + data
+        messages = []
+        offset = 0
+        available = len(data)
+        header_size = FRAME_HEADER.size
+        while available - offset >= header_size:
+            length, message_type = FRAME_HEADER.unpack_from(data, offset)
+            frame_end = offset + header_size + length
+            if frame_end > available:
+                break
+            messages.append(decode_body(message_type, data[offset + header_size:frame_end]))
+            offset = frame_end
+        self.buffer = data[offset:]
+        return messages
+
+
+class MessageChat(asynchat.async_chat):
+    """ async_chat that sends and receives messages in text or binary framing.
+
+        Subclasses implement handle_message(header, fields). Messages are sent
+        with send_message(header, *fields) which uses the framing currently
+        negotiated for output.
+
+        Reading stops while more than Config.CHANNEL_HIGH_WATER bytes wait to be
+        sent, so a peer that does not read cannot make its output grow without
+        bound.
+
+        Args:
+            sock (optional[socket]): connected socket, None for outgoing connections.
+            map (optional[dict]): asyncore socket map, asyncore.socket_map if None.
+    """
+    def __init__(self, sock=None, map=None):
+        asynchat.async_chat.__init__(self, sock=sock, map=map)
+        self.set_terminator(Config.TERMINATOR)
+        self.incoming = []
+        self.frame_reader = None
+        self.binary_in = False
+        self.binary_out = False
+
+    def readable(self):
+        if self.producer_fifo and sum(len(data) for data in self.producer_fifo if data) > Config.CHANNEL_HIGH_WATER:
+            return False
+        return asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        """ Buffers text until its terminator, decodes binary frames as they complete. """
+        if self.binary_in:
+            for header, fields in self.frame_reader.feed(data):
+                self.handle_message(header, fields)
+        else:
+            self.incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        del self.incoming[:]
+        header, fields = decode_text(data)
+        self.handle_message(header, fields)
+
+    def send_message(self, header, *fields):
+        if self.binary_out:
+            self.push(encode(header, *fields))
+        else:
+            self.push(encode_text(header, *fields))
+
+    def start_binary_input(self):
+        """ Treats everything after the current text message as binary frames. """
+        self.binary_in = True
+        self.frame_reader = FrameReader()
+        self.set_terminator(None)
+
+    def handle_message(self, header, fields):
+        raise NotImplementedError
@@ -0,0 +1,121 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import asynchat
+import os
+import time
+import protocol
+from config import Config
+""" Parser benchmark for the server side of the wire protocol.
+
+Feeds the same stream of messages through three parsers on one core and
+reports messages/sec for each:
+
+    legacy text  the asynchat parser ClientAPI used before protocol.py,
+                 which splits every message and rebuilds client_message.
+    text         protocol.MessageChat in text framing.
+    binary       protocol.MessageChat in binary framing.
+
+The stream is a client mix of stats, file rollovers and heartbeats read
+from the socket in Config.CHANNEL_READ_SIZE chunks. Only cpu time of this
+process is counted, so the numbers are per core.
+
+Example:
+    python protocolbenchmark.py -n 200000
+"""
+
+
+def build_messages(count):
+    """ Returns count (header, fields) tuples in the ratio a FileWriteTest sends them. """
+    now = time.time()
+    mix = [(Config.API_TEST_FILE_WRITE, (now,)),
+           (Config.API_TEST_FILE_WRITE, (now,)),
+           (Config.API_TEST_STATS, (0.3125, 0.0028, now)),
+           (Config.API_TEST_FILE_WRITE, (now,)),
+           (Config.API_HEARTBEAT, (now,))]
+    return [mix[i % len(mix)] for i in xrange(count)]
+
+
+def chunk(stream):
+    return [stream[i:i + Config.CHANNEL_READ_SIZE] for i in xrange(0, len(stream), Config.CHANNEL_READ_SIZE)]
+
+
+class LegacyTextParser(asynchat.async_chat):
+    """ ClientAPI's parser before protocol.py, kept here as the baseline. """
+    def __init__(self, chunks):
+        asynchat.async_chat.__init__(self)
+        self.set_terminator(Config.TERMINATOR)
+        self.chunks = chunks
+        self.client_header = None
+        self.client_message = []
+        self.handled = 0
+        self.message_handler = dict((header, self.handle) for header in protocol.MESSAGE_TYPES)
+
+    def recv(self, buffer_size):
+        return self.chunks.pop()
+
+    def collect_incoming_data(self, data):
+        del self.client_message[:]
+        message = data.split(Config.API_DELIMITER)
+        self.client_header = message[0]
+        for msg in message[1:]:
+            self.client_message.append(msg)
+
+    def found_terminator(self):
+        self.message_handler.get(self.client_header, self.handle)()
+
+    def handle(self):
+        self.handled += 1
+
+
+class BenchmarkChat(protocol.MessageChat):
+    """ MessageChat reading from prepared chunks instead of a socket. """
+    def __init__(self, chunks, binary):
+        protocol.MessageChat.__init__(self)
+        self.chunks = chunks
+        self.handled = 0
+        if binary:
+            self.start_binary_input()
+
+    def recv(self, buffer_size):
+        return self.chunks.pop()
+
+    def handle_message(self, header, fields):
+        self.handled += 1
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_parser(parser, chunks):
+    """ Return:
+            (int, float): messages handled and cpu seconds spent.
+    """
+    parser.chunks = list(reversed(chunks))
+    start = cpu_time()
+    while parser.chunks:
+        parser.handle_read()
+    return parser.handled, cpu_time() - start
+
+
+def main(count):
+    messages = build_messages(count)
+    text_chunks = chunk(''.join(protocol.encode_text(header, *fields) for header, fields in messages))
+    binary_chunks = chunk(''.join(protocol.encode(header, *fields) for header, fields in messages))
+
+    results = [('legacy text', len(text_chunks)) + run_parser(LegacyTextParser([]), text_chunks),
+               ('text', len(text_chunks)) + run_parser(BenchmarkChat([], False), text_chunks),
+               ('binary', len(binary_chunks)) + run_parser(BenchmarkChat([], True), binary_chunks)]
+
+    print '{:<12} {:>10} {:>10} {:>10} {:>14}'.format('parser', 'reads', 'messages', 'cpu sec', 'messages/sec')
+    for name, reads, handled, seconds in results:
+        print '{:<12} {:>10} {:>10} {:>10.3f} {:>14.0f}'.format(name, reads, handled, seconds, handled / seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', dest='messages', default=200000, type=int,
+                        help='messages per parser')
+    main(parser.parse_args().messages)
@@ -0,0 +1,85 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import multiprocessing
+import os
+import time
+import utilities
+from procsampler import ProcSampler
+""" Overhead benchmark for the stats sampler of running tests.
+
+Takes the same number of samples with two samplers and reports cpu time
+per sample, which is what sampling costs the machine under test:
+
+    legacy   the utilities calls gather_stats made before procsampler.py,
+             which open, read and split /proc/stat, /proc/meminfo and
+             /proc/<pid>/stat twice per pid on every sample.
+    sampler  ProcSampler.sample(), which also reads /proc/<pid>/io and
+             /proc/diskstats.
+
+pids idle child processes are watched together with the benchmark itself.
+The cost per sample bounds how short stats_interval can be, e.g. 100 us
+per sample is 0.1% of a core at 10 samples per second.
+
+Example:
+    python samplerbenchmark.py -n 20000 -p 4
+"""
+
+
+def idle(stop):
+    stop.wait()
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def legacy_sample(pids):
+    cpu = sum(utilities.get_cpu_clock_cycles_of_pid(pid) or 0 for pid in pids)
+    total = utilities.get_total_cpu_clock_cycles()
+    mem_total = utilities.get_total_memory()
+    mem = sum(utilities.get_memory_of_pid(pid) or 0 for pid in pids)
+    return cpu, total, mem_total, mem
+
+
+def run_sampler(sample, count):
+    """ Return:
+            (float, float): cpu and wall seconds for count samples.
+    """
+    start_cpu, start_wall = cpu_time(), time.time()
+    for _ in xrange(count):
+        sample()
+    return cpu_time() - start_cpu, time.time() - start_wall
+
+
+def main(count, pids):
+    stop = multiprocessing.Event()
+    children = [multiprocessing.Process(target=idle, args=(stop,)) for _ in xrange(pids)]
+    for child in children:
+        child.start()
+    watched = [os.getpid()] + [child.pid for child in children]
+    sampler = ProcSampler(watched)
+    try:
+        results = [('legacy',) + run_sampler(lambda: legacy_sample(watched), count),
+                   ('sampler',) + run_sampler(sampler.sample, count)]
+    finally:
+        sampler.close()
+        stop.set()
+        for child in children:
+            child.join()
+
+    print '{} samples, {} pids'.format(count, len(watched))
+    print '{:<10} {:>14} {:>14}'.format('sampler', 'cpu us/sample', 'wall us/sample')
+    for name, cpu_seconds, wall_seconds in results:
+        print '{:<10} {:>14.1f} {:>14.1f}'.format(name, cpu_seconds / count * 1e6, wall_seconds / count * 1e6)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--samples', dest='samples', default=20000, type=int,
+                        help='samples per sampler')
+    parser.add_argument('-p', '--pids', dest='pids', default=2, type=int,
+                        help='idle child processes to watch besides this process')
+    cmd_input = parser.parse_args()
+    main(cmd_input.samples, cmd_input.pids)
@@ -0,0 +1,227 @@
+__author__ = 'Tristan Storz'
+import collections
+import heapq
+import itertools
+from config import Config
+""" Test scheduler of TestServer, replacing a FIFO Queue of TestRequests.
+
+Tests are put with a priority and constraints on the host of the client
+that may run them. Constraints map a key of the host info (see
+hostinfo.py, nested keys joined with '.', e.g. 'device.rotational') or
+'host_id' to a value, or to a list or tuple of allowed values. Host
+affinity is a constraint on 'hostname' or 'host_id'.
+
+Tests with the same constraints form a class with its own heap ordered by
+priority (higher first), then by the order they were put. A dispatch
+looks at the top of every class whose constraints the client's host
+matches, so it costs O(classes + log n). Matches are cached per host, and
+a class is dropped once its heap is empty, so 100k queued tests in a
+handful of classes dispatch in microseconds.
+
+Running tests are counted per host and per test device (host_id, major
+and minor number of the device holding the client's test directory).
+While a host or device is at its limit, clients that could run a test
+wait: wait() keeps a retry callback per host, and release() of a test on
+that host calls the callbacks in order until one is still blocked. Tests
+whose client aborted or timed out are put back in their place up to
+max_requeues times.
+
+Sources, like a parameter sweep (see sweep.py), add tests lazily. Their
+expand() is asked for more tests on every dispatch and release, and
+their record() gets the write speed of every test that ended. While a
+source is not done, clients without a test wait for it instead of
+leaving.
+
+Example:
+    tests = Scheduler(device_limit=1)
+    tests.put(TestRequest('file_write', timeout=10), priority=5, constraints={'device.rotational': True})
+    tests.put(TestRequest('random_io', timeout=10), constraints={'hostname': ('db1', 'db2')})
+    ticket, blocked = tests.get(host_id, host_info)
+"""
+
+Ticket = collections.namedtuple('Ticket', ['request', 'priority', 'sequence', 'constraints', 'attempts', 'source'])
+
+
+def constraint_key(constraints):
+    """ Returns constraints as a sorted tuple of items, list values become tuples of allowed values. """
+    return tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                        for name, value in (constraints or {}).iteritems()))
+
+
+def host_value(info, key):
+    """ Returns the value of a dotted key in info, None if a part of it is missing. """
+    value = info
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def device_of(host_id, info):
+    device = info.get('device') or {}
+    return host_id, device.get('major'), device.get('minor')
+
+
+class ConstraintClass(object):
+    """ Tests sharing one set of constraints, in a heap of (-priority, sequence, ticket). """
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self.heap = []
+
+    def matches(self, host_id, info):
+        for key, allowed in self.constraints:
+            value = host_id if key == 'host_id' else host_value(info, key)
+            if isinstance(allowed, tuple):
+                if value not in allowed:
+                    return False
+            elif value != allowed:
+                return False
+        return True
+
+
+class Scheduler(object):
+    """ Priority queue of tests with host constraints and concurrency limits.
+
+        Args:
+            host_limit (optional[int]): running tests per host, None for no limit.
+            device_limit (optional[int]): running tests per test device, None for no limit.
+            max_requeues (optional[int]): times a test is put back after its client aborted.
+    """
+    def __init__(self, host_limit=Config.SCHEDULER_HOST_LIMIT, device_limit=Config.SCHEDULER_DEVICE_LIMIT,
+                 max_requeues=Config.SCHEDULER_MAX_REQUEUES):
+        self.host_limit = host_limit
+        self.device_limit = device_limit
+        self.max_requeues = max_requeues
+        self.classes = {}
+        self.matches = {}
+        self.sequence = itertools.count()
+        self.queued = 0
+        self.running = collections.Counter()
+        self.devices = {}
+        self.waiters = {}
+        self.sources = []
+
+    def __len__(self):
+        return self.queued
+
+    def empty(self):
+        return not self.queued
+
+    def put(self, request, priority=0, constraints=None):
+        """ Queues a TestRequest. constraints values that are lists are turned into tuples of
+            allowed values.
+        """
+        self.push(Ticket(request, priority, next(self.sequence), constraint_key(constraints), 0, None))
+
+    def add_source(self, source):
+        """ Adds a source of tests with expand(), record(request, result), done(), priority and
+            constraints attributes.
+        """
+        self.sources.append(source)
+        self.refill()
+
+    def refill(self):
+        """ Queues the tests sources have ready. Returns True if any was added. """
+        added = False
+        for source in self.sources:
+            key = constraint_key(source.constraints)
+            for request in source.expand():
+                self.push(Ticket(request, source.priority, next(self.sequence), key, 0, source))
+                added = True
+        return added
+
+    def sources_done(self):
+        return all(source.done() for source in self.sources)
+
+    def push(self, ticket):
+        test_class = self.classes.get(ticket.constraints)
+        if test_class is None:
+            test_class = self.classes[ticket.constraints] = ConstraintClass(ticket.constraints)
+        heapq.heappush(test_class.heap, (-ticket.priority, ticket.sequence, ticket))
+        self.queued += 1
+
+    def matching(self, host_id, info):
+        """ Returns the classes whose constraints host_id matches, computed once per host and class. """
+        cache = self.matches.setdefault(host_id, {})
+        found = []
+        for key, test_class in self.classes.iteritems():
+            matched = cache.get(key)
+            if matched is None:
+                matched = cache[key] = test_class.matches(host_id, info)
+            if matched:
+                found.append(test_class)
+        return found
+
+    def at_limit(self, host_id, info):
+        if self.host_limit is not None and self.running[host_id] >= self.host_limit:
+            return True
+        return self.device_limit is not None and self.running[device_of(host_id, info)] >= self.device_limit
+
+    def get(self, host_id, info):
+        """ Takes the highest priority test that host_id may run.
+
+            Args:
+                host_id (int): host of the client, None if unknown.
+                info (dict): decoded host info of the client, empty if unknown.
+
+            Return:
+                (Ticket, bool): the test, or None and True if a matching test is queued but the
+                                host or its device is at its limit, or a source may add more.
+        """
+        if self.sources:
+            self.refill()
+        candidates = self.matching(host_id, info)
+        if not candidates:
+            return None, not self.sources_done()
+        if self.at_limit(host_id, info):
+            return None, True
+        best = min(candidates, key=lambda test_class: test_class.heap[0][:2])
+        ticket = heapq.heappop(best.heap)[2]
+        if not best.heap:
+            del self.classes[best.constraints]
+        self.queued -= 1
+        device = device_of(host_id, info)
+        self.running[host_id] += 1
+        self.running[device] += 1
+        self.devices[ticket] = (host_id, device)
+        return ticket, False
+
+    def wait(self, host_id, retry):
+        """ Calls retry() when a test on host_id ends. retry returns False while still blocked. """
+        self.waiters.setdefault(host_id, collections.deque()).append(retry)
+
+    def release(self, ticket, requeue=False, result=None):
+        """ Ends a dispatched test, puts it back if requeue and it has requeues left. Then lets
+            clients waiting on the host retry, or every waiting client if tests were added.
+
+            Args:
+                ticket (Ticket): test returned by get().
+                requeue (bool): True if the client did not complete the test.
+                result (float): write speed of a completed test, passed on to its source.
+        """
+        host_id, device = self.devices.pop(ticket)
+        self.running[host_id] -= 1
+        self.running[device] -= 1
+        changed = False
+        if requeue and ticket.attempts < self.max_requeues:
+            self.push(ticket._replace(attempts=ticket.attempts + 1))
+            changed = True
+        elif ticket.source is not None:
+            ticket.source.record(ticket.request, None if requeue else result)
+            changed = self.refill() or ticket.source.done()
+        if changed:
+            for waiting_host in self.waiters.keys():
+                self.wake(waiting_host)
+        else:
+            self.wake(host_id)
+
+    def wake(self, host_id):
+        """ Calls the retry callbacks of host_id in order until one is still blocked. """
+        waiters = self.waiters.get(host_id)
+        while waiters:
+            if not waiters[0]():
+                break
+            waiters.popleft()
+        if waiters is not None and not waiters:
+            del self.waiters[host_id]
@@ -0,0 +1,251 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import multiprocessing
+import os
+import resource
+import select
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+import protocol
+import serverengine
+import testserver
+from histogram import LogHistogram
+from loggers import server_log
+from config import Config
+from protocolbenchmark import build_messages
+""" Load benchmark of the TestServer engines.
+
+For every engine and client count a TestServer runs in its own process
+and a load process connects the simulated clients. Once all of them are
+connected, every client sends start, test start, messages stats, rollover
+and heartbeat messages and end in text framing, then waits for the server
+to close it. The server's db is written to a temporary directory, logging
+is turned off for the run so it does not dominate the handler times.
+Reported per run:
+
+    connected  connections the server accepted and peak open clients.
+    msgs/sec   messages handled between the first and the last message.
+    p99 us     99th percentile of ClientAPI.handle_message time.
+
+asyncore's select() cannot watch fds above 1024, so at 10k clients its run
+ends with an error, reported in the last column.
+
+Example:
+    python serverbenchmark.py -c 1000 10000 -m 20
+"""
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def read_rss(pid='self'):
+    """ Return:
+            (int, int): current and peak resident memory of pid in KB, None if unknown.
+    """
+    rss = peak = None
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return rss, peak
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((Config.HOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class BenchmarkClientAPI(testserver.ClientAPI):
+    """ ClientAPI that records the time of every message handler in the server's histogram. """
+    def __init__(self, server, *args):
+        testserver.ClientAPI.__init__(self, *args)
+        self.server = server
+
+    def handle_message(self, header, fields):
+        start = time.time()
+        testserver.ClientAPI.handle_message(self, header, fields)
+        end = time.time()
+        self.server.handler_latency.record((end - start) * Config.MICRO_SECONDS_PER_SECOND)
+        if self.server.first_message is None:
+            self.server.first_message = start
+        self.server.last_message = end
+
+
+class BenchmarkServer(testserver.TestServer):
+    """ TestServer that runs until clients connections were made and closed, or timeout passes. """
+    def __init__(self, port, engine, clients, timeout, ready):
+        testserver.TestServer.__init__(self, Config.HOST, port, live_port=None, engine=engine)
+        self.clients = clients
+        self.deadline = time.time() + timeout
+        self.ready = ready
+        self.handler_latency = LogHistogram()
+        self.first_message = None
+        self.last_message = None
+        self.first_accept = None
+        self.last_accept = None
+        self.peak_clients = 0
+
+    def setup(self):
+        result = testserver.TestServer.setup(self)
+        self.ready.set()
+        return result
+
+    def create_client(self, sock):
+        client = BenchmarkClientAPI(self, sock, uuid.uuid4(), self.scheduler, self.db_writer, self.last_run_id,
+                                    self.hosts, self.live, self.engine.socket_map)
+        self.peak_clients = max(self.peak_clients, len(self.live.clients))
+        self.last_accept = time.time()
+        if self.first_accept is None:
+            self.first_accept = self.last_accept
+        return client
+
+    def check_for_exit(self):
+        if time.time() > self.deadline:
+            return False
+        return self.connections_total < self.clients or bool(self.live.clients)
+
+
+def serve(port, engine, clients, timeout, ready, results):
+    """ Runs a BenchmarkServer in the current directory and puts its results on results. """
+    raise_file_limit()
+    server_log.disabled = True
+    server = BenchmarkServer(port, engine, clients, timeout, ready)
+    error = None
+    try:
+        server.run()
+    except Exception as e:
+        error = repr(e)
+    finally:
+        try:
+            server.end()
+        except Exception as e:
+            error = error or repr(e)
+    elapsed = (server.last_message - server.first_message) if server.first_message else 0
+    accepting = (server.last_accept - server.first_accept) if server.first_accept else 0
+    rss, peak_rss = read_rss()
+    results.put(dict(connections=server.connections_total, peak=server.peak_clients,
+                     accepts_per_sec=server.connections_total / accepting if accepting else None,
+                     messages=server.live.messages, seconds=elapsed,
+                     p50=server.handler_latency.percentile(50), p90=server.handler_latency.percentile(90),
+                     p99=server.handler_latency.percentile(99), p999=server.handler_latency.percentile(99.9),
+                     max=server.handler_latency.max, rss_kb=rss, peak_rss_kb=peak_rss, error=error))
+
+
+def build_payload(messages):
+    """ Returns the text framed bytes one simulated client sends. """
+    payload = [protocol.encode_text(Config.API_CLIENT_START),
+               protocol.encode_text(Config.API_RUNNING_TEST, Config.TEST_FILE_WRITE_NAME,
+                                    "{'timeout': 10, 'file_size': 1}")]
+    payload.extend(protocol.encode_text(header, *fields) for header, fields in build_messages(messages))
+    payload.append(protocol.encode_text(Config.API_CLIENT_END))
+    return ''.join(payload)
+
+
+def run_clients(port, clients, messages, timeout):
+    """ Connects clients sockets, then sends every payload and waits for the server to close them.
+
+        Return:
+            int: clients that were connected.
+    """
+    payload = build_payload(messages)
+    deadline = time.time() + timeout
+    sockets = []
+    try:
+        for _ in xrange(clients):
+            sockets.append(socket.create_connection((Config.HOST, port), timeout))
+    except socket.error:
+        pass
+    epoll = select.epoll()
+    pending = {}
+    for sock in sockets:
+        sock.setblocking(False)
+        pending[sock.fileno()] = [sock, payload]
+        epoll.register(sock.fileno(), select.EPOLLOUT)
+    while pending and time.time() < deadline:
+        for fd, flags in epoll.poll(1):
+            sock, data = pending[fd]
+            closed = False
+            try:
+                if data and flags & select.EPOLLOUT:
+                    pending[fd][1] = data = data[sock.send(data):]
+                    if not data:
+                        epoll.modify(fd, select.EPOLLIN)
+                elif not sock.recv(Config.CHANNEL_READ_SIZE):
+                    closed = True
+            except socket.error:
+                closed = True
+            if closed:
+                epoll.unregister(fd)
+                sock.close()
+                del pending[fd]
+    for sock, _ in pending.itervalues():
+        sock.close()
+    epoll.close()
+    return len(sockets)
+
+
+def benchmark(engine, clients, messages, timeout):
+    """ Return:
+            dict: server results of one engine at clients simulated clients.
+    """
+    directory = tempfile.mkdtemp(prefix='serverbenchmark')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        port = free_port()
+        ready = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(port, engine, clients, timeout, ready, results))
+        server.start()
+        ready.wait(timeout)
+        connected = run_clients(port, clients, messages, timeout)
+        result = results.get(timeout=timeout + Config.SERVER_DRAIN_TIMEOUT + 30)
+        server.join()
+        result.update(engine=engine, clients=clients, connected=connected)
+        return result
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(engines, client_counts, messages, timeout):
+    raise_file_limit()
+    print '{:<9} {:>7} {:>17} {:>10} {:>11} {:>8} {:>8}  {}'.format('engine', 'clients', 'connected/peak',
+                                                                   'messages', 'msgs/sec', 'p50 us', 'p99 us',
+                                                                   'error')
+    for clients in client_counts:
+        for engine in engines:
+            result = benchmark(engine, clients, messages, timeout)
+            rate = result['messages'] / result['seconds'] if result['seconds'] else 0
+            print '{:<9} {:>7} {:>17} {:>10} {:>11.0f} {:>8} {:>8}  {}'.format(
+                engine, clients, '{}/{}'.format(result['connections'], result['peak']), result['messages'], rate,
+                result['p50'], result['p99'], result['error'] or '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--engines', dest='engines', nargs='+', default=sorted(serverengine.ENGINES),
+                        choices=sorted(serverengine.ENGINES), help='engines to compare')
+    parser.add_argument('-c', '--clients', dest='clients', nargs='+', default=[1000, 10000], type=int,
+                        help='simulated client counts')
+    parser.add_argument('-m', '--messages', dest='messages', default=20, type=int,
+                        help='stats, rollover and heartbeat messages per client')
+    parser.add_argument('-t', '--timeout', dest='timeout', default=120, type=float,
+                        help='max seconds per run')
+    cmd_input = parser.parse_args()
+    main(cmd_input.engines, cmd_input.clients, cmd_input.messages, cmd_input.timeout)
@@ -0,0 +1,202 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import asyncore
+import errno
+import select
+import time
+from config import Config
+""" Event loop engines for TestServer.
+
+An engine owns the socket map that TestServer, ClientAPI and the live
+metrics dispatchers are created with, and steps the loop over it. Both
+engines run the same asyncore dispatchers and message handlers:
+
+    asyncore  asyncore.loop over select(). Every step rebuilds the fd sets
+              of every socket, and select() cannot watch fds above
+              FD_SETSIZE (1024).
+    epoll     EpollMap keeps one epoll registration per socket and only
+              re-reads readable()/writable() of sockets that had events or
+              asked for it with wake(), plus a full rescan every
+              Config.ENGINE_RESCAN_INTERVAL seconds.
+
+With both engines reading from every socket can be paused, which
+TestServer uses to push back on clients while the db writer's queue is
+above its high water mark. Paused sockets still send their output, their
+clients block once the kernel's buffers are full.
+
+drain() runs the loop with reading paused until every socket has sent its
+buffered output or the timeout passes, so messages queued for clients are
+not lost when TestServer ends.
+
+Example:
+    engine = get_engine('epoll')
+    server = SomeDispatcher(map=engine.socket_map)
+    while True:
+        engine.poll(Config.LOOP_TIMEOUT)
+"""
+
+EPOLL_READ = getattr(select, 'EPOLLIN', 0) | getattr(select, 'EPOLLPRI', 0)
+EPOLL_WRITE = getattr(select, 'EPOLLOUT', 0)
+
+
+class AsyncoreEngine(object):
+    """ select() loop of asyncore over a socket map of its own. """
+    name = 'asyncore'
+
+    def __init__(self):
+        self.socket_map = {}
+        self.paused = False
+
+    def poll(self, timeout):
+        if self.paused:
+            self.poll_output(timeout)
+        else:
+            asyncore.loop(timeout=timeout, map=self.socket_map, count=Config.LOOP_COUNT)
+
+    def poll_output(self, timeout):
+        """ One step of asyncore.poll that only watches writable sockets, nothing is read or
+            accepted.
+        """
+        writers = [fd for fd, obj in self.socket_map.items() if not obj.accepting and obj.writable()]
+        if not writers:
+            time.sleep(timeout)
+            return
+        try:
+            _, writers, errors = select.select([], writers, writers, timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in writers:
+            obj = self.socket_map.get(fd)
+            if obj is not None:
+                asyncore.write(obj)
+        for fd in errors:
+            obj = self.socket_map.get(fd)
+            if obj is not None:
+                asyncore._exception(obj)
+
+    def pause_reading(self, paused):
+        """ Stops or resumes reading from every socket, output is still sent. """
+        self.paused = paused
+
+    def pending_output(self):
+        return [obj for obj in self.socket_map.values() if not obj.accepting and obj.writable()]
+
+    def drain(self, timeout):
+        """ Runs the loop until no socket has output left or timeout seconds pass.
+
+            Return:
+                bool: True if all output was sent.
+        """
+        self.pause_reading(True)
+        deadline = time.time() + timeout
+        while self.pending_output():
+            if time.time() >= deadline:
+                return False
+            self.poll(Config.ENGINE_DRAIN_POLL)
+        return True
+
+    def close(self):
+        asyncore.close_all(self.socket_map)
+
+
+class EpollMap(dict):
+    """ asyncore socket map that keeps an epoll object in sync with the sockets added to
+        and removed from it.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.epoll = select.epoll()
+        self.masks = {}
+        self.dirty = set()
+
+    def __setitem__(self, fd, obj):
+        if fd in self.masks:
+            self.epoll.unregister(fd)
+        dict.__setitem__(self, fd, obj)
+        self.epoll.register(fd, 0)
+        self.masks[fd] = 0
+        self.dirty.add(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.masks.pop(fd, None)
+        self.dirty.discard(fd)
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def wake(self, obj):
+        """ Re-reads obj's readable() and writable() before the next poll. """
+        self.dirty.add(obj._fileno)
+
+
+class EpollEngine(AsyncoreEngine):
+    """ epoll loop over an EpollMap. """
+    name = 'epoll'
+
+    def __init__(self):
+        AsyncoreEngine.__init__(self)
+        self.socket_map = EpollMap()
+        self.last_rescan = time.time()
+
+    def refresh(self):
+        """ Updates the epoll masks of the sockets whose state may have changed. """
+        socket_map = self.socket_map
+        now = time.time()
+        if now - self.last_rescan >= Config.ENGINE_RESCAN_INTERVAL:
+            socket_map.dirty.update(socket_map.iterkeys())
+            self.last_rescan = now
+        for fd in socket_map.dirty:
+            obj = socket_map.get(fd)
+            if obj is None:
+                continue
+            mask = 0
+            if not self.paused and obj.readable():
+                mask |= EPOLL_READ
+            if not obj.accepting and obj.writable():
+                mask |= EPOLL_WRITE
+            if mask != socket_map.masks[fd]:
+                socket_map.epoll.modify(fd, mask)
+                socket_map.masks[fd] = mask
+        socket_map.dirty.clear()
+
+    def poll(self, timeout):
+        self.refresh()
+        socket_map = self.socket_map
+        try:
+            events = socket_map.epoll.poll(timeout, Config.ENGINE_MAX_EVENTS)
+        except IOError as e:
+            if e.errno == asyncore.EINTR:
+                return
+            raise
+        for fd, flags in events:
+            obj = socket_map.get(fd)
+            if obj is None:
+                continue
+            asyncore.readwrite(obj, flags)
+            socket_map.dirty.add(fd)
+
+    def pause_reading(self, paused):
+        if paused != self.paused:
+            self.paused = paused
+            self.socket_map.dirty.update(self.socket_map.iterkeys())
+
+    def close(self):
+        AsyncoreEngine.close(self)
+        self.socket_map.epoll.close()
+
+
+ENGINES = {AsyncoreEngine.name: AsyncoreEngine}
+if hasattr(select, 'epoll'):
+    ENGINES[EpollEngine.name] = EpollEngine
+
+
+def get_engine(name):
+    """ Returns a new engine by name, raises ValueError for engines not available here. """
+    try:
+        return ENGINES[name]()
+    except KeyError:
+        raise ValueError('unknown server engine {}, available: {}'.format(name, ', '.join(sorted(ENGINES))))
@@ -0,0 +1,289 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import argparse
+import itertools
+import json
+import math
+import time
+import testregistry
+from launcher import Launcher
+from scheduler import Scheduler
+from testserver import TestServer
+from config import Config
+from loggers import server_log
+""" Parameter sweeps over a registered test, to find the knee of a device's throughput curve.
+
+A sweep spec names a test, lists values per parameter and how often each
+point of the matrix is run. One parameter may be the axis of the curves,
+e.g. workers or block_size. Every combination of the other parameters is
+a curve, walked along the axis values in the order given:
+
+    {"test": "file_write",
+     "parameters": {"timeout": [10], "file_size": [1, 10], "engine": ["sync", "direct"],
+                    "block_size": [4096, 65536], "workers": [1, 2, 4, 8, 16]},
+     "axis": "workers",
+     "repetitions": 3,
+     "plateau": 0.05}
+
+Sweep is a source of Scheduler (see scheduler.py). It expands the matrix
+lazily: a curve is only opened when the curves already open have no test
+left to hand out, and the next point of a curve is only queued once every
+repetition of the current one has ended, with at most prefetch tests
+queued or running at a time. When the mean write speed of a point gains
+less than plateau (a fraction) over the point before it, the throughput
+has plateaued and the rest of the curve is skipped. Without an axis every
+point is run.
+
+summary() groups the write speeds by point with mean and standard
+deviation. Run as a script, the sweep is served by a TestServer on
+Config.PORT with clients from a Launcher on this host, other hosts may
+connect their own clients, and the summary is printed and written as
+JSON.
+
+Example:
+    python sweep.py spec.json -c 64 -w 4 -o sweep.json
+"""
+
+
+def to_str(value):
+    """ JSON strings load as unicode, tests and the wire protocol expect str. """
+    return str(value) if isinstance(value, unicode) else value
+
+
+def mean_stddev(values):
+    """ Returns the mean and sample standard deviation of values, (None, None) if empty. """
+    if not values:
+        return None, None
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    return mean, math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1))
+
+
+class Curve(object):
+    """ Points of one combination of the fixed parameters along the axis. """
+    def __init__(self, fixed, axis, values):
+        self.fixed = fixed
+        self.axis = axis
+        self.values = values
+        self.index = 0
+        self.issued = 0
+        self.ended = 0
+        self.last_mean = None
+
+    def point(self, index=None):
+        point = dict(self.fixed)
+        if self.axis is not None:
+            point[self.axis] = self.values[self.index if index is None else index]
+        return point
+
+
+class Sweep(object):
+    """ Lazily expanded test matrix with a plateau early stop.
+
+        Args:
+            test_name (str): registered test to run.
+            parameters (dict): parameter name mapped to the list of values to sweep.
+            axis (optional[str]): parameter the curves run along, None to run every point.
+            repetitions (optional[int]): runs per point.
+            plateau (optional[float]): least gain over the previous point that keeps a curve going,
+                None to never stop early.
+            prefetch (optional[int]): tests queued or running at a time.
+            priority (optional[int]): scheduler priority of the sweep's tests.
+            constraints (optional[dict]): scheduler constraints of the sweep's tests.
+    """
+    def __init__(self, test_name, parameters, axis=None, repetitions=Config.SWEEP_REPETITIONS,
+                 plateau=Config.SWEEP_PLATEAU, prefetch=Config.SWEEP_PREFETCH, priority=0, constraints=None):
+        if axis is not None and axis not in parameters:
+            raise ValueError('sweep axis {} is not one of its parameters'.format(axis))
+        self.test_name = test_name
+        self.parameters = dict((name, list(values) if isinstance(values, (list, tuple)) else [values])
+                               for name, values in parameters.iteritems())
+        testregistry.parse_args(testregistry.get_test(test_name),
+                                kwargs=dict((name, values[0]) for name, values in self.parameters.iteritems()))
+        self.axis = axis
+        self.repetitions = repetitions
+        self.plateau = plateau
+        self.prefetch = prefetch
+        self.priority = priority
+        self.constraints = constraints
+        self.fixed_names = sorted(name for name in self.parameters if name != axis)
+        self.curves = self.open_curves()
+        self.exhausted = False
+        self.active = []
+        self.issued = {}
+        self.points = {}
+        self.order = []
+
+    @classmethod
+    def from_spec(cls, spec):
+        """ Builds a sweep from a spec dict as shown in the module docstring. """
+        parameters = dict((to_str(name), [to_str(value) for value in values] if isinstance(values, list)
+                           else to_str(values)) for name, values in spec['parameters'].iteritems())
+        return cls(to_str(spec['test']), parameters, axis=to_str(spec.get('axis')),
+                   repetitions=spec.get('repetitions', Config.SWEEP_REPETITIONS),
+                   plateau=spec.get('plateau', Config.SWEEP_PLATEAU),
+                   prefetch=spec.get('prefetch', Config.SWEEP_PREFETCH),
+                   priority=spec.get('priority', 0), constraints=spec.get('constraints'))
+
+    def open_curves(self):
+        axis_values = self.parameters[self.axis] if self.axis is not None else [None]
+        for values in itertools.product(*[self.parameters[name] for name in self.fixed_names]):
+            yield Curve(dict(zip(self.fixed_names, values)), self.axis, axis_values)
+
+    def size(self):
+        """ Returns the number of tests in the full matrix. """
+        size = self.repetitions
+        for values in self.parameters.itervalues():
+            size *= len(values)
+        return size
+
+    def point_entry(self, point):
+        key = tuple(sorted(point.iteritems()))
+        entry = self.points.get(key)
+        if entry is None:
+            entry = self.points[key] = dict(point=point, results=[], failed=0, skipped=False)
+            self.order.append(key)
+        return entry
+
+    def next_curve(self):
+        """ Returns an open curve with repetitions left to hand out, opening a new one if needed. """
+        for curve in self.active:
+            if curve.issued < self.repetitions:
+                return curve
+        if self.exhausted:
+            return None
+        try:
+            curve = next(self.curves)
+        except StopIteration:
+            self.exhausted = True
+            return None
+        self.active.append(curve)
+        return curve
+
+    def expand(self):
+        """ Return:
+                list: TestRequests ready to be queued.
+        """
+        requests = []
+        while len(self.issued) < self.prefetch:
+            curve = self.next_curve()
+            if curve is None:
+                break
+            point = curve.point()
+            self.point_entry(point)
+            request = testregistry.TestRequest(self.test_name, **point)
+            curve.issued += 1
+            self.issued[request] = curve
+            requests.append(request)
+        return requests
+
+    def record(self, request, result):
+        """ Records the write speed of an ended test, None if it did not complete. Moves its curve
+            to the next point once every repetition has ended.
+        """
+        curve = self.issued.pop(request)
+        entry = self.point_entry(curve.point())
+        if result is None:
+            entry['failed'] += 1
+        else:
+            entry['results'].append(result)
+        curve.ended += 1
+        if curve.ended < self.repetitions:
+            return
+        mean, _ = mean_stddev(entry['results'])
+        plateaued = (self.plateau is not None and mean is not None and curve.last_mean
+                     and mean < curve.last_mean * (1 + self.plateau))
+        if mean is not None:
+            curve.last_mean = mean
+        curve.index += 1
+        curve.issued = curve.ended = 0
+        if plateaued:
+            server_log.debug('Sweep plateaued at {}, skipping {} points'.format(entry['point'],
+                                                                                len(curve.values) - curve.index))
+            for index in xrange(curve.index, len(curve.values)):
+                self.point_entry(curve.point(index))['skipped'] = True
+        if plateaued or curve.index >= len(curve.values):
+            self.active.remove(curve)
+
+    def done(self):
+        return self.exhausted and not self.active
+
+    def summary(self):
+        """ Return:
+                list: dict per point in the order the points were reached, with point, runs, failed,
+                      skipped and mean, stddev, min and max of the write speed in MB/s.
+        """
+        rows = []
+        for key in self.order:
+            entry = self.points[key]
+            mean, stddev = mean_stddev(entry['results'])
+            rows.append(dict(point=entry['point'], runs=len(entry['results']), failed=entry['failed'],
+                             skipped=entry['skipped'], mean=mean, stddev=stddev,
+                             min=min(entry['results']) if entry['results'] else None,
+                             max=max(entry['results']) if entry['results'] else None))
+        return rows
+
+
+class SweepServer(TestServer):
+    """ TestServer that runs until its sweeps are done, or no client is left once one connected. """
+    def check_for_exit(self):
+        if self.scheduler.sources_done() and not self.live.clients:
+            server_log.debug('Sweep done')
+            return False
+        return TestServer.check_for_exit(self)
+
+
+def print_summary(sweep):
+    names = sorted(sweep.parameters)
+    print ' '.join('{:>12}'.format(name[:12]) for name in names), \
+        '{:>5} {:>6} {:>10} {:>10}'.format('runs', 'failed', 'MB/s', 'stddev')
+    for row in sweep.summary():
+        values = ' '.join('{:>12}'.format(row['point'][name]) for name in names)
+        if row['skipped']:
+            print values, '{:>5}'.format('skipped (plateau)')
+        else:
+            print values, '{:>5} {:>6} {:>10.2f} {:>10.2f}'.format(row['runs'], row['failed'], row['mean'] or 0,
+                                                                   row['stddev'] or 0)
+
+
+def main(spec, clients, rate, workers, device_limit, output):
+    sweep = Sweep.from_spec(spec)
+    scheduler = Scheduler(device_limit=device_limit)
+    scheduler.add_source(sweep)
+    if clients:
+        launcher = Launcher(Config.HOST, Config.PORT, workers)
+        launcher.ramp(clients, rate, delay=1)
+        launcher.start()
+    server = SweepServer(Config.HOST, Config.PORT, scheduler)
+    try:
+        server.run()
+    finally:
+        server.end()
+    print_summary(sweep)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(dict(spec=spec, finished=time.strftime('%Y-%m-%d_%H:%M:%S'), points=sweep.summary()),
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('spec', help='sweep spec as a JSON file')
+    parser.add_argument('-c', '--clients', dest='clients', default=None, type=int,
+                        help='clients to launch on this host, defaults to one per test of the full matrix')
+    parser.add_argument('-r', '--rate', dest='rate', default=50, type=float,
+                        help='clients launched per second')
+    parser.add_argument('-w', '--workers', dest='workers', default=None, type=int,
+                        help='launcher worker processes, defaults to one per cpu')
+    parser.add_argument('-d', '--device-limit', dest='device_limit', default=1, type=int,
+                        help='tests running at a time per device, 0 for no limit')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help='file to write the summary to as JSON')
+    cmd_input = parser.parse_args()
+    with open(cmd_input.spec, 'r') as f:
+        sweep_spec = json.load(f)
+    if cmd_input.clients is None:
+        cmd_input.clients = Sweep.from_spec(sweep_spec).size()
+    main(sweep_spec, cmd_input.clients, cmd_input.rate, cmd_input.workers, cmd_input.device_limit or None,
+         cmd_input.output)
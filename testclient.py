@@ -1,6 +1,5 @@
 __author__ = 'Tristan Storz'
 import asyncore
-import asynchat
 import socket
 import multiprocessing
 import argparse
@@ -8,14 +7,21 @@ import sys
 import utilities
 import logging
 import time
+import protocol
+import testregistry
+import hostinfo
 from config import Config
-from loggers import test_log, file_formatter
-from filewritetest import FileWriteTest
+import loggers
+from loggers import test_log
 """ Test Client for running tests and sending test information to server
 
 The TestClient uses asynchat to connect with a TestServer on a host:port.
-When a connection is successful, TestClient will proceed to send system
-information and request a system id and test from the server. The TestClient
+When a connection is successful, TestClient offers binary framing and
+requests a system id. Once the server has answered (see protocol.py), it
+sends its host fingerprint and requests a test from the server. Servers
+that negotiated binary framing get the fingerprint's hash and ask for the
+full host info only if they have not seen the host before (see
+hostinfo.py). Older servers get the host info as text. The TestClient
 will then proceed to run and send test information to the server.
 
 Optionally, TestClient can be initialized with a test. In that case, no
@@ -29,25 +35,69 @@ Example:
         finally:
             client.close()
 
-    # Start client with FileWriteTest
-        from filewritetest import FileWriteTest
+    # Start client with a registered test
+        import testregistry
 
-        client = TestClient('localhost', 1123 FileWriteTest(1, 2))
+        client = TestClient('localhost', 1123, testregistry.create('file_write', kwargs=dict(timeout=1, file_size=2)))
         try:
             client.connect_to_host()
         finally:
             client.close()
 
-Note: The only supported test is 'file write' Adding more tests requires
-      adding the test class to TestClient.test_handler. Additional tests
-      must be classes with the following methods, run(), get_test_name(),
-      and get_test_args(). Also, the following parameters, message_queue
-      (multiprocessing.Queue()) and end_of_test (multiprocessing.Event()).
+Note: Tests are looked up in testregistry, see testregistry.py and
+      workload.py for adding tests. Tests must be classes with the
+      following methods, run(), get_test_name(), and get_test_args().
+      Also, the following parameters, message_channel (MessageChannel())
+      and end_of_test (multiprocessing.Event()).
 """
 
 
-class TestClient(asynchat.async_chat):
+class TestMessageDispatcher(asyncore.file_dispatcher):
+    """ Forwards messages from a running test's message_channel to the server.
+
+        The read end of the channel is watched by the client's asyncore loop,
+        so the client only wakes when the test writes a message or when the
+        loop timeout expires to check run_test.end_of_test.
+
+        Args:
+            client (TestClient): connection to forward messages through.
+            run_test (Class): running test with message_channel and end_of_test.
+    """
+    def __init__(self, client, run_test):
+        asyncore.file_dispatcher.__init__(self, run_test.message_channel.fileno())
+        self.client = client
+        self.run_test = run_test
+        self.frame_reader = protocol.FrameReader()
+
+    def readable(self):
+        """ Checked on every pass of the loop. Ends the session once the test is over. """
+        if self.run_test.end_of_test.is_set():
+            self.forward(self.run_test.message_channel.read_available())
+            test_log.debug('Test ended')
+            self.client.end()
+            return False
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.forward(self.recv(Config.CHANNEL_READ_SIZE))
+
+    def forward(self, data):
+        """ Re-sends every complete frame in data with the framing used by the client. """
+        for header, fields in self.frame_reader.feed(data):
+            self.client.send_message(header, *fields)
+
+    def handle_close(self):
+        self.close()
+        self.run_test.message_channel.close()
+
+
+class TestClient(protocol.MessageChat):
     """ Init log and params, call connect_to_host() after creating instance to run.
+        Several clients can share one loop by calling open_connection() on each and
+        running asyncore.loop() once (see launcher.py).
 
         Args:
             host (str): test server address.
@@ -55,42 +105,62 @@ class TestClient(asynchat.async_chat):
             run_test (Class): test to run when connected to the server.
     """
     def __init__(self, host, port, run_test=None):
-        asynchat.async_chat.__init__(self)
-        self.set_terminator(Config.TERMINATOR)
+        protocol.MessageChat.__init__(self)
         self.host = host
         self.port = port
         self.run_test = run_test
         self.server_header = None
         self.server_message = []
         self.client_id = None
+        self.test_channel = None
+        self.session_started = False
+        self.host_info = None
+        self.host_hash = None
         self.message_handler = {Config.API_TEST_REQUEST: self.set_run_test,
-                                Config.API_ID_REQUEST: self.set_client_id}
-        self.test_handler = {Config.TEST_FILE_WRITE_NAME: FileWriteTest}
+                                Config.API_ID_REQUEST: self.set_client_id,
+                                Config.API_PROTOCOL: self.set_protocol,
+                                Config.API_HOST: self.set_host_status}
         self.setup_log_file()
 
+    log_file = None
+
     @staticmethod
     def setup_log_file():
+        """ Adds the test log file handler once per process, however many clients it runs. """
+        if TestClient.log_file is not None:
+            return
         utilities.verify_dir_exists(Config.TEST_LOG_DIR)
         test_log_file = logging.FileHandler(Config.TEST_LOG_DIR + time.strftime('%Y%m%d_%H%M%S'), 'a')
         test_log_file.setLevel(logging.DEBUG)
-        test_log_file.setFormatter(file_formatter)
-        test_log.addHandler(test_log_file)
+        test_log_file.setFormatter(loggers.log_file_formatter())
+        loggers.add_handler(test_log, test_log_file)
+        TestClient.log_file = test_log_file
 
     def connect_to_host(self):
         """ Create/bind socket, start asyncore loop until connection ends """
+        self.open_connection()
+        asyncore.loop(timeout=Config.LOOP_TIMEOUT)
+
+    def open_connection(self):
+        """ Create socket and start connecting, the caller runs the asyncore loop. """
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((self.host, self.port))
-        asyncore.loop(timeout=Config.LOOP_TIMEOUT)
 
     def handle_connect(self):
-        """ Sends start and system info. Requests id. Requests test if not
-            initialized with test.
+        """ Sends start with an offer of binary framing and requests id. The rest of
+            the session starts once the server answers one of them.
         """
-        self.send(Config.API_CLIENT_START + Config.TERMINATOR)
+        self.send_message(Config.API_CLIENT_START, Config.PROTOCOL_BINARY, protocol.PROTOCOL_VERSION)
+        self.send_message(Config.API_ID_REQUEST)
+
+    def start_session(self):
+        """ Sends system info. Requests test if not initialized with test. """
+        if self.session_started:
+            return
+        self.session_started = True
         self.send_system_info()
-        self.send(Config.API_ID_REQUEST + Config.TERMINATOR)
         if not self.run_test:
-            self.send(Config.API_TEST_REQUEST + Config.TERMINATOR)
+            self.send_message(Config.API_TEST_REQUEST)
         else:
             self.run()
 
@@ -101,29 +171,42 @@ class TestClient(asynchat.async_chat):
 
     def handle_close(self):
         test_log.debug('Socket closed')
+        self.close_test_channel()
         self.shutdown(socket.SHUT_RDWR)
         self.close()
 
-    def collect_incoming_data(self, data):
-        """ Saves data to server_header and server_message.
+    def close_test_channel(self):
+        """ Stops forwarding test messages. Signals the test to stop if it is still running. """
+        if self.test_channel:
+            self.run_test.end_of_test.set()
+            self.test_channel.handle_close()
+            self.test_channel = None
+
+    def handle_message(self, header, fields):
+        """ Saves message to server_header and server_message, calls api method from message_handler dict.
             Args:
-                data (str): information from server.
+                header (str): message header from server.
+                fields (list): message fields from server.
         """
-        del self.server_message[:]
-        message = data.split(Config.API_DELIMITER)
-        self.server_header = message[0]
-        for msg in message[1:]:
-            self.server_message.append(msg)
-
-    def found_terminator(self):
-        """ Calls api method from message_handler dict. """
+        self.server_header = header
+        self.server_message = fields
         self.message_handler.get(self.server_header, self.log_unknown_server_command)()
 
+    def set_protocol(self):
+        """ Server accepted binary framing. Marks the end of text output and switches to binary. """
+        version = int(self.server_message[0])
+        test_log.debug('binary protocol version {}'.format(version))
+        self.start_binary_input()
+        self.send_message(Config.API_PROTOCOL, version)
+        self.binary_out = True
+        self.start_session()
+
     def set_client_id(self):
         """ Sets client_id to the return packet from server if present. """
         if len(self.server_message):
             self.client_id = self.server_message[0]
             test_log.debug('id received: {}'.format(self.client_id))
+            self.start_session()
         else:
             test_log.debug('Id request returned no information')
             self.handle_close()
@@ -132,15 +215,31 @@ class TestClient(asynchat.async_chat):
         """ Sets run_test to the return packet from server if present """
         if len(self.server_message):
             test_log.debug('running test from server: {} {}'.format(self.server_message[0], self.server_message[1]))
-            function_args = [int(arg) for arg in self.server_message[1].split(',')]
-            self.run_test = self.test_handler[self.server_message[0]](*function_args)
+            args, kwargs = testregistry.parse_args_string(self.server_message[1])
+            try:
+                self.run_test = testregistry.create(self.server_message[0], args, kwargs)
+            except ValueError as e:
+                test_log.debug('cannot run test from server: {}'.format(e))
+                self.handle_close()
+                return
             self.run()
         else:
             test_log.debug('no test found, ending session')
             self.handle_close()
 
     def send_system_info(self):
-        self.send(Config.API_SYSTEM_INFO + Config.API_DELIMITER + utilities.get_cpu_info() + Config.TERMINATOR)
+        """ Sends the host hash to servers that negotiated binary framing, the full host info otherwise. """
+        self.host_info, self.host_hash = hostinfo.load_host_info()
+        if self.binary_out:
+            self.send_message(Config.API_HOST, self.host_hash)
+        else:
+            self.send_message(Config.API_SYSTEM_INFO, self.host_info)
+
+    def set_host_status(self):
+        """ Server answered the host hash, sends the full host info if the host is unknown. """
+        if len(self.server_message) > 1 and self.server_message[1] == hostinfo.HOST_UNKNOWN:
+            test_log.debug('host unknown to server, sending host info')
+            self.send_message(Config.API_SYSTEM_INFO, self.host_info, self.host_hash)
 
     def log_unknown_server_command(self):
         test_log.debug('Unknown command, ending session' + self.server_header)
@@ -148,45 +247,64 @@ class TestClient(asynchat.async_chat):
 
     def run(self):
         """ Sends test information for run_test to server. Then forks to run test in child.
-            Continues to log any information from run_test.message_queue until
-            run_test.end_of_test is set by the test. Ends the connection gracefully.
+            Registers run_test.message_channel with the asyncore loop so test messages are
+            forwarded as they arrive. The session is ended by TestMessageDispatcher once
+            run_test.end_of_test is set by the test.
         """
         if self.run_test:
             test_log.debug('Starting test')
-            self.send(Config.API_RUNNING_TEST + Config.API_DELIMITER + self.run_test.get_test_name() +
-                      Config.API_DELIMITER + self.run_test.get_test_args() + Config.TERMINATOR)
+            self.send_message(Config.API_RUNNING_TEST, self.run_test.get_test_name(), self.run_test.get_test_args())
             test_process = multiprocessing.Process(target=self.run_test.run)
             test_process.start()
-
-            while not self.run_test.end_of_test.is_set():
-                if not self.run_test.message_queue.empty():
-                    self.send(self.run_test.message_queue.get())
-
-            test_log.debug('Test ended')
-            self.end()
+            self.test_channel = TestMessageDispatcher(self, self.run_test)
         else:
             test_log.debug('No running test')
             self.handle_close()
 
     def end(self):
+        """ Sends end to the server and closes once all pushed messages are sent. """
         test_log.debug('Ending session')
-        self.send(Config.API_CLIENT_END + Config.TERMINATOR)
-        self.handle_close()
+        self.close_test_channel()
+        self.send_message(Config.API_CLIENT_END)
+        self.close_when_done()
 
 
 if __name__ == '__main__':
-    # Spin up a client to connect to the test server. Input arguments are for the file write test,
-    # more can be added to support additional tests.
+    # Spin up a client to connect to the test server. The options below are shared by the
+    # registered tests, any other parameter of a test can be set with -o name=value.
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--timeout', dest='timeout', default=10, type=int,
+    parser.add_argument('-T', '--test', dest='test', default=Config.TEST_FILE_WRITE_NAME,
+                        help='test to run: {}'.format(', '.join(sorted(testregistry.get_tests()))))
+    parser.add_argument('-t', '--timeout', dest='timeout', default=None, type=float,
                         help='runtime for client')
-    parser.add_argument('-f', '--filesize', dest='file_size', default=10, type=int,
+    parser.add_argument('-f', '--filesize', dest='file_size', default=None, type=int,
                         help='chunk size of test files')
+    parser.add_argument('-e', '--engine', dest='engine', default=None,
+                        help='write engine: sync, direct or writev')
+    parser.add_argument('-b', '--blocksize', dest='block_size', default=None, type=int,
+                        help='block size in bytes, defaults to the filesystem block size')
+    parser.add_argument('-i', '--iosize', dest='io_size', default=None, type=int,
+                        help='bytes per I/O call, defaults to the block size')
+    parser.add_argument('-p', '--preallocate', dest='preallocate', action='store_true', default=None,
+                        help='preallocate test files with posix_fallocate')
+    parser.add_argument('-w', '--workers', dest='workers', default=None, type=int,
+                        help='concurrent worker processes (outstanding I/Os)')
+    parser.add_argument('-s', '--statsinterval', dest='stats_interval', default=None, type=float,
+                        help='seconds between cpu/mem/io samples, may be below 1')
+    parser.add_argument('-o', '--option', dest='options', default=[], action='append',
+                        help='test parameter as name=value, may be repeated')
     cmd_input = parser.parse_args()
 
     if len(sys.argv) > 1:
         test_log.debug('custom test {}'.format(cmd_input))
-        client = TestClient(Config.HOST, Config.PORT, FileWriteTest(cmd_input.timeout, cmd_input.file_size))
+        test_class = testregistry.get_test(cmd_input.test)
+        declared = set(parameter.name for parameter in test_class.parameters)
+        test_kwargs = dict((name, value) for name, value in vars(cmd_input).iteritems()
+                           if name in declared and value is not None)
+        for option in cmd_input.options:
+            name, _, value = option.partition('=')
+            test_kwargs[name.strip()] = value
+        client = TestClient(Config.HOST, Config.PORT, testregistry.create(cmd_input.test, kwargs=test_kwargs))
     else:
         client = TestClient(Config.HOST, Config.PORT)
 
@@ -0,0 +1,211 @@
+__author__ = 'Tristan Storz'
+import importlib
+import pkgutil
+from ast import literal_eval
+from config import Config
+from loggers import test_log
+""" Registry of the tests TestClient can run and TestServer can queue.
+
+A test class is registered with the register decorator. It declares its
+name, its typed parameters and the result metrics it reports:
+
+    @testregistry.register
+    class SequentialReadTest(Workload):
+        name = 'seq_read'
+        parameters = [Parameter('timeout', float, 10, 'runtime in seconds'), ...]
+        metrics = [Metric('read_speed', 'MB/s', 'sum')]
+
+Parameters are listed in the order the test's __init__ takes them, that
+order is also used for positional test arguments on the wire. Values are
+converted to the declared type, so arguments can come from the command
+line or a server as strings.
+
+Tests are found the first time the registry is used:
+    - filewritetest, which is always available.
+    - every module of the Config.TEST_PLUGIN_PACKAGE package (workloads/).
+    - every entry point in the Config.TEST_ENTRY_POINT group of installed
+      distributions, when setuptools is available.
+A plugin that fails to import is logged and skipped.
+
+Example:
+    test = testregistry.create('random_io', kwargs=dict(timeout=5, read_percent=70))
+    request = TestRequest('file_write', timeout=5, file_size=1)
+    print request.name, request.get_args_string()
+"""
+
+BUILTIN_MODULES = ['filewritetest']
+METRIC_AGGREGATES = ('sum', 'mean', 'max', 'min')
+TRUE_STRINGS = ('1', 'true', 'yes', 'on')
+
+_tests = {}
+_discovered = False
+
+
+class Parameter(object):
+    """ Typed test parameter.
+
+        Args:
+            name (str): keyword argument name of the test's __init__.
+            kind (type): int, float, str or bool.
+            default (optional): value used when the parameter is not given.
+            help (optional[str]): description for command line help.
+    """
+    def __init__(self, name, kind, default=None, help=''):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.help = help
+
+    def parse(self, value):
+        """ Returns value converted to kind. None is kept to select the test's default behaviour. """
+        if value is None:
+            return None
+        if self.kind is bool:
+            if isinstance(value, basestring):
+                return value.strip().lower() in TRUE_STRINGS
+            return bool(value)
+        try:
+            return self.kind(value)
+        except (TypeError, ValueError):
+            raise ValueError('parameter {} expects {}, got {!r}'.format(self.name, self.kind.__name__, value))
+
+
+class Metric(object):
+    """ Result metric a test reports per worker with Workload.send_result.
+
+        Args:
+            name (str): metric name stored with the run.
+            unit (str): unit of the metric.
+            aggregate (optional[str]): how worker values are combined, one of METRIC_AGGREGATES.
+            help (optional[str]): description of the metric.
+    """
+    def __init__(self, name, unit, aggregate='sum', help=''):
+        if aggregate not in METRIC_AGGREGATES:
+            raise ValueError('metric {} has unknown aggregate {}'.format(name, aggregate))
+        self.name = name
+        self.unit = unit
+        self.aggregate = aggregate
+        self.help = help
+
+
+def register(test_class):
+    """ Class decorator adding test_class to the registry under test_class.name. """
+    if not test_class.name:
+        raise ValueError('{} has no test name'.format(test_class.__name__))
+    registered = _tests.get(test_class.name)
+    if registered is not None and registered is not test_class:
+        raise ValueError('test {} is registered by {} and {}'.format(test_class.name, registered.__name__,
+                                                                    test_class.__name__))
+    _tests[test_class.name] = test_class
+    return test_class
+
+
+def discover():
+    """ Imports built in tests, the plugin package and entry points once. """
+    global _discovered
+    if _discovered:
+        return
+    _discovered = True
+    for module in BUILTIN_MODULES:
+        importlib.import_module(module)
+
+    try:
+        package = importlib.import_module(Config.TEST_PLUGIN_PACKAGE)
+    except ImportError as e:
+        test_log.debug('test plugin package {} not loaded: {}'.format(Config.TEST_PLUGIN_PACKAGE, e))
+    else:
+        for _, module, _ in pkgutil.iter_modules(package.__path__):
+            try:
+                importlib.import_module(package.__name__ + '.' + module)
+            except Exception as e:
+                test_log.debug('test plugin {} failed to load: {!r}'.format(module, e))
+
+    try:
+        import pkg_resources
+    except ImportError:
+        return
+    for entry_point in pkg_resources.iter_entry_points(Config.TEST_ENTRY_POINT):
+        try:
+            register(entry_point.load())
+        except Exception as e:
+            test_log.debug('test entry point {} failed to load: {!r}'.format(entry_point.name, e))
+
+
+def get_tests():
+    """ Return:
+            dict: test name mapped to test class for every registered test.
+    """
+    discover()
+    return dict(_tests)
+
+
+def get_test(name):
+    """ Returns the test class registered as name. Raises ValueError for unknown tests. """
+    discover()
+    try:
+        return _tests[name]
+    except KeyError:
+        raise ValueError('unknown test {}, expected one of {}'.format(name, ', '.join(sorted(_tests))))
+
+
+def parse_args(test_class, args=(), kwargs=None):
+    """ Maps positional args and kwargs onto test_class.parameters.
+
+        Return:
+            dict: parameter name mapped to its typed value, unknown names raise ValueError.
+    """
+    parameters = test_class.parameters
+    if len(args) > len(parameters):
+        raise ValueError('{} takes {} arguments, got {}'.format(test_class.name, len(parameters), len(args)))
+    values = dict((parameter.name, parameter.parse(arg)) for parameter, arg in zip(parameters, args))
+    by_name = dict((parameter.name, parameter) for parameter in parameters)
+    for name, value in (kwargs or {}).iteritems():
+        if name not in by_name:
+            raise ValueError('{} has no parameter {}'.format(test_class.name, name))
+        values[name] = by_name[name].parse(value)
+    return values
+
+
+def parse_args_string(args_string):
+    """ Splits test arguments sent by a server into (args, kwargs). Servers send either
+        positional arguments (5, 1) or a dict of keyword arguments.
+    """
+    if not args_string.strip():
+        return (), {}
+    value = literal_eval(args_string)
+    if isinstance(value, dict):
+        return (), value
+    return literal_eval('(' + args_string + ',)'), {}
+
+
+def create(name, args=(), kwargs=None):
+    """ Returns an instance of test name built from args and kwargs. """
+    test_class = get_test(name)
+    return test_class(**parse_args(test_class, args, kwargs))
+
+
+class TestRequest(object):
+    """ A test queued on TestServer for clients that request one.
+
+        Args:
+            name (str): registered test name.
+            kwargs: parameters of the test, checked against its declaration.
+    """
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.kwargs = parse_args(get_test(name), kwargs=kwargs)
+
+    def get_args_string(self):
+        """ Returns the arguments as positional values in declaration order. Parameters
+            after the last one given are left out, so requests that only use the
+            original timeout and file_size reach older clients unchanged.
+        """
+        parameters = get_test(self.name).parameters
+        given = [index for index, parameter in enumerate(parameters) if parameter.name in self.kwargs]
+        if not given:
+            return ''
+        return ', '.join(repr(self.kwargs.get(parameter.name, parameter.default))
+                         for parameter in parameters[:given[-1] + 1])
+
+    def __repr__(self):
+        return 'TestRequest({!r}, **{!r})'.format(self.name, self.kwargs)
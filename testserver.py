@@ -1,31 +1,77 @@
 from __future__ import division
 __author__ = 'Tristan Storz'
 from ast import literal_eval
+import argparse
 import asyncore
-import asynchat
 import socket
-import Queue
 import sqlite3
 import os
 import time
 import uuid
 import logging
 import utilities
+import protocol
+import testregistry
+import hostinfo
+import livemetrics
+import serverengine
+from scheduler import Scheduler
+from timerwheel import TimerWheel
 from config import Config
-from loggers import server_log, file_formatter
+import dbwriter
+from dbwriter import DatabaseWriter
+from histogram import LogHistogram
+from onlinestats import RunningStats
+import loggers
+from loggers import server_log, log_category
 """ Test Server for logging information from concurrent clients running tests.
 
 The TestServer class utilizes asyncore to monitor a host:port and
-then spawns ClientAPI instances when a connection is made. TestServer
-logs information from clients to a sqlite3 db in the same directory
-(test_server.db). Information about the session is also logged to
-server_logs/[datetime].log, where datetime is in YearMonthDay_Time
-format
-
-Additionally, TestServer can be initialized with a TestQueue to serve
+then spawns ClientAPI instances when a connection is made. The loop is
+run by a serverengine engine, asyncore's select() loop or epoll.
+Reading from clients pauses while the db writer's queue is above
+Config.DB_QUEUE_HIGH_WATER. When the server ends, output still queued
+for clients is drained and open runs are recorded as ABORTED.
+
+Clients send a heartbeat every Config.TEST_HEARTBEAT_TIME seconds. A
+client that sends nothing for missed_heartbeats heartbeat intervals is
+closed and its run recorded as TIMED_OUT with what it reported so far.
+Connections are tracked in a TimerWheel that only looks at a client
+when its deadline comes up, so liveness checks do not scan every socket.
+
+TestServer logs information from clients to a sqlite3 db in the same
+directory (test_server.db) through a DatabaseWriter thread, so inserts
+never block the loop. Each connection is a run with its own run_id.
+Stats, heartbeats and file rollovers are stored per run in the samples
+table and downsampled when the run ends. Write latency snapshots are
+merged per run and stored as percentiles and a histogram.
+
+CPU, memory and the throughput of every stats interval are summarised
+in constant memory per run (see onlinestats.py) and stored in the
+run_stats table. Newer clients stamp rollovers, stats and heartbeats
+with their host's monotonic clock in nanoseconds. Throughput is computed
+over those client intervals, so network and loop delay do not count,
+every file's duration is kept and the offset of the client's clock to
+the server's is estimated per connection.
+
+Tests may write to several target directories at once (see
+workload.py). Rollovers are attributed to the target of their worker
+and every target is stored in run_targets with its host and device.
+
+Clients are identified by a host fingerprint, stored once per host in
+the hosts table and referenced from tests by host_id. While the session
+runs, the state of every client is streamed as Server-Sent Events from
+Config.LIVE_PORT (see livemetrics.py). Information about the session is
+also logged to server_logs/[datetime].log, where datetime is in
+YearMonthDay_Time format.
+
+Additionally, TestServer can be initialized with a Scheduler to serve
 tests to clients as they connect. This is only for the case where the
 TestClient does not have a test to run and will then request one from
-TestServer.
+TestServer. The scheduler picks by priority and by the constraints of a
+test on the client's host, and holds clients back while their host or
+device runs as many tests as its limit allows (see scheduler.py). A test
+request of an unknown host is answered once its host info has arrived.
 
 Example:
     # Start server on localhost port 1123:
@@ -35,22 +81,50 @@ Example:
         finally:
             server.end()
 
-    # Start server with test queue:
-        import Queue
+    # Start server with scheduled tests, one test per device at a time:
+        from scheduler import Scheduler
+        from testregistry import TestRequest
 
-        tests = Queue.Queue()
-        tests.put(Config.TEST_FILE_WRITE(timeout=10, file_size=10))
+        tests = Scheduler(device_limit=1)
+        tests.put(TestRequest('file_write', timeout=10, file_size=10))
+        tests.put(TestRequest('random_io', timeout=10, read_percent=70), priority=1,
+                  constraints={'device.rotational': False})
         server = TestServer('localhost', 1123, tests)
         try:
             server.run()
         finally:
             server.end()
 
-Note: the only supported test is 'file write' Adding more tests will
-      require interfacing with TestClient and adding the appropriate
-      information to config.py.
+Note: tests are registered in testregistry. Rollovers count the bytes a
+      test moved, so files_written, bytes_written and write_speed hold
+      passes, bytes and MB/s for read tests as well. Metrics a test
+      declares are combined over its workers and stored in run_metrics.
 """
 
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def client_int(value):
+    """ Returns value as an int that fits sqlite's 64 bit INTEGER, raises ValueError otherwise. """
+    number = int(value)
+    if not INT64_MIN <= number <= INT64_MAX:
+        raise ValueError('{} does not fit in 64 bits'.format(value))
+    return number
+
+
+def optional_int(value):
+    """ Returns value as client_int(), None for None, which text frames carry as 'None'. """
+    return None if value in (None, 'None') else client_int(value)
+
+
+STATS_IO_FIELDS = [('client_cpu', float),
+                   ('read_bytes', client_int),
+                   ('write_bytes', client_int),
+                   ('disk_read_bytes', client_int),
+                   ('disk_write_bytes', client_int),
+                   ('disk_busy', float)]
+
 
 class TestServer(asyncore.dispatcher):
     TESTS_RAN = 0
@@ -60,29 +134,47 @@ class TestServer(asyncore.dispatcher):
         Args:
             host (str): address to host test server on.
             port (int): address port.
-            test_queue (optional[Queue]): tests to run when client
-                connects to server.
+            scheduler (optional[Scheduler]): tests to run when clients request one, none if None.
+            live_port (optional[int]): port of the live metrics endpoint, None to disable it.
+            engine (optional[str]): event loop engine, 'asyncore' or 'epoll'.
+            missed_heartbeats (optional[float]): heartbeat intervals without any message after
+                which a client is timed out.
     """
-    def __init__(self, host, port, test_queue=Queue.Queue()):
-        asyncore.dispatcher.__init__(self)
+    def __init__(self, host, port, scheduler=None, live_port=Config.LIVE_PORT,
+                 engine=Config.SERVER_ENGINE, missed_heartbeats=Config.LIVENESS_MISSED_HEARTBEATS):
+        self.engine = serverengine.get_engine(engine)
+        asyncore.dispatcher.__init__(self, map=self.engine.socket_map)
         self.host = host
         self.port = port
-        self.test_queue = test_queue
-        self.db = None
-        self.db_cursor = None
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.db_writer = None
+        self.hosts = None
+        self.last_run_id = 0
         self.connection_made = False
         self.start_time = None
         self.end_time = None
         self.connections_total = 0
+        self.live_port = live_port
+        self.live = livemetrics.LiveMetrics(self.get_counters)
+        self.live_server = None
+        self.liveness = TimerWheel()
+        self.liveness_timeout = missed_heartbeats * Config.TEST_HEARTBEAT_TIME
+        self.timed_out = 0
         self.setup_log_file()
 
+    log_file = None
+
     @staticmethod
     def setup_log_file():
+        """ Adds the server log file handler once per process. """
+        if TestServer.log_file is not None:
+            return
         utilities.verify_dir_exists(Config.SERVER_LOG_DIR)
         server_log_file = logging.FileHandler(Config.SERVER_LOG_DIR + time.strftime('%Y%m%d_%H%M%S'), 'a')
         server_log_file.setLevel(logging.DEBUG)
-        server_log_file.setFormatter(file_formatter)
-        server_log.addHandler(server_log_file)
+        server_log_file.setFormatter(loggers.log_file_formatter())
+        loggers.add_handler(server_log, server_log_file)
+        TestServer.log_file = server_log_file
 
     def handle_accept(self):
         """ Spawn TestClient instance with unique id to handle connected client. """
@@ -90,18 +182,42 @@ class TestServer(asyncore.dispatcher):
         if pair is not None:
             sock, address = pair
             server_log.debug('Connection from %s' % repr(address))
-            ClientAPI(sock, uuid.uuid4(), self.test_queue, self.db_cursor)
+            self.last_run_id += 1
+            self.create_client(sock)
             self.connections_total += 1
             self.connection_made = True
 
+    def create_client(self, sock):
+        client = ClientAPI(sock, uuid.uuid4(), self.scheduler, self.db_writer, self.last_run_id, self.hosts,
+                           self.live, self.engine.socket_map)
+        self.liveness.schedule(client, client.last_seen + self.liveness_timeout)
+        return client
+
+    def check_liveness(self):
+        """ Times out clients whose deadline passed without a message since it was set. Clients
+            that sent something in the meantime, or wait for the scheduler, get a new deadline.
+        """
+        now = time.time()
+        for client in self.liveness.advance(now):
+            if client.run_ended:
+                continue
+            if client.waiting:
+                client.last_seen = now
+            deadline = client.last_seen + self.liveness_timeout
+            if deadline > now:
+                self.liveness.schedule(client, deadline)
+            else:
+                self.timed_out += 1
+                client.handle_timeout(now - client.last_seen)
+
     def check_for_exit(self):
         """ Called in run() after every loop of asyncore.
 
             Return:
                 bool: True if clients are present or no client has connected,
-                      False otherwise.
+                      False otherwise. Live metrics subscribers do not count as clients.
          """
-        if len(asyncore.socket_map) > 1:
+        if self.live.clients:
             return True
         elif not self.connection_made:
             return True
@@ -110,23 +226,18 @@ class TestServer(asyncore.dispatcher):
             return False
 
     def initialize_database(self):
-        """ Create db with tests table if no db is present """
-        if not os.path.isfile(Config.DB_NAME):
-            self.db = sqlite3.connect(Config.DB_NAME)
-            self.db_cursor = self.db.cursor()
-            self.db_cursor.execute('''CREATE TABLE tests
-                                    (test text,
-                                     start_time text,
-                                     end_time text,
-                                     files_written int,
-                                     write_speed int,
-                                     avg_cpu float,
-                                     avg_mem float,
-                                     cpu_info text,
-                                     status text);''')
-        else:
-            self.db = sqlite3.connect(Config.DB_NAME)
-            self.db_cursor = self.db.cursor()
+        """ Create or upgrade db tables, then start the db writer and expire old samples """
+        db = sqlite3.connect(Config.DB_NAME)
+        try:
+            dbwriter.initialize_schema(db)
+            self.last_run_id = dbwriter.get_last_run_id(db)
+            self.hosts = hostinfo.Hosts(dbwriter.get_hosts(db), dbwriter.get_host_infos(db))
+        finally:
+            db.close()
+        self.db_writer = DatabaseWriter(Config.DB_NAME)
+        self.db_writer.start()
+        self.db_writer.call(dbwriter.expire_samples,
+                            time.time() - Config.SAMPLES_RETENTION_DAYS * Config.SECONDS_PER_DAY)
 
     def setup(self):
         """ Create/bind socket and initialize sqlite database.
@@ -136,23 +247,65 @@ class TestServer(asyncore.dispatcher):
         """
         server_log.debug('Setting up server')
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.bind((self.host, self.port))
         self.set_reuse_addr()
-        self.listen(5)
+        self.bind((self.host, self.port))
+        self.listen(Config.SERVER_BACKLOG)
+        if self.live_port:
+            try:
+                self.live_server = livemetrics.LiveMetricsServer(self.host, self.live_port, self.live,
+                                                                 self.engine.socket_map)
+            except socket.error as e:
+                server_log.debug('Live metrics disabled, port {} unavailable: {}'.format(self.live_port, e))
         self.initialize_database()
         server_log.debug('Setup successful')
         return True
 
     def run(self):
-        """ If setup succeeds, continue asyncore loop until exit status is reached. """
-        server_log.debug('Starting session')
+        """ If setup succeeds, continue the engine's loop until exit status is reached. """
+        server_log.debug('Starting session with {} engine'.format(self.engine.name))
         if self.setup():
             self.start_time = time.strftime('%Y-%m-%d_%H:%M:%S')
             while self.check_for_exit():
-                asyncore.loop(timeout=Config.LOOP_TIMEOUT, count=Config.LOOP_COUNT)
+                self.engine.poll(Config.ENGINE_DRAIN_POLL if self.engine.paused else Config.LOOP_TIMEOUT)
+                self.live.tick()
+                self.flow_control()
+                self.check_liveness()
+
+    def flow_control(self):
+        """ Pauses reading from clients while the db writer's queue is above its high water mark.
+            Raises DatabaseWriterError if the writer has stopped, its queue would never drain.
+        """
+        self.db_writer.check_alive()
+        depth = self.db_writer.queue_depth()
+        if not self.engine.paused and depth >= Config.DB_QUEUE_HIGH_WATER:
+            server_log.debug('Database queue at {}, pausing clients'.format(depth))
+            self.engine.pause_reading(True)
+        elif self.engine.paused and depth <= Config.DB_QUEUE_LOW_WATER:
+            server_log.debug('Database queue at {}, resuming clients'.format(depth))
+            self.engine.pause_reading(False)
+
+    def drain(self):
+        """ Stops accepting, sends output still queued for clients and closes open runs as ABORTED. """
+        self.close()
+        if not self.engine.drain(Config.SERVER_DRAIN_TIMEOUT):
+            server_log.debug('Drain timed out after {}s'.format(Config.SERVER_DRAIN_TIMEOUT))
+        for client in [obj for obj in self.engine.socket_map.values() if isinstance(obj, ClientAPI)]:
+            try:
+                client.handle_close()
+            except dbwriter.DatabaseWriterError as e:
+                server_log.error('{}: run not recorded, {}'.format(client.client_id, e))
+                client.close()
+
+    def get_counters(self):
+        """ Returns the session counters published by the live metrics. """
+        return dict(connections_total=self.connections_total,
+                    tests_ran=TestServer.TESTS_RAN,
+                    tests_completed=TestServer.TESTS_COMPLETED,
+                    tests_timed_out=self.timed_out)
 
     def end(self):
-        """ Commit statements to database and then close the connection """
+        """ Drain clients, flush queued statements to database and then close the connection """
+        self.drain()
         self.end_time = time.strftime('%Y-%m-%d_%H:%M:%S')
         server_log.debug('Ending Session: Server Metrics')
         server_log.debug('\tstart time:       {}'.format(self.start_time))
@@ -160,106 +313,224 @@ class TestServer(asyncore.dispatcher):
         server_log.debug('\tconnections made: {}'.format(self.connections_total))
         server_log.debug('\ttests ran:        {}'.format(TestServer.TESTS_RAN))
         server_log.debug('\ttests completed:  {}'.format(TestServer.TESTS_COMPLETED))
-        if self.db:
-            self.db.commit()
-            self.db.close()
-        self.close()
+        server_log.debug('\ttests timed out:  {}'.format(self.timed_out))
+        server_log.debug('\tmessages:         {}'.format(self.live.messages))
+        if self.live_server:
+            self.live.close()
+        if self.db_writer:
+            self.db_writer.close()
+            counters = self.db_writer.get_counters()
+            server_log.debug('\tdb rows written:  {}'.format(counters['rows_written']))
+            server_log.debug('\tdb rows dropped:  {}'.format(counters['rows_dropped']))
+            server_log.debug('\tdb commits:       {}'.format(counters['commits']))
+            server_log.debug('\tdb max queue:     {}'.format(counters['max_queue_depth']))
+            server_log.debug('\tdb commit time:   avg {:.6f}s max {:.6f}s'.format(counters['commit_time_avg'],
+                                                                             counters['commit_time_max']))
+        self.engine.close()
+
+
+class RunState(object):
+    """ Totals of a running test, created by ClientAPI once the client reports its first test
+        message so idle connections do not carry them. The latency histogram is created with
+        the first latency snapshot. cpu, mem and the throughput of every stats interval are
+        RunningStats (see onlinestats.py).
+    """
+    __slots__ = ('files_written', 'bytes_written', 'cpu', 'mem', 'throughput', 'file_duration', 'last_stat_time',
+                 'last_stat_bytes', 'rollover_bytes', 'worker_stats', 'write_latency', 'results', 'write_start',
+                 'write_stop', 'start_ns', 'end_ns', 'avg_write_speed', 'targets')
+
+    def __init__(self):
+        self.files_written = 0
+        self.bytes_written = 0
+        self.cpu = RunningStats()
+        self.mem = RunningStats()
+        self.throughput = RunningStats()
+        self.file_duration = RunningStats()
+        self.last_stat_time = None
+        self.last_stat_bytes = 0
+        self.rollover_bytes = None
+        self.worker_stats = {}
+        self.write_latency = None
+        self.results = {}
+        self.write_start = 0
+        self.write_stop = 0
+        self.start_ns = None
+        self.end_ns = None
+        self.avg_write_speed = 0
+        self.targets = {}
 
 
-class ClientAPI(asynchat.async_chat):
+class TargetState(object):
+    """ A target directory of a running test (see workload.py), the device holding it and the
+        totals of the target's workers. Throughput (rollover bytes between target stats) and disk
+        busy are sampled at target stats, which clients only send for tests with more than one
+        target.
+    """
+    __slots__ = ('index', 'path', 'major', 'minor', 'filesystem', 'block_size', 'first_worker', 'workers',
+                 'files_written', 'bytes_written', 'start_ns', 'end_ns', 'file_duration', 'throughput', 'disk_busy',
+                 'last_stat_time', 'last_stat_bytes')
+
+    def __init__(self, index, path, major, minor, filesystem, block_size, first_worker, workers):
+        self.index = index
+        self.path = path
+        self.major = major
+        self.minor = minor
+        self.filesystem = filesystem
+        self.block_size = block_size
+        self.first_worker = first_worker
+        self.workers = workers
+        self.files_written = 0
+        self.bytes_written = 0
+        self.start_ns = None
+        self.end_ns = None
+        self.file_duration = RunningStats()
+        self.throughput = RunningStats()
+        self.disk_busy = RunningStats()
+        self.last_stat_time = None
+        self.last_stat_bytes = 0
+
+
+class ClientAPI(protocol.MessageChat):
     """ Manage client connections. Log client information and send tests when requested.
 
+        asyncore's dispatcher is a classic class, so ClientAPI instances always have a __dict__.
+        It holds the connection state only, messages are dispatched through the class level
+        message_handlers table and test totals live in a slotted RunState created with the test.
+
         Args:
             sock (int): address to host test server on.
             client_id (uuid.uuid4): unique client identification.
-            test_queue (optional[Queue]): tests to run when client requests a test.
-            db_cursor (sqlite3.Cursor): object to write out sql commands to server db
+            scheduler (Scheduler): tests to run when client requests a test.
+            db_writer (DatabaseWriter): queues sql commands for the server db
+            run_id (int): id of the run in the tests and samples tables.
+            hosts (hostinfo.Hosts): host ids of the hosts stored in the db.
+            live (livemetrics.LiveMetrics): in memory state of connected clients.
+            socket_map (optional[dict]): socket map of the server's engine.
     """
-    def __init__(self, sock, client_id, test_queue, db_cursor):
-        asynchat.async_chat.__init__(self, sock=sock)
-        self.set_terminator(Config.TERMINATOR)
+    def __init__(self, sock, client_id, scheduler, db_writer, run_id, hosts, live, socket_map=None):
+        protocol.MessageChat.__init__(self, sock=sock, map=socket_map)
         self.client_id = str(client_id)
+        self.run_id = run_id
         self.client_header = None
-        self.client_message = []
+        self.client_message = None
         self.test = None
         self.test_args = None
         self.test_status = 'NOT RUN'
         self.test_completed = False
+        self.run_ended = False
+        self.last_seen = time.time()
         self.start_time = ''
         self.end_time = ''
-        self.client_cpu_info = None
-        self.test_queue = test_queue
-        self.db_cursor = db_cursor
-        self.files_written = 0
-        self.avg_write_speed = 0
-        self.avg_cpu = 0
-        self.avg_mem = 0
-        self.cpu_total = 0
-        self.mem_total = 0
-        self.stat_tick = 0
-        self.write_start = 0
-        self.write_stop = 0
-        self.write_time = 0
-        self.message_handler = {Config.API_CLIENT_START: self.log_client_start,
-                                Config.API_ID_REQUEST: self.send_client_id,
-                                Config.API_SYSTEM_INFO: self.log_client_system_info,
-                                Config.API_RUNNING_TEST: self.log_run_test,
-                                Config.API_TEST_REQUEST: self.send_client_test,
-                                Config.API_CLIENT_END: self.log_client_end,
-                                Config.API_HEARTBEAT: self.log_heartbeat,
-                                Config.API_TEST_STATS: self.log_test_stats,
-                                Config.API_TEST_FILE_WRITE: self.log_test_info,
-                                Config.API_BAD_TIMEOUT: self.log_bad_timeout}
+        self.hosts = hosts
+        self.host_id = None
+        self.host_pending = False
+        self.test_requested = False
+        self.ticket = None
+        self.waiting = False
+        self.live = live
+        self.scheduler = scheduler
+        self.db_writer = db_writer
+        self.samples = 0
+        self.run = None
+        self.clock_offset = None
+        self.live.client_open(run_id, self.client_id)
+
+    def get_run(self):
+        """ Returns the RunState of the test, created on first use. """
+        if self.run is None:
+            self.run = RunState()
+        return self.run
 
     def handle_close(self):
         """ Records test status and shutdowns socket. """
         server_log.debug(self.client_id + ': stop')
-        if self.test_completed:
-            self.test_status = 'COMPLETED'
-        else:
-            self.test_status = 'ABORTED'
+        self.end_run('COMPLETED' if self.test_completed else 'ABORTED')
+
+    def handle_timeout(self, silence):
+        """ Client sent nothing for silence seconds, records what it reported as TIMED_OUT. """
+        server_log.debug(self.client_id + ': no message for {:.1f}s, timed out'.format(silence))
+        self.end_run('TIMED_OUT')
+
+    def end_run(self, status):
+        """ Writes the run with status once and closes the socket. """
+        if self.run_ended:
+            return
+        self.run_ended = True
+        self.test_status = status
         self.end_time = time.strftime('%Y-%m-%d_%H:%M:%S')
+        self.live.client_close(self.run_id, self.test_status)
         self.write_to_db()
+        if self.ticket is not None:
+            self.scheduler.release(self.ticket, requeue=status != 'COMPLETED',
+                                   result=self.run.avg_write_speed if self.run else 0)
         self.close()
 
-    def collect_incoming_data(self, data):
-        """ Saves data from client to client_header and client_message.
+    def handle_message(self, header, fields):
+        """ Saves message to client_header and client_message, calls api method from message_handlers dict.
             Args:
-                data (str): message from server.
+                header (str): message header from client.
+                fields (list): message fields from client.
         """
-        del self.client_message[:]
-        message = data.split(Config.API_DELIMITER)
-        self.client_header = message[0]
-        for msg in message[1:]:
-            self.client_message.append(msg)
-
-    def found_terminator(self):
-        """ Calls api method from message_handler dict. """
-        self.message_handler.get(self.client_header, self.log_unknown)()
+        self.client_header = header
+        self.client_message = fields
+        self.last_seen = time.time()
+        self.live.messages += 1
+        self.message_handlers.get(header, ClientAPI.log_unknown)(self)
 
     def send_client_id(self):
         """ Sends self.client_id. """
         server_log.debug(self.client_id + ': sending id')
-        self.send(Config.API_ID_REQUEST + Config.API_DELIMITER +
-                  self.client_id + Config.TERMINATOR)
+        self.send_message(Config.API_ID_REQUEST, self.client_id)
 
     def send_client_test(self):
-        """ Sends test from queue if non empty, otherwise sends None. """
-        if not self.test_queue.empty():
-            self.test = self.test_queue.get()
-            self.test_args = ", ".join([str(arg) for arg in self.test])
-            # Must guarantee that self.test is no longer a namedtuple after pulling information
-            # this eases the write out to the db for both paths (client test or server test)
-            self.test = type(self.test).__name__
+        """ Sends the scheduler's next test for this host. Waits for the host info of unknown hosts
+            and for a free slot of hosts at their limit, sends None if no test matches.
+        """
+        if self.host_pending:
+            self.test_requested = True
+            return
+        ticket, blocked = self.scheduler.get(self.host_id, self.hosts.get_info(self.host_id))
+        if ticket is not None:
+            self.ticket = ticket
+            self.waiting = False
+            self.test = ticket.request.name
+            self.test_args = ticket.request.get_args_string()
             test_string = self.test + Config.API_DELIMITER + self.test_args
             server_log.debug(self.client_id + ': Sending test-' + test_string)
-            self.send(Config.API_TEST_REQUEST + Config.API_DELIMITER + test_string + Config.TERMINATOR)
+            self.send_message(Config.API_TEST_REQUEST, self.test, self.test_args)
+        elif blocked:
+            if not self.waiting:
+                server_log.debug(self.client_id + ': host {} at its limit, waiting'.format(self.host_id))
+                self.waiting = True
+                self.scheduler.wait(self.host_id, self.retry_test)
         else:
-            server_log.debug(self.client_id + ': test queue is empty, no test sent')
-            self.send(Config.API_TEST_REQUEST + Config.TERMINATOR)
+            self.waiting = False
+            server_log.debug(self.client_id + ': no queued test for host {}, no test sent'.format(self.host_id))
+            self.send_message(Config.API_TEST_REQUEST)
+
+    def retry_test(self):
+        """ Called by the scheduler when a test on this host ended.
+
+            Return:
+                bool: False if the client is still waiting.
+        """
+        if self.run_ended or not self.waiting:
+            return True
+        self.send_client_test()
+        return not self.waiting
 
     def log_client_start(self):
+        """ Accepts binary framing if the client offers it. Clients that do not offer it stay on text. """
         server_log.debug(self.client_id + ': start')
+        if len(self.client_message) > 1 and self.client_message[0] == Config.PROTOCOL_BINARY:
+            version = min(int(self.client_message[1]), protocol.PROTOCOL_VERSION)
+            self.send_message(Config.API_PROTOCOL, version)
+            self.binary_out = True
+            server_log.debug(self.client_id + ': binary protocol version {}'.format(version))
+
+    def log_protocol(self):
+        """ Client marks the end of its text output, everything after is binary. """
+        self.start_binary_input()
 
     def log_client_end(self):
         server_log.debug(self.client_id + ': test finished')
@@ -267,53 +538,376 @@ class ClientAPI(asynchat.async_chat):
         TestServer.TESTS_COMPLETED += 1
         self.handle_close()
 
+    def log_host(self):
+        """ Client sent its host hash. Answers known or unknown, unknown hosts send their info next. """
+        digest = self.client_message[0]
+        self.host_id = self.hosts.lookup(digest)
+        status = hostinfo.HOST_KNOWN if self.host_id is not None else hostinfo.HOST_UNKNOWN
+        self.host_pending = self.host_id is None
+        self.live.update(self.run_id, host_id=self.host_id)
+        self.send_message(Config.API_HOST, digest, status)
+        server_log.debug(self.client_id + ': host {} {}'.format(digest, status))
+
     def log_client_system_info(self):
-        self.client_cpu_info = self.client_message[0]
-        server_log.debug(self.client_id + ': system info gathered')
+        """ Host info and its hash. Older clients send lscpu text only, it is hashed here. """
+        info = self.client_message[0]
+        digest = hostinfo.host_hash(info)
+        self.host_id, new_host = self.hosts.add(digest)
+        if new_host:
+            self.db_writer.insert('hosts', dict(host_id=self.host_id, hash=digest, info=info,
+                                                first_seen=time.strftime('%Y-%m-%d_%H:%M:%S')))
+        self.hosts.set_info(self.host_id, info)
+        self.live.update(self.run_id, host_id=self.host_id)
+        server_log.debug(self.client_id + ': system info gathered, host {}'.format(self.host_id))
+        self.host_pending = False
+        if self.test_requested:
+            self.test_requested = False
+            self.send_client_test()
 
     def log_heartbeat(self):
-        server_log.debug(self.client_id + ': heartbeat')
+        """ Heartbeats are client time and, from newer clients, the client's monotonic ns. """
+        if len(self.client_message) > 1:
+            self.observe_clock(self.client_message[1])
+        self.write_sample(Config.SAMPLE_HEARTBEAT, self.client_time(0), value=1)
+        server_log.debug('%s: heartbeat', self.client_id, extra=log_category(Config.API_HEARTBEAT))
 
     def log_test_stats(self):
-        self.stat_tick += 1
-        self.cpu_total += float(self.client_message[1])
-        self.mem_total += float(self.client_message[3])
-        server_log.debug(self.client_id + ': ' + ' '.join(str(msg) for msg in self.client_message))
+        """ Stats are cpu, mem and client time. Newer clients add client cpu, bytes read and
+            written by the test and bytes read, written and busy share of the test device.
+            Newest clients end with the monotonic ns of the sample. The throughput of an
+            interval is the bytes of the rollovers since the previous stats, the bytes the
+            test moved whether it reads or writes, over the monotonic interval if sent.
+        """
+        cpu = float(self.client_message[0])
+        mem = float(self.client_message[1])
+        client_time = self.client_time(2)
+        if len(self.client_message) > 3 + len(STATS_IO_FIELDS):
+            interval_time = self.observe_clock(self.client_message[3 + len(STATS_IO_FIELDS)])
+        else:
+            interval_time = client_time
+        run = self.get_run()
+        run.cpu.add(cpu)
+        run.mem.add(mem)
+        io_stats = {}
+        if len(self.client_message) >= 3 + len(STATS_IO_FIELDS):
+            io_stats = dict((name, kind(value)) for (name, kind), value in zip(STATS_IO_FIELDS,
+                                                                             self.client_message[3:]))
+        interval_bytes = run.bytes_written - run.last_stat_bytes
+        if run.last_stat_time is not None and interval_time > run.last_stat_time:
+            run.throughput.add(interval_bytes / Config.BYTES_PER_MEGABYTE / (interval_time - run.last_stat_time))
+        run.last_stat_time = interval_time
+        run.last_stat_bytes = run.bytes_written
+        self.write_sample(Config.SAMPLE_STATS, client_time, cpu=cpu, mem=mem, **io_stats)
+        self.live.update(self.run_id, cpu=cpu, mem=mem, client_cpu=io_stats.get('client_cpu'))
+        server_log.debug('%s: CPU %s MEM %s', self.client_id, cpu, mem, extra=log_category(Config.API_TEST_STATS))
 
     def log_test_info(self):
-        self.files_written += 1
-        self.write_stop = time.time()
-        server_log.debug(self.client_id + ': file roll over')
+        """ Rollovers are client time, worker index, bytes written and the client's monotonic
+            ns at the start and end of the file. Older clients send fewer fields, down to
+            client time or nothing, their rollovers count as worker 0 writing one file_size file.
+        """
+        run = self.get_run()
+        worker = client_int(self.client_message[1]) if len(self.client_message) > 1 else 0
+        file_bytes = client_int(self.client_message[2]) if len(self.client_message) > 2 else run.rollover_bytes
+        start_ns = end_ns = duration = None
+        if len(self.client_message) > 4 and self.client_message[3] not in (None, 'None'):
+            start_ns = client_int(self.client_message[3])
+            end_ns = client_int(self.client_message[4])
+            self.observe_clock(end_ns)
+            duration = (end_ns - start_ns) / Config.NANO_SECONDS_PER_SECOND
+            run.file_duration.add(duration)
+            run.start_ns = start_ns if run.start_ns is None else min(run.start_ns, start_ns)
+            run.end_ns = end_ns if run.end_ns is None else max(run.end_ns, end_ns)
+        run.files_written += 1
+        run.bytes_written += file_bytes or 0
+        run.write_stop = time.time()
+        stats = run.worker_stats.get(worker)
+        if stats is None:
+            stats = run.worker_stats[worker] = [0, 0, 0, start_ns, end_ns]
+        stats[0] += 1
+        stats[1] += file_bytes or 0
+        stats[2] = run.write_stop
+        if end_ns is not None:
+            stats[3] = start_ns if stats[3] is None else min(stats[3], start_ns)
+            stats[4] = end_ns if stats[4] is None else max(stats[4], end_ns)
+        target = self.target_of(worker)
+        if target is not None:
+            target.files_written += 1
+            target.bytes_written += file_bytes or 0
+            if end_ns is not None:
+                target.file_duration.add(duration)
+                target.start_ns = start_ns if target.start_ns is None else min(target.start_ns, start_ns)
+                target.end_ns = end_ns if target.end_ns is None else max(target.end_ns, end_ns)
+        self.write_sample(Config.SAMPLE_ROLLOVER, self.client_time(0), value=file_bytes, duration=duration)
+        self.live.rollover(self.run_id, file_bytes or 0)
+        server_log.debug('%s: file roll over (worker %s)', self.client_id, worker,
+                         extra=log_category(Config.API_TEST_FILE_WRITE))
+
+    def log_test_target(self):
+        """ Targets are index, path, device major and minor, filesystem, block size, first worker
+            and workers of a directory the test writes to.
+        """
+        try:
+            index, path, major, minor, filesystem, block_size, first_worker, workers = self.client_message[:8]
+            target = TargetState(client_int(index), path, optional_int(major), optional_int(minor),
+                                 None if filesystem in (None, 'None') else filesystem,
+                                 client_int(block_size), client_int(first_worker), client_int(workers))
+        except (ValueError, TypeError) as e:
+            server_log.debug(self.client_id + ': bad target {!r}'.format(e))
+            return
+        self.get_run().targets[target.index] = target
+        server_log.debug(self.client_id + ': target {} {} on {}:{} ({})'.format(target.index, target.path,
+                                                                             target.major, target.minor,
+                                                                             target.filesystem))
+
+    def log_test_target_stats(self):
+        """ Target stats are target index, client time, monotonic ns, cpu and mem of the target's
+            workers, bytes they read and wrote and bytes read, written and busy share of its device.
+        """
+        try:
+            target = self.get_run().targets[int(self.client_message[0])]
+            cpu, mem = float(self.client_message[3]), float(self.client_message[4])
+            read_bytes, write_bytes = client_int(self.client_message[5]), client_int(self.client_message[6])
+            disk_read_bytes = optional_int(self.client_message[7])
+            disk_write_bytes = optional_int(self.client_message[8])
+            disk_busy = None if self.client_message[9] in (None, 'None') else float(self.client_message[9])
+        except (IndexError, KeyError, ValueError, TypeError) as e:
+            server_log.debug(self.client_id + ': bad target stats {!r}'.format(e))
+            return
+        interval_time = self.observe_clock(self.client_message[2])
+        interval_bytes = target.bytes_written - target.last_stat_bytes
+        if target.last_stat_time is not None and interval_time > target.last_stat_time:
+            target.throughput.add(interval_bytes / Config.BYTES_PER_MEGABYTE / (interval_time - target.last_stat_time))
+        target.last_stat_time = interval_time
+        target.last_stat_bytes = target.bytes_written
+        if disk_busy is not None:
+            target.disk_busy.add(disk_busy)
+        self.write_sample(Config.SAMPLE_TARGET_STATS, self.client_time(1), cpu=cpu, mem=mem, target=target.index,
+                          read_bytes=read_bytes, write_bytes=write_bytes, disk_read_bytes=disk_read_bytes,
+                          disk_write_bytes=disk_write_bytes, disk_busy=disk_busy)
+        server_log.debug('%s: target %s CPU %s DISK %s', self.client_id, target.index, cpu, disk_busy,
+                         extra=log_category(Config.API_TEST_TARGET_STATS))
+
+    def target_of(self, worker):
+        """ Returns the TargetState worker writes to, None for clients that send no targets. """
+        for target in self.run.targets.itervalues():
+            if target.first_worker <= worker < target.first_worker + target.workers:
+                return target
+        return None
+
+    def log_test_latency(self):
+        """ Latency snapshots are client time, worker index and an encoded LogHistogram. """
+        try:
+            snapshot = LogHistogram.decode(self.client_message[2])
+            run = self.get_run()
+            if run.write_latency is None:
+                run.write_latency = LogHistogram()
+            run.write_latency.merge(snapshot)
+        except (IndexError, ValueError) as e:
+            server_log.debug(self.client_id + ': bad latency snapshot {!r}'.format(e))
+
+    def log_test_result(self):
+        """ Results are client time, worker index, metric name and value. """
+        try:
+            metric = self.client_message[2]
+            self.get_run().results.setdefault(metric, []).append(float(self.client_message[3]))
+        except (IndexError, ValueError) as e:
+            server_log.debug(self.client_id + ': bad test result {!r}'.format(e))
 
     def log_run_test(self):
         TestServer.TESTS_RAN += 1
         self.start_time = time.strftime('%Y-%m-%d_%H:%M:%S')
-        self.write_start = time.time()
         self.test = self.client_message[0]
         self.test_args = self.client_message[1]
+        run = self.get_run()
+        run.write_start = time.time()
+        run.rollover_bytes = self.file_size_bytes()
+        self.live.test_start(self.run_id, self.test, self.host_id)
         server_log.debug(self.client_id + ': Running {} {}'.format(self.test, self.test_args))
 
     def log_bad_timeout(self):
-        server_log.debug(self.client_id + ': timeout too low, timeout set to ' + self.client_message[0])
+        server_log.debug(self.client_id + ': timeout too low, timeout set to ' + str(self.client_message[0]))
 
     def log_unknown(self):
         server_log.debug(self.client_id + ': Unknown command from client({})'.format(self.client_header))
 
+    def client_time(self, index):
+        """ Returns the client timestamp at client_message[index]. Older clients do not
+            send timestamps, in that case the server time is used.
+        """
+        try:
+            return float(self.client_message[index])
+        except (IndexError, ValueError):
+            return time.time()
+
+    def observe_clock(self, client_ns):
+        """ Updates the offset of the server's clock to the client's monotonic clock with a
+            client timestamp that just arrived. Network and loop delay only add to the
+            difference, so the smallest one seen is the best estimate.
+
+            Return:
+                float: client_ns in seconds.
+        """
+        client_seconds = int(client_ns) / Config.NANO_SECONDS_PER_SECOND
+        offset = time.time() - client_seconds
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        return client_seconds
+
+    def file_size_bytes(self):
+        """ Returns bytes per rollover for older clients that do not send them, None if unknown. """
+        try:
+            return literal_eval(self.test_args)['file_size'] * Config.BYTES_PER_MEGABYTE
+        except (ValueError, SyntaxError, TypeError, KeyError):
+            return None
+
+    def aggregate_results(self):
+        """ Combines the results of all workers per metric with the aggregate the test declares.
+
+            Return:
+                list[tuple]: (metric, value, unit) for every reported metric.
+        """
+        try:
+            declared = dict((metric.name, metric) for metric in testregistry.get_test(self.test).metrics)
+        except ValueError:
+            declared = {}
+        aggregates = {'sum': sum, 'max': max, 'min': min, 'mean': lambda values: sum(values) / len(values)}
+        results = []
+        for name, values in sorted(self.run.results.iteritems()):
+            metric = declared.get(name)
+            aggregate = aggregates[metric.aggregate if metric else 'sum']
+            results.append((name, aggregate(values), metric.unit if metric else None))
+        return results
+
+    def write_sample(self, kind, client_time, cpu=None, mem=None, value=None, duration=None, target=None,
+                     **io_stats):
+        """ Queues one row for the samples table. io_stats are columns named in STATS_IO_FIELDS. """
+        self.samples += 1
+        row = dict(run_id=self.run_id, client_time=client_time, kind=kind, cpu=cpu, mem=mem, value=value,
+                   duration=duration, target=target)
+        row.update(io_stats)
+        self.db_writer.insert('samples', row)
+
+    def write_speed(self, bytes_written, write_stop, start_ns=None, end_ns=None):
+        """ Returns MB/s for bytes_written over the client's monotonic interval from start_ns to
+            end_ns, or for older clients between the test start and write_stop on the server.
+        """
+        if start_ns is not None:
+            if end_ns <= start_ns:
+                return 0
+            seconds = (end_ns - start_ns) / Config.NANO_SECONDS_PER_SECOND
+            return (bytes_written / Config.BYTES_PER_MEGABYTE) / seconds
+        if write_stop <= self.run.write_start:
+            return 0
+        return (bytes_written / Config.BYTES_PER_MEGABYTE) / (write_stop - self.run.write_start)
+
     def write_to_db(self):
-        """ Write out test information to database. """
+        """ Write out test information and per-worker results to database. """
         if self.test:
-            if self.stat_tick:
-                self.avg_cpu = self.mem_total / self.stat_tick
-                self.avg_mem = self.cpu_total / self.stat_tick
-            if self.test == Config.TEST_FILE_WRITE_NAME:
-                arg_dict = literal_eval(self.test_args)
-                self.avg_write_speed = (self.files_written * arg_dict['file_size']) / (self.write_stop - self.write_start)
-            entries = (self.test + '\n' + self.test_args, self.start_time, self.end_time, self.files_written,
-                       self.avg_write_speed, self.avg_cpu, self.avg_mem, self.client_cpu_info, self.test_status)
-            self.db_cursor.execute('INSERT INTO tests VALUES (?,?,?,?,?,?,?,?,?);', entries)
+            run = self.get_run()
+            run.avg_write_speed = self.write_speed(run.bytes_written, run.write_stop, run.start_ns, run.end_ns)
+            write_latency = run.write_latency or LogHistogram()
+            for worker, (files_written, bytes_written, write_stop, start_ns, end_ns) in run.worker_stats.iteritems():
+                target = self.target_of(worker)
+                self.db_writer.insert('run_workers', dict(run_id=self.run_id,
+                                                          worker=worker,
+                                                          target=target.index if target else None,
+                                                          files_written=files_written,
+                                                          bytes_written=bytes_written,
+                                                          write_speed=self.write_speed(bytes_written, write_stop,
+                                                                                       start_ns, end_ns)))
+            for metric, value, unit in self.aggregate_results():
+                self.db_writer.insert('run_metrics', dict(run_id=self.run_id, metric=metric, value=value, unit=unit))
+            for metric, stats in ((Config.METRIC_CPU, run.cpu), (Config.METRIC_MEM, run.mem),
+                                  (Config.METRIC_THROUGHPUT, run.throughput),
+                                  (Config.METRIC_FILE_DURATION, run.file_duration)):
+                if stats.count:
+                    self.db_writer.insert('run_stats', dbwriter.run_stats_row(self.run_id, metric, stats))
+            self.write_targets()
+            percentiles = write_latency.percentiles()
+            if write_latency.count:
+                self.db_writer.insert('histograms', dict(run_id=self.run_id,
+                                                         metric=Config.METRIC_WRITE_LATENCY,
+                                                         count=write_latency.count,
+                                                         histogram=write_latency.encode()))
+            self.db_writer.insert('tests', dict(test=self.test + '\n' + self.test_args,
+                                                test_name=self.test,
+                                                start_time=self.start_time,
+                                                end_time=self.end_time,
+                                                files_written=run.files_written,
+                                                bytes_written=run.bytes_written,
+                                                write_speed=run.avg_write_speed,
+                                                avg_cpu=run.cpu.mean if run.cpu.count else 0,
+                                                avg_mem=run.mem.mean if run.mem.count else 0,
+                                                host_id=self.host_id,
+                                                clock_offset=self.clock_offset,
+                                                status=self.test_status,
+                                                run_id=self.run_id,
+                                                latency_p50=percentiles[50],
+                                                latency_p90=percentiles[90],
+                                                latency_p99=percentiles[99],
+                                                latency_p999=percentiles[99.9],
+                                                latency_max=write_latency.max))
+        if self.samples > Config.SAMPLES_MAX_PER_RUN:
+            self.db_writer.call(dbwriter.downsample_run, self.run_id, Config.SAMPLES_MAX_PER_RUN)
+
+    def write_targets(self):
+        """ Writes a run_targets row per target, and the target's stats if the test had several. """
+        run = self.run
+        for target in run.targets.itervalues():
+            self.db_writer.insert('run_targets', dict(run_id=self.run_id,
+                                                      target=target.index,
+                                                      host_id=self.host_id,
+                                                      path=target.path,
+                                                      major=target.major,
+                                                      minor=target.minor,
+                                                      filesystem=target.filesystem,
+                                                      block_size=target.block_size,
+                                                      workers=target.workers,
+                                                      files_written=target.files_written,
+                                                      bytes_written=target.bytes_written,
+                                                      write_speed=self.write_speed(target.bytes_written,
+                                                                                   run.write_stop,
+                                                                                   target.start_ns,
+                                                                                   target.end_ns)))
+            if len(run.targets) < 2:
+                continue
+            for metric, stats in ((Config.METRIC_THROUGHPUT, target.throughput),
+                                  (Config.METRIC_DISK_BUSY, target.disk_busy),
+                                  (Config.METRIC_FILE_DURATION, target.file_duration)):
+                if stats.count:
+                    self.db_writer.insert('run_stats', dbwriter.run_stats_row(self.run_id, metric, stats,
+                                                                              target.index))
+
+    message_handlers = {Config.API_CLIENT_START: log_client_start,
+                        Config.API_ID_REQUEST: send_client_id,
+                        Config.API_SYSTEM_INFO: log_client_system_info,
+                        Config.API_HOST: log_host,
+                        Config.API_RUNNING_TEST: log_run_test,
+                        Config.API_TEST_REQUEST: send_client_test,
+                        Config.API_CLIENT_END: log_client_end,
+                        Config.API_HEARTBEAT: log_heartbeat,
+                        Config.API_TEST_STATS: log_test_stats,
+                        Config.API_TEST_FILE_WRITE: log_test_info,
+                        Config.API_TEST_LATENCY: log_test_latency,
+                        Config.API_TEST_RESULT: log_test_result,
+                        Config.API_TEST_TARGET: log_test_target,
+                        Config.API_TEST_TARGET_STATS: log_test_target_stats,
+                        Config.API_BAD_TIMEOUT: log_bad_timeout,
+                        Config.API_PROTOCOL: log_protocol}
 
 if __name__ == '__main__':
-    server = TestServer(Config.HOST, Config.PORT)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--engine', dest='engine', default=Config.SERVER_ENGINE,
+                        choices=sorted(serverengine.ENGINES), help='event loop engine')
+    parser.add_argument('-l', '--live-port', dest='live_port', default=Config.LIVE_PORT, type=int,
+                        help='port of the live metrics endpoint, 0 to disable it')
+    parser.add_argument('-m', '--missed-heartbeats', dest='missed_heartbeats', type=float,
+                        default=Config.LIVENESS_MISSED_HEARTBEATS,
+                        help='heartbeat intervals without a message before a client is timed out')
+    cmd_input = parser.parse_args()
+    server = TestServer(Config.HOST, Config.PORT, live_port=cmd_input.live_port, engine=cmd_input.engine,
+                        missed_heartbeats=cmd_input.missed_heartbeats)
     try:
         server.run()
     except KeyboardInterrupt:
@@ -0,0 +1,78 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import math
+import time
+from config import Config
+""" Hashed timer wheel for deadlines of many connections.
+
+The wheel is a ring of slots, each covering resolution seconds. A key is
+put in the slot its deadline falls in, so schedule() and cancel() are a
+set add and remove, and advance() only visits the slots of the ticks that
+passed since the last call. Deadlines further away than one turn of the
+wheel share a slot with nearer ones and are kept there until their own
+turn comes. Deadlines fire up to one resolution late, never early.
+
+Example:
+    wheel = TimerWheel(resolution=1.0, slots=64)
+    wheel.schedule('client', time.time() + 15)
+    for key in wheel.advance(time.time()):
+        print key, 'expired'
+"""
+
+
+class TimerWheel(object):
+    """ Timer wheel of keys and their deadlines.
+
+        Args:
+            resolution (optional[float]): seconds per slot.
+            slots (optional[int]): slots in the wheel.
+            start (optional[float]): time the wheel starts at, now if None.
+    """
+    def __init__(self, resolution=Config.LIVENESS_RESOLUTION, slots=Config.LIVENESS_SLOTS, start=None):
+        self.resolution = resolution
+        self.wheel = [set() for _ in xrange(slots)]
+        self.entries = {}
+        self.tick = self.tick_of(time.time() if start is None else start) - 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def tick_of(self, when):
+        return int(math.floor(when / self.resolution))
+
+    def schedule(self, key, deadline):
+        """ Sets the deadline of key, replacing an earlier one. """
+        self.cancel(key)
+        index = max(self.tick_of(deadline), self.tick + 1) % len(self.wheel)
+        self.entries[key] = (deadline, index)
+        self.wheel[index].add(key)
+
+    def cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.wheel[entry[1]].discard(key)
+
+    def advance(self, now):
+        """ Moves the wheel past every tick that ended by now.
+
+            Return:
+                list: keys whose deadlines passed, in no particular order. They are removed
+                      from the wheel.
+        """
+        last = self.tick_of(now) - 1
+        if last <= self.tick:
+            return []
+        expired = []
+        for tick in xrange(max(self.tick + 1, last - len(self.wheel) + 1), last + 1):
+            slot = self.wheel[tick % len(self.wheel)]
+            if not slot:
+                continue
+            for key in [key for key in slot if self.entries[key][0] <= now]:
+                slot.discard(key)
+                del self.entries[key]
+                expired.append(key)
+        self.tick = last
+        return expired
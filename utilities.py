@@ -1,11 +1,46 @@
 __author__ = 'Tristan Storz'
 import os
 import subprocess
+import time
+import ctypes
+import ctypes.util
 from config import Config
 
 LINUX_MEM_INFO_LOCATION = '/proc/meminfo'
 LINUX_STAT_LOCATION = '/proc/stat'
 LINUX_PROCESS_STAT_LOCATION = '/proc/%d/stat'
+POSIX_FADV_DONTNEED = 4
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+CLOCK_MONOTONIC = 1
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _TimeSpec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def monotonic_ns():
+    """ Returns CLOCK_MONOTONIC in integer nanoseconds. Uses time.monotonic_ns when present,
+        clock_gettime through ctypes otherwise. The clock only compares with itself on the
+        same host, it is not affected by changes of the wall clock.
+    """
+    if _monotonic_ns is not None:
+        return _monotonic_ns()
+    timespec = _TimeSpec()
+    if _libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return timespec.tv_sec * Config.NANO_SECONDS_PER_SECOND + timespec.tv_nsec
+
+
+_monotonic_ns = getattr(time, 'monotonic_ns', None)
 
 
 def get_total_cpu_clock_cycles():
@@ -87,3 +122,97 @@ def verify_dir_exists(directory):
         except os.error as e:
             print 'could not create directory {}'.format(directory)
             raise e
+
+
+def posix_fallocate(file_descriptor, offset, length):
+    """ Allocates disk space for offset + length bytes of file_descriptor.
+        Uses os.posix_fallocate when present, libc otherwise.
+    """
+    if hasattr(os, 'posix_fallocate'):
+        return os.posix_fallocate(file_descriptor, offset, length)
+    error = _libc.posix_fallocate(file_descriptor, ctypes.c_longlong(offset), ctypes.c_longlong(length))
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+def pread(file_descriptor, size, offset=0):
+    """ Reads up to size bytes at offset. Uses os.pread when present, which leaves the file
+        position alone, lseek and read otherwise, which costs less than pread through ctypes
+        but leaves the position at offset + len(data). Callers sharing file_descriptor with
+        sequential reads or writes must not rely on the position afterwards.
+    """
+    if hasattr(os, 'pread'):
+        return os.pread(file_descriptor, size, offset)
+    os.lseek(file_descriptor, offset, os.SEEK_SET)
+    return os.read(file_descriptor, size)
+
+
+def posix_fadvise(file_descriptor, offset, length, advice):
+    """ Passes advice about the access pattern of file_descriptor to the kernel.
+        Uses os.posix_fadvise when present, libc otherwise.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise(file_descriptor, offset, length, advice)
+    error = _libc.posix_fadvise(file_descriptor, ctypes.c_longlong(offset), ctypes.c_longlong(length), advice)
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+def sync_file_range(file_descriptor, offset, length, flags):
+    """ Starts and/or waits for writeback of length bytes of file_descriptor at offset, see
+        SYNC_FILE_RANGE_*. Neither metadata nor the device's cache are flushed. Uses
+        os.sync_file_range when present, libc otherwise. Linux only.
+    """
+    if hasattr(os, 'sync_file_range'):
+        return os.sync_file_range(file_descriptor, offset, length, flags)
+    if _libc.sync_file_range(file_descriptor, ctypes.c_longlong(offset), ctypes.c_longlong(length),
+                             ctypes.c_uint(flags)):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def syncfs(file_descriptor):
+    """ Writes out the dirty data and metadata of the filesystem holding file_descriptor,
+        of every filesystem if libc has no syncfs.
+    """
+    try:
+        function = _libc.syncfs
+    except AttributeError:
+        _libc.sync()
+        return
+    if function(file_descriptor):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def make_iovecs(buffers):
+    """ Returns an iovec array for buffers that can be passed to writev repeatedly.
+        The caller must keep buffers alive for as long as the array is used.
+    """
+    iovecs = (_IOVec * len(buffers))()
+    for iovec, buf in zip(iovecs, buffers):
+        iovec.iov_base = ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p)
+        iovec.iov_len = len(buf)
+    return iovecs
+
+
+def writev(file_descriptor, buffers, iovecs=None):
+    """ Writes buffers with a single writev call. Uses os.writev when present, libc otherwise.
+
+        Args:
+            file_descriptor (int): open file.
+            buffers (list[str]): data to write.
+            iovecs (optional): array from make_iovecs(buffers), built here if not given.
+
+        Return:
+            int: bytes written.
+    """
+    if hasattr(os, 'writev'):
+        return os.writev(file_descriptor, buffers)
+    if iovecs is None:
+        iovecs = make_iovecs(buffers)
+    written = _libc.writev(file_descriptor, iovecs, len(buffers))
+    if written < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return written
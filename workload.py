@@ -0,0 +1,287 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import os
+import time
+import multiprocessing
+import utilities
+from hostinfo import get_filesystem
+from loggers import test_log, log_category
+from config import Config
+from messagechannel import MessageChannel
+from procsampler import ProcSampler, block_device_of_path
+""" Base class for tests run by TestClient.
+
+A Workload runs run_worker(worker) in workers processes next to a
+heartbeat and a stats process, for test_timeout_sec seconds. The stats
+process samples the workers and the client with a ProcSampler every
+stats_interval seconds, which may be below a second. Subclasses
+declare name, parameters and metrics for testregistry and implement
+run_worker. Workers report through message_channel:
+
+    send_rollover(worker, nbytes, start_ns)
+                                         a file or pass finished, nbytes moved
+                                         since start_ns.
+    report_latency(worker, latency)      LogHistogram of microseconds per I/O,
+                                         sent every Config.TEST_LATENCY_TIME.
+    send_result(worker, metric, value)   a declared metric, combined over
+                                         workers by its aggregate.
+
+Rollovers, stats and heartbeats carry utilities.monotonic_ns() of the
+client's host. A rollover carries the monotonic start and end of its
+file or pass, the start defaults to the end of the worker's previous
+rollover. The server takes throughput and per-file durations from these
+intervals instead of from when the messages arrive.
+
+A Workload writes to one or more targets, directories that may be on
+different devices (Config.TEST_LOG_DIR by default). Every target gets
+workers worker processes of its own, worker w of target t has the index
+t * workers + w, and its files go into the target's directory. Before
+the workers start, every target is sent as
+
+    target(index, path, major, minor, filesystem, block_size, first worker, workers)
+
+so the server can attribute rollovers to the device. major and minor
+are those of the block device backing the target (see procsampler.py),
+None with a warning if there is none. With more than one target the
+stats process also sends target stats per target: cpu, mem and I/O bytes
+of the target's workers and the counters of its device, None without a
+device.
+
+Workers run until stop is set. When the timeout expires run() sets stop,
+gives the workers Config.TEST_STOP_TIMEOUT seconds to send their final
+latency and results and then sets end_of_test, which ends the session.
+
+Example:
+    test = testregistry.create('seq_read', kwargs=dict(timeout=5))
+    test.run()
+    print test.message_channel.read_available()
+"""
+
+
+def parse_targets(targets):
+    """ Returns the list of target directories of targets, a comma separated string, a list or None. """
+    if not targets:
+        return [Config.TEST_LOG_DIR]
+    if isinstance(targets, basestring):
+        targets = targets.split(',')
+    return [path.strip() for path in targets if path.strip()]
+
+
+class Target(object):
+    """ A directory a test writes to and the block device and filesystem holding it. The
+        directory is created if missing. major and minor are None if no block device backs it.
+
+        Args:
+            index (int): position of the target in the test's targets.
+            path (str): directory to write to.
+    """
+    def __init__(self, index, path):
+        utilities.verify_dir_exists(path)
+        self.index = index
+        self.path = path
+        self.major, self.minor = block_device_of_path(path) or (None, None)
+        if self.major is None:
+            test_log.warning('No block device found for target {}, its disk counters are not sampled'.format(path))
+        self.filesystem = get_filesystem(path)
+        self.block_size = os.statvfs(path).f_bsize
+
+
+class Workload(object):
+    """ Initializes the shared test state.
+
+        Args:
+            timeout (float): test timeout time in seconds.
+            workers (optional[int]): number of concurrent worker processes.
+            stats_interval (optional[float]): seconds between stats samples.
+            targets (optional[str or list]): directories to test, comma separated if a string,
+                Config.TEST_LOG_DIR if None.
+    """
+    name = None
+    parameters = []
+    metrics = []
+
+    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, workers=1, stats_interval=Config.TEST_STATS_TIME,
+                 targets=None):
+        self.test_timeout_sec = timeout
+        self.workers = max(int(workers), 1)
+        self.targets = [Target(index, path) for index, path in enumerate(parse_targets(targets))]
+        self.stats_interval = max(stats_interval or Config.TEST_STATS_TIME, Config.TEST_STATS_MIN_TIME)
+        self.message_channel = MessageChannel()
+        self.end_of_test = multiprocessing.Event()
+        self.stop = multiprocessing.Event()
+        self.latency_sent = 0
+        self.rollover_ns = None
+
+    @classmethod
+    def get_test_name(cls):
+        return cls.name
+
+    def get_args(self):
+        """ Return:
+                list[tuple]: parameters reported with the test, subclasses add their own.
+        """
+        return [('timeout', self.test_timeout_sec), ('workers', self.workers),
+                ('stats_interval', self.stats_interval)]
+
+    def get_test_args(self):
+        return str(dict(self.get_args()))
+
+    def target_of(self, worker):
+        return self.targets[worker // self.workers]
+
+    def test_file_name(self, worker, number):
+        return os.path.join(self.target_of(worker).path, '{}_{}_{}'.format(os.getpid(), worker, number))
+
+    def create_test_file(self, worker, nbytes, number='data'):
+        """ Writes and syncs a file of nbytes for workloads that read or overwrite existing data.
+
+            Return:
+                str: file name, the caller removes the file.
+        """
+        file_name = self.test_file_name(worker, number)
+        chunk = Config.TEST_FILL_BYTE * Config.BYTES_PER_MEGABYTE
+        file_descriptor = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            remaining = nbytes
+            while remaining > 0:
+                remaining -= os.write(file_descriptor, chunk[:remaining])
+            os.fsync(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+        return file_name
+
+    def run(self):
+        """ Spawns the worker processes, a heartbeat and a stats process and then waits
+            for test time to end. Upon ending, stops the processes, waits for the workers
+            to report and sets the end_of_test Event.
+        """
+        test_log.debug('Creating {} worker processes for {} targets'.format(self.workers, len(self.targets)))
+        for target in self.targets:
+            self.message_channel.put(Config.API_TEST_TARGET, target.index, target.path, target.major, target.minor,
+                                     target.filesystem, target.block_size, target.index * self.workers,
+                                     self.workers)
+        tests = []
+        for worker in xrange(self.workers * len(self.targets)):
+            test = multiprocessing.Process(target=self.worker_main, args=(worker,))
+            test.start()
+            tests.append(test)
+        multiprocessing.Process(target=self.send_heartbeat).start()
+        multiprocessing.Process(target=self.gather_stats, args=([test.pid for test in tests], os.getppid())).start()
+
+        test_log.debug('Beginning test loop')
+        end_time = time.time() + self.test_timeout_sec
+        while time.time() < end_time:
+            time.sleep(Config.TEST_TIMEOUT_CHECK)
+        self.stop.set()
+        stop_deadline = time.time() + Config.TEST_STOP_TIMEOUT
+        for test in tests:
+            test.join(max(stop_deadline - time.time(), 0))
+        test_log.debug('Test ended')
+        self.end_of_test.set()
+
+    def worker_main(self, worker):
+        self.latency_sent = time.time()
+        self.rollover_ns = utilities.monotonic_ns()
+        self.run_worker(worker)
+
+    def run_worker(self, worker):
+        """ Runs one worker until stop is set.
+            Args:
+                worker (int): index of this worker, used in its file names and messages.
+        """
+        raise NotImplementedError
+
+    def send_heartbeat(self):
+        """ Continues writing out message event until stop is set """
+        while not self.stop.wait(Config.TEST_HEARTBEAT_TIME):
+            self.message_channel.put(Config.API_HEARTBEAT, time.time(), utilities.monotonic_ns())
+            test_log.debug('Heartbeat', extra=log_category(Config.API_HEARTBEAT))
+
+    def gather_stats(self, test_pids, client_pid=None):
+        """ Continues writing out cpu/mem/io info summed over input pids every stats_interval
+            until stop is set. Stats are cpu, mem, time, client cpu, bytes read and written by
+            the test pids, bytes read, written and busy share of the test devices and the
+            monotonic time of the sample in nanoseconds. With more than one target, target
+            stats follow for every target.
+            Args:
+                test_pids (list[int]): pids of processes to monitor.
+                client_pid (optional[int]): pid of the client forwarding test messages.
+        """
+        try:
+            sampler = ProcSampler(test_pids + ([client_pid] if client_pid else []),
+                                  [(target.major, target.minor) for target in self.targets
+                                   if target.major is not None])
+        except (OSError, IOError) as e:
+            test_log.debug('{} process data could not be gathered from Linux proc files: {}'.format(self.name, e))
+            return
+        next_sample = time.time() + self.stats_interval
+        try:
+            while not self.stop.wait(max(next_sample - time.time(), 0)):
+                next_sample += self.stats_interval
+                stats = sampler.sample()
+                cpu = sum(stats['cpu'].get(pid, 0) for pid in test_pids)
+                mem = sum(stats['mem'].get(pid, 0) for pid in test_pids)
+                self.message_channel.put(Config.API_TEST_STATS, cpu, mem, stats['time'],
+                                         stats['cpu'].get(client_pid, 0),
+                                         sum(stats['read_bytes'].get(pid, 0) for pid in test_pids),
+                                         sum(stats['write_bytes'].get(pid, 0) for pid in test_pids),
+                                         stats['disk_read_bytes'], stats['disk_write_bytes'], stats['disk_busy'],
+                                         utilities.monotonic_ns())
+                if len(self.targets) > 1:
+                    self.send_target_stats(stats, test_pids)
+                test_log.debug('Stats: CPU %3.5f%% MEM %3.5f%% DISK %3.5f%%', cpu, mem, stats['disk_busy'],
+                               extra=log_category(Config.API_TEST_STATS))
+        finally:
+            sampler.close()
+
+    def send_target_stats(self, stats, test_pids):
+        """ Sends target stats: target index, time, monotonic ns, cpu, mem, bytes read and written
+            by the target's workers and bytes read, written and busy share of its device.
+        """
+        now_ns = utilities.monotonic_ns()
+        for target in self.targets:
+            pids = test_pids[target.index * self.workers:(target.index + 1) * self.workers]
+            disk_read, disk_write, disk_busy = stats['devices'].get((target.major, target.minor),
+                                                                   (None, None, None))
+            self.message_channel.put(Config.API_TEST_TARGET_STATS, target.index, stats['time'], now_ns,
+                                     sum(stats['cpu'].get(pid, 0) for pid in pids),
+                                     sum(stats['mem'].get(pid, 0) for pid in pids),
+                                     sum(stats['read_bytes'].get(pid, 0) for pid in pids),
+                                     sum(stats['write_bytes'].get(pid, 0) for pid in pids),
+                                     disk_read, disk_write, disk_busy)
+
+    def send_rollover(self, worker, nbytes, start_ns=None):
+        """ Sends a finished file or pass of nbytes.
+            Args:
+                worker (int): index of the worker.
+                nbytes (int): bytes moved.
+                start_ns (optional[int]): monotonic_ns() when the file was started, the end of
+                    the worker's previous rollover if None.
+        """
+        end_ns = utilities.monotonic_ns()
+        if start_ns is None:
+            start_ns = self.rollover_ns
+        self.rollover_ns = end_ns
+        self.message_channel.put(Config.API_TEST_FILE_WRITE, time.time(), worker, nbytes, start_ns, end_ns)
+
+    def report_latency(self, worker, latency, final=False):
+        """ Sends the latencies recorded since the last snapshot and resets latency, once
+            Config.TEST_LATENCY_TIME has passed since the last snapshot or when final.
+            Args:
+                worker (int): index of the worker that recorded latency.
+                latency (LogHistogram): microseconds per I/O.
+                final (optional[bool]): send now, the worker is done.
+        """
+        now = time.time()
+        if not final and now - self.latency_sent < Config.TEST_LATENCY_TIME:
+            return
+        self.latency_sent = now
+        if latency.count:
+            # Snapshots are split so each message stays below the pipe's atomic write size
+            for part in latency.encode_parts(Config.CHANNEL_MAX_MESSAGE // 2):
+                self.message_channel.put(Config.API_TEST_LATENCY, now, worker, part)
+            latency.reset()
+
+    def send_result(self, worker, metric, value):
+        """ Sends the value of a declared metric measured by worker. """
+        self.message_channel.put(Config.API_TEST_RESULT, time.time(), worker, metric, value)
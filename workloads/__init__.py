@@ -0,0 +1,10 @@
+__author__ = 'Tristan Storz'
+""" Workloads shipped next to FileWriteTest.
+
+Every module in this package is imported by testregistry.discover(), so
+a module that registers a Workload subclass is all a new test needs.
+
+    seqread    seq_read     sequential reads of a synced file.
+    randomio   random_io    random io_size reads and writes at aligned offsets.
+    mmapwrite  mmap_write   stores into memory mapped files, msync per file.
+"""
@@ -0,0 +1,108 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import os
+import mmap
+import time
+import testregistry
+from testregistry import Parameter, Metric
+from histogram import LogHistogram
+from loggers import test_log, log_category
+from config import Config
+from workload import Workload
+""" Memory Mapped Write Test
+
+Each worker sizes a new file_size file with ftruncate, maps it and fills
+it with io_size stores until the file is full. With sync the mapping is
+flushed with msync before the file is closed, so the file's data has
+reached the device when the rollover is reported. Store latency includes
+the page faults that allocate the file's pages.
+
+Example:
+    test = MmapWriteTest(10, file_size=64, io_size=64 * 1024)
+    test.run()
+"""
+
+DEFAULT_IO_SIZE = 64 * 1024
+
+
+@testregistry.register
+class MmapWriteTest(Workload):
+    """ Initializes test.
+
+        Args:
+            timeout (float): test timeout time in seconds.
+            file_size (int): size of files to write in MB.
+            io_size (optional[int]): bytes per store into the mapping.
+            sync (optional[bool]): msync every file before closing it.
+            workers (optional[int]): number of concurrent writer processes.
+            stats_interval (optional[float]): seconds between stats samples.
+    """
+    name = 'mmap_write'
+    parameters = [Parameter('timeout', float, Config.TEST_DEFAULT_TIMEOUT_SEC, 'runtime in seconds'),
+                  Parameter('file_size', int, Config.TEST_DEFAULT_FILE_SIZE_MB, 'size of test files in MB'),
+                  Parameter('io_size', int, DEFAULT_IO_SIZE, 'bytes per store'),
+                  Parameter('sync', bool, True, 'msync every file before closing it'),
+                  Parameter('workers', int, 1, 'concurrent writer processes'),
+                  Parameter('stats_interval', float, Config.TEST_STATS_TIME, 'seconds between stats samples')]
+    metrics = [Metric('write_speed', 'MB/s', 'sum', 'write throughput of all workers'),
+               Metric('msync_time', 'ms', 'mean', 'time to msync one file')]
+
+    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, file_size=Config.TEST_DEFAULT_FILE_SIZE_MB,
+                 io_size=DEFAULT_IO_SIZE, sync=True, workers=1,
+                 stats_interval=Config.TEST_STATS_TIME):
+        Workload.__init__(self, timeout, workers, stats_interval)
+        self.file_size_mb = file_size
+        self.io_size = io_size or DEFAULT_IO_SIZE
+        self.sync = sync
+
+    def get_args(self):
+        return Workload.get_args(self) + [('file_size', self.file_size_mb), ('io_size', self.io_size),
+                                          ('sync', self.sync)]
+
+    def run_worker(self, worker=0):
+        """ Writes mapped files one after another until stop is set.
+            Args:
+                worker (int): index of this writer, used in its file names and messages.
+        """
+        file_number = 0
+        file_bytes = self.file_size_mb * Config.BYTES_PER_MEGABYTE
+        stores = file_bytes // self.io_size
+        chunk = Config.TEST_FILL_BYTE * self.io_size
+        latency = LogHistogram()
+        clock = time.time
+        total_bytes = 0
+        msync_total = 0
+        start = clock()
+        while not self.stop.is_set():
+            test_file = self.test_file_name(worker, file_number)
+            file_number += 1
+            file_descriptor = os.open(test_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            try:
+                os.ftruncate(file_descriptor, file_bytes)
+                mapping = mmap.mmap(file_descriptor, file_bytes)
+                try:
+                    offset = 0
+                    for _ in xrange(stores):
+                        store_start = clock()
+                        mapping[offset:offset + self.io_size] = chunk
+                        latency.record((clock() - store_start) * Config.MICRO_SECONDS_PER_SECOND)
+                        offset += self.io_size
+                    if self.sync:
+                        msync_start = clock()
+                        mapping.flush()
+                        msync_total += clock() - msync_start
+                finally:
+                    mapping.close()
+            finally:
+                os.close(file_descriptor)
+                os.remove(test_file)
+            total_bytes += stores * self.io_size
+            self.send_rollover(worker, stores * self.io_size)
+            test_log.debug('mmap file roll over', extra=log_category(Config.API_TEST_FILE_WRITE))
+            self.report_latency(worker, latency)
+        self.report_latency(worker, latency, final=True)
+        elapsed = clock() - start
+        if elapsed:
+            self.send_result(worker, 'write_speed', total_bytes / Config.BYTES_PER_MEGABYTE / elapsed)
+        if self.sync and file_number:
+            self.send_result(worker, 'msync_time', msync_total / file_number * 1000)
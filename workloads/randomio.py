@@ -0,0 +1,122 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import io
+import os
+import mmap
+import random
+import time
+import testregistry
+from testregistry import Parameter, Metric
+from histogram import LogHistogram
+from config import Config
+from workload import Workload
+""" Random I/O Test
+
+Each worker writes and syncs a file_size file, then issues io_size reads
+and writes at random io_size aligned offsets until the test ends. Each
+operation is a read with probability read_percent. Writes are O_DSYNC,
+direct adds O_DIRECT so reads bypass the page cache as well. Keep
+file_size well above the page cache or use direct for device numbers.
+
+Every file_size bytes of operations are reported as a rollover. Workers
+report read and write IOPS when they stop.
+
+Example:
+    test = RandomIOTest(10, file_size=256, read_percent=70, direct=True, workers=4)
+    test.run()
+"""
+
+DEFAULT_IO_SIZE = 4096
+DEFAULT_FILE_SIZE_MB = 64
+
+
+@testregistry.register
+class RandomIOTest(Workload):
+    """ Initializes test.
+
+        Args:
+            timeout (float): test timeout time in seconds.
+            file_size (int): size of the file each worker accesses in MB.
+            io_size (optional[int]): bytes per operation, also the offset alignment.
+            read_percent (optional[int]): share of operations that are reads, 0-100.
+            direct (optional[bool]): open the file with O_DIRECT.
+            workers (optional[int]): number of concurrent processes.
+            stats_interval (optional[float]): seconds between stats samples.
+    """
+    name = 'random_io'
+    parameters = [Parameter('timeout', float, Config.TEST_DEFAULT_TIMEOUT_SEC, 'runtime in seconds'),
+                  Parameter('file_size', int, DEFAULT_FILE_SIZE_MB, 'size of the accessed file in MB'),
+                  Parameter('io_size', int, DEFAULT_IO_SIZE, 'bytes per operation'),
+                  Parameter('read_percent', int, 50, 'share of reads in percent'),
+                  Parameter('direct', bool, False, 'open the file with O_DIRECT'),
+                  Parameter('workers', int, 1, 'concurrent processes'),
+                  Parameter('stats_interval', float, Config.TEST_STATS_TIME, 'seconds between stats samples')]
+    metrics = [Metric('read_iops', 'ops/s', 'sum', 'random reads per second of all workers'),
+               Metric('write_iops', 'ops/s', 'sum', 'random writes per second of all workers')]
+
+    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, file_size=DEFAULT_FILE_SIZE_MB,
+                 io_size=DEFAULT_IO_SIZE, read_percent=50, direct=False, workers=1,
+                 stats_interval=Config.TEST_STATS_TIME):
+        Workload.__init__(self, timeout, workers, stats_interval)
+        self.file_size_mb = file_size
+        self.io_size = io_size or DEFAULT_IO_SIZE
+        self.read_percent = min(max(int(read_percent), 0), 100)
+        self.direct = direct
+        if self.file_size_mb * Config.BYTES_PER_MEGABYTE < self.io_size:
+            raise ValueError('file_size {} MB is smaller than io_size {}'.format(self.file_size_mb, self.io_size))
+
+    def get_args(self):
+        return Workload.get_args(self) + [('file_size', self.file_size_mb), ('io_size', self.io_size),
+                                          ('read_percent', self.read_percent), ('direct', self.direct)]
+
+    def run_worker(self, worker=0):
+        """ Issues random reads and writes until stop is set.
+            Args:
+                worker (int): index of this process, used in its file name and messages.
+        """
+        file_bytes = self.file_size_mb * Config.BYTES_PER_MEGABYTE
+        file_name = self.create_test_file(worker, file_bytes)
+        flags = os.O_RDWR | os.O_DSYNC
+        if self.direct:
+            flags |= getattr(os, 'O_DIRECT', 0)
+        file_descriptor = os.open(file_name, flags)
+        handle = io.FileIO(file_descriptor, 'r+', closefd=False)
+        buf = mmap.mmap(-1, self.io_size)
+        buf.write(Config.TEST_FILL_BYTE * self.io_size)
+        blocks = file_bytes // self.io_size
+        read_threshold = self.read_percent / 100
+        latency = LogHistogram()
+        rand = random.Random(os.getpid()).random
+        clock = time.time
+        reads, writes = 0, 0
+        start = clock()
+        try:
+            while not self.stop.is_set():
+                operations = 0
+                for _ in xrange(blocks):
+                    os.lseek(file_descriptor, int(rand() * blocks) * self.io_size, os.SEEK_SET)
+                    if rand() < read_threshold:
+                        op_start = clock()
+                        handle.readinto(buf)
+                        latency.record((clock() - op_start) * Config.MICRO_SECONDS_PER_SECOND)
+                        reads += 1
+                    else:
+                        op_start = clock()
+                        handle.write(buf)
+                        latency.record((clock() - op_start) * Config.MICRO_SECONDS_PER_SECOND)
+                        writes += 1
+                    operations += 1
+                    if self.stop.is_set():
+                        break
+                self.send_rollover(worker, operations * self.io_size)
+                self.report_latency(worker, latency)
+        finally:
+            handle.close()
+            os.close(file_descriptor)
+            os.remove(file_name)
+            buf.close()
+        self.report_latency(worker, latency, final=True)
+        elapsed = clock() - start
+        if elapsed:
+            self.send_result(worker, 'read_iops', reads / elapsed)
+            self.send_result(worker, 'write_iops', writes / elapsed)
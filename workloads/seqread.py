@@ -0,0 +1,105 @@
+from __future__ import division
+__author__ = 'Tristan Storz'
+import io
+import os
+import mmap
+import time
+import utilities
+import testregistry
+from testregistry import Parameter, Metric
+from histogram import LogHistogram
+from loggers import test_log, log_category
+from config import Config
+from workload import Workload
+""" Sequential Read Test
+
+Each worker writes and syncs a file_size file, then reads it from start
+to end in io_size reads until the test ends. Every pass is reported as a
+rollover with the bytes read. Before every pass the file's pages are
+dropped from the page cache with posix_fadvise, so passes are read from
+the device. direct opens the file with O_DIRECT instead.
+
+Example:
+    test = SequentialReadTest(10, file_size=64, io_size=128 * 1024)
+    test.run()
+"""
+
+DEFAULT_IO_SIZE = 128 * 1024
+
+
+@testregistry.register
+class SequentialReadTest(Workload):
+    """ Initializes test.
+
+        Args:
+            timeout (float): test timeout time in seconds.
+            file_size (int): size of the file each worker reads in MB.
+            io_size (optional[int]): bytes per read call.
+            direct (optional[bool]): read with O_DIRECT.
+            workers (optional[int]): number of concurrent reader processes.
+            stats_interval (optional[float]): seconds between stats samples.
+    """
+    name = 'seq_read'
+    parameters = [Parameter('timeout', float, Config.TEST_DEFAULT_TIMEOUT_SEC, 'runtime in seconds'),
+                  Parameter('file_size', int, Config.TEST_DEFAULT_FILE_SIZE_MB, 'size of the read file in MB'),
+                  Parameter('io_size', int, DEFAULT_IO_SIZE, 'bytes per read call'),
+                  Parameter('direct', bool, False, 'read with O_DIRECT instead of dropping the page cache'),
+                  Parameter('workers', int, 1, 'concurrent reader processes'),
+                  Parameter('stats_interval', float, Config.TEST_STATS_TIME, 'seconds between stats samples')]
+    metrics = [Metric('read_speed', 'MB/s', 'sum', 'read throughput of all workers')]
+
+    def __init__(self, timeout=Config.TEST_DEFAULT_TIMEOUT_SEC, file_size=Config.TEST_DEFAULT_FILE_SIZE_MB,
+                 io_size=DEFAULT_IO_SIZE, direct=False, workers=1,
+                 stats_interval=Config.TEST_STATS_TIME):
+        Workload.__init__(self, timeout, workers, stats_interval)
+        self.file_size_mb = file_size
+        self.io_size = io_size or DEFAULT_IO_SIZE
+        self.direct = direct
+
+    def get_args(self):
+        return Workload.get_args(self) + [('file_size', self.file_size_mb), ('io_size', self.io_size),
+                                          ('direct', self.direct)]
+
+    def run_worker(self, worker=0):
+        """ Reads the worker's file pass after pass until stop is set.
+            Args:
+                worker (int): index of this reader, used in its file name and messages.
+        """
+        file_bytes = self.file_size_mb * Config.BYTES_PER_MEGABYTE
+        file_name = self.create_test_file(worker, file_bytes)
+        flags = os.O_RDONLY
+        if self.direct:
+            flags |= getattr(os, 'O_DIRECT', 0)
+        file_descriptor = os.open(file_name, flags)
+        reader = io.FileIO(file_descriptor, 'r', closefd=False)
+        buf = mmap.mmap(-1, self.io_size)
+        latency = LogHistogram()
+        clock = time.time
+        total_bytes = 0
+        start = clock()
+        try:
+            while not self.stop.is_set():
+                if not self.direct:
+                    utilities.posix_fadvise(file_descriptor, 0, 0, utilities.POSIX_FADV_DONTNEED)
+                os.lseek(file_descriptor, 0, os.SEEK_SET)
+                pass_bytes = 0
+                while pass_bytes < file_bytes and not self.stop.is_set():
+                    read_start = clock()
+                    nbytes = reader.readinto(buf)
+                    latency.record((clock() - read_start) * Config.MICRO_SECONDS_PER_SECOND)
+                    if not nbytes:
+                        break
+                    pass_bytes += nbytes
+                total_bytes += pass_bytes
+                self.send_rollover(worker, pass_bytes)
+                test_log.debug('read pass done', extra=log_category(Config.API_TEST_FILE_WRITE))
+                self.report_latency(worker, latency)
+        finally:
+            reader.close()
+            os.close(file_descriptor)
+            os.remove(file_name)
+            buf.close()
+        self.report_latency(worker, latency, final=True)
+        elapsed = clock() - start
+        if elapsed:
+            self.send_result(worker, 'read_speed', total_bytes / Config.BYTES_PER_MEGABYTE / elapsed)